@@ -1,31 +1,79 @@
 """This module initializes the Flask application and its extensions."""
+import logging
+import os
 from flask import Flask, redirect
 from flask_sqlalchemy import SQLAlchemy
-from flasgger import Swagger
 from flasgger.utils import swag_from
 from flask_cors import CORS
-from app.extensions import db, migrate
+from app.extensions import CachedSwagger, db, migrate
 from app.swagger_config import template_swagger
+from app.admission import init_admission
 from app.config import Config 
+from app.database import configure_engines, init_engines
+from app.jobs import init_jobs
+from app.json_provider import json_provider
+from app.metrics import init_metrics
+from app.shards import init_shards
+from app.utils.responses import init_compression
+
+logger = logging.getLogger(__name__)
+
+DB_CREATE_ALL_MODES = ('auto', 'always', 'never')
+
+
+def _should_create_all(app) -> bool:
+    """Whether the tables are created on boot, flask-migrate owns them otherwise."""
+    mode = app.config['DB_CREATE_ALL']
+    if mode not in DB_CREATE_ALL_MODES:
+        raise ValueError(f"Invalid DB_CREATE_ALL '{mode}'. "
+                         f"Valid values are: {list(DB_CREATE_ALL_MODES)}")
+    if mode == 'auto':
+        directory = app.extensions['migrate'].directory
+        if os.path.isdir(directory):
+            logger.info(f"Migrations found in {directory}, skipping create_all")
+            return False
+    return mode != 'never'
+
 
 def create_app():
     """Create and configure the Flask application."""
     app = Flask(__name__)
     app.config.from_object(Config)
+    app.json = json_provider(app)
+    init_compression(app)
 
+    configure_engines(app)
     db.init_app(app)
+    init_engines(app, db)
+    shards = init_shards(app)
+    metrics = init_metrics(app, db)
+    init_admission(app)
+    init_jobs(app)
     migrate.init_app(app, db)
-    Swagger(app, template=template_swagger)
+    CachedSwagger(app, template=template_swagger)
     CORS(app)
 
-    from .routes import firewalls, policies, rules, firewall_policy
+    from .routes import changes, firewalls, jobs, policies, rules, firewall_policy
     app.register_blueprint(firewalls.bp)
     app.register_blueprint(policies.bp)
     app.register_blueprint(rules.bp)
     app.register_blueprint(firewall_policy.bp)
+    app.register_blueprint(changes.bp)
+    app.register_blueprint(jobs.bp)
+    if metrics is not None:
+        from .routes import metrics as metrics_routes
+        app.register_blueprint(metrics_routes.bp)
+
+    from .cli import docs_cli, rules_cli, search_cli, shards_cli
+    app.cli.add_command(rules_cli)
+    app.cli.add_command(docs_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(shards_cli)
 
-    with app.app_context():
-        db.create_all()
+    if _should_create_all(app):
+        with app.app_context():
+            db.create_all()
+        shards.create_all()
 
     # Redirect root URL to Swagger UI
     @app.route('/')
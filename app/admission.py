@@ -0,0 +1,237 @@
+"This file contains the admission control shedding the requests an overloaded worker cannot serve"
+import logging
+import math
+import threading
+import time
+from flask import g, jsonify, request
+from app.metrics import METRICS_KEY
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ADMISSION_KEY = 'jouerflux.admission'
+
+# Endpoint name of ADMISSION_LIMITS applying to the endpoints not listed
+DEFAULT_LIMIT = '*'
+
+# Endpoints never throttled: scraping the metrics must work under load
+EXEMPT_ENDPOINTS = ('metrics.export_metrics', 'static')
+
+# Above this many clients, the buckets refilled to their burst are forgotten
+MAX_TRACKED_CLIENTS = 10000
+
+
+def parse_limits(value: str) -> dict:
+    """Parse the ADMISSION_LIMITS setting.
+
+    Args:
+        value (str): Comma-separated endpoint=count pairs, e.g.
+            "firewall_policy.get_policies_of_firewall=4,*=16".
+
+    Returns:
+        dict: The number of concurrent requests allowed, by endpoint name.
+
+    Raises:
+        ValueError: If a pair is malformed or a count is not a positive integer.
+    """
+    limits = {}
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        endpoint, separator, count = (part.strip() for part in pair.partition('='))
+        if not separator or not endpoint or not count.isdigit() or int(count) < 1:
+            raise ValueError(f"Invalid admission limit '{pair.strip()}', expected endpoint=count")
+        limits[endpoint] = int(count)
+    return limits
+
+
+class ConcurrencyLimit:
+    """Requests of an endpoint served at once, the others waiting in a bounded queue.
+
+    A request finding the queue full is rejected at once, one waiting longer
+    than the timeout is rejected when it expires: either way it never holds
+    a database connection.
+    """
+
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> str:
+        """Take a slot, waiting in the queue if needed.
+
+        Returns:
+            str: The decision: admitted, queued (admitted after waiting), shed
+                (the queue was full) or timeout (no slot freed in time).
+        """
+        with self._condition:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return 'admitted'
+            if self.waiting >= self.queue_size:
+                return 'shed'
+            self.waiting += 1
+            try:
+                if not self._condition.wait_for(lambda: self.active < self.limit, self.timeout):
+                    return 'timeout'
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return 'queued'
+
+    def release(self):
+        """Give back a slot taken by ``acquire``."""
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class TokenBuckets:
+    """Per-client token buckets: ``rate`` requests per second, bursts of ``burst``."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, client: str) -> float:
+        """Take a token from the bucket of a client.
+
+        Returns:
+            float: 0 if the request may go, otherwise the seconds until a token is available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[client] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self._buckets[client] = (tokens - 1, now)
+            if len(self._buckets) > MAX_TRACKED_CLIENTS:
+                self._forget_full(now)
+            return 0.0
+
+    def _forget_full(self, now: float):
+        # A full bucket is the state of a client never seen, nothing is lost
+        self._buckets = {client: (tokens, updated)
+                         for client, (tokens, updated) in self._buckets.items()
+                         if tokens + (now - updated) * self.rate < self.burst}
+
+
+class Admission:
+    """Admits, queues or rejects each request before its view runs.
+
+    Rate limits are checked first, as they are cheap and per client, then
+    the concurrency limit of the endpoint. Limits hold per worker process.
+    """
+
+    def __init__(self, limits: dict, queue_size: int, queue_timeout: float, retry_after: int,
+                 rate: float, burst: int, client_header: str = '', registry=None):
+        self.limits = {endpoint: ConcurrencyLimit(count, queue_size, queue_timeout)
+                       for endpoint, count in limits.items() if endpoint != DEFAULT_LIMIT}
+        self.default_limit = limits.get(DEFAULT_LIMIT)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.buckets = TokenBuckets(rate, burst) if rate > 0 else None
+        self.client_header = client_header
+        self._lock = threading.Lock()
+        self.decisions = None
+        if registry is not None:
+            self.decisions = registry.counter(
+                'jouerflux_admission_decisions_total',
+                'Admission decisions: admitted, queued, shed, timeout or throttled.',
+                ('endpoint', 'decision'))
+
+    def limit_of(self, endpoint: str):
+        """Return the concurrency limit of an endpoint, None when it has none."""
+        limit = self.limits.get(endpoint)
+        if limit is None and self.default_limit is not None:
+            with self._lock:
+                limit = self.limits.setdefault(endpoint, ConcurrencyLimit(
+                    self.default_limit, self.queue_size, self.queue_timeout))
+        return limit
+
+    def client(self) -> str:
+        """Identify the client of the current request for its rate limit."""
+        if self.client_header:
+            value = request.headers.get(self.client_header)
+            if value:
+                # The first address of X-Forwarded-For is the original client
+                return value.split(',')[0].strip()
+        return request.remote_addr or ''
+
+    def _count(self, endpoint: str, decision: str):
+        if self.decisions is not None:
+            self.decisions.inc(endpoint, decision)
+
+    def _reject(self, status: int, message: str, retry_after: float):
+        response = jsonify({'error': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    # Flask request hooks
+
+    def before_request(self):
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+            return None
+        if self.buckets is not None:
+            wait = self.buckets.take(self.client())
+            if wait:
+                self._count(endpoint, 'throttled')
+                return self._reject(429, 'Rate limit exceeded', wait)
+        limit = self.limit_of(endpoint)
+        if limit is None:
+            return None
+        decision = limit.acquire()
+        self._count(endpoint, decision)
+        if decision in ('shed', 'timeout'):
+            logger.warning(f"Shed a request to {endpoint} ({decision}), "
+                           f"{limit.active} running, {limit.waiting} waiting")
+            return self._reject(503, 'Server busy, retry later', self.retry_after)
+        g._admission = limit
+        return None
+
+    def teardown_request(self, exception=None):
+        limit = g.pop('_admission', None)
+        if limit is not None:
+            limit.release()
+
+    def connect(self, app):
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+
+def init_admission(app):
+    """Install the admission control when ADMISSION_LIMITS or RATE_LIMIT_PER_SECOND is set.
+
+    Nothing is hooked otherwise. Decisions are counted on /metrics when
+    metrics are enabled, so call it after ``init_metrics``.
+
+    Args:
+        app (Flask): The Flask application.
+
+    Returns:
+        Admission: The admission control, or None when disabled.
+    """
+    limits = parse_limits(app.config['ADMISSION_LIMITS'])
+    rate = app.config['RATE_LIMIT_PER_SECOND']
+    if not limits and rate <= 0:
+        return None
+    burst = app.config['RATE_LIMIT_BURST'] or max(1, math.ceil(rate))
+    admission = Admission(limits, app.config['ADMISSION_QUEUE_SIZE'],
+                          app.config['ADMISSION_QUEUE_TIMEOUT'],
+                          app.config['ADMISSION_RETRY_AFTER'], rate, burst,
+                          app.config['RATE_LIMIT_CLIENT_HEADER'],
+                          app.extensions.get(METRICS_KEY))
+    admission.connect(app)
+    app.extensions[ADMISSION_KEY] = admission
+    return admission
@@ -0,0 +1,139 @@
+"This file contains the maintenance commands of the Flask application"
+import json
+import logging
+import os
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, func, select, update
+from app.extensions import db
+from app.models import Policy, Rule
+from app.shards import MAIN_SHARD, rule_shards
+from app.utils.common import address_columns
+from app.utils.resharding import move_policy, plan_moves, shard_loads
+from app.utils.search import SEARCHABLE_MODELS, install_name_index
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+rules_cli = AppGroup('rules', help='Maintenance of the firewall rules.')
+docs_cli = AppGroup('docs', help='API documentation.')
+search_cli = AppGroup('search', help='Name search indexes.')
+shards_cli = AppGroup('shards', help='Placement of the rules across the shards.')
+
+
+@rules_cli.command('backfill-ranges')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of rules updated per transaction.')
+def backfill_ranges(batch_size: int):
+    """Fill the normalized address ranges of the rules created before they existed."""
+    table = Rule.__table__
+    statement = (update(table)
+                 .where(table.c.id == bindparam('rule_id'))
+                 .values({column: bindparam(column) for column in (
+                     'src_version', 'src_start', 'src_end',
+                     'dst_version', 'dst_start', 'dst_end')}))
+    shards = rule_shards()
+    total = 0
+    for name in shards.names():
+        bind_arguments = shards.bind_arguments(name)
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                select(table.c.id, table.c.source_ip, table.c.destination_ip)
+                .where(table.c.id > last_id, table.c.src_version.is_(None))
+                .order_by(table.c.id)
+                .limit(batch_size),
+                bind_arguments=bind_arguments
+            ).all()
+            if not rows:
+                break
+            params = [{'rule_id': rule_id,
+                       **address_columns('src', source_ip),
+                       **address_columns('dst', destination_ip)}
+                      for rule_id, source_ip, destination_ip in rows]
+            db.session.execute(statement, params, bind_arguments=bind_arguments)
+            db.session.commit()
+            total += len(rows)
+            last_id = rows[-1].id
+            logger.info(f"Backfilled {total} rules")
+    click.echo(f"Backfilled address ranges of {total} rules")
+
+
+@docs_cli.command('build')
+@click.option('--output', default=None, help='Artifact path, defaults to APISPEC_PATH.')
+def build_spec(output: str):
+    """Compile the OpenAPI spec of every endpoint into a JSON artifact."""
+    app = current_app._get_current_object()
+    output = output or app.config['APISPEC_PATH']
+    swagger = app.swag
+    with app.test_request_context():
+        specs = {spec['endpoint']: swagger.get_apispecs(spec['endpoint'])
+                 for spec in swagger.config['specs']}
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as artifact:
+        json.dump(specs, artifact, separators=(',', ':'))
+    click.echo(f"Wrote {sum(len(spec['paths']) for spec in specs.values())} paths to {output}")
+
+
+@search_cli.command('rebuild')
+def rebuild_search():
+    """Create the name search indexes if missing and re-index every name."""
+    with db.engine.begin() as connection:
+        for model in SEARCHABLE_MODELS:
+            if not install_name_index(connection, model, rebuild=True):
+                click.echo(f"No name index for the {connection.dialect.name} database")
+                return
+    click.echo(f"Rebuilt the name indexes of {', '.join(m.__tablename__ for m in SEARCHABLE_MODELS)}")
+
+
+@shards_cli.command('status')
+def shards_status():
+    """Show the policies and rules held by each shard."""
+    shards = rule_shards()
+    policies = dict(db.session.execute(select(Policy.shard, func.count())
+                                       .group_by(Policy.shard)).all())
+    for name in shards.names():
+        rules = db.session.execute(select(func.count()).select_from(Rule),
+                                   bind_arguments=shards.bind_arguments(name)).scalar()
+        placed = policies.get(None if name == MAIN_SHARD else name, 0)
+        click.echo(f"{name}: {placed} policies, {rules} rules")
+
+
+@shards_cli.command('move')
+@click.argument('policy_id', type=int)
+@click.argument('shard')
+@click.option('--batch-size', default=None, type=int,
+              help='Rules copied per transaction, defaults to SHARD_MOVE_BATCH_SIZE.')
+def shards_move(policy_id: int, shard: str, batch_size: int):
+    """Move the rules of a policy to another shard, online."""
+    batch_size = batch_size or current_app.config['SHARD_MOVE_BATCH_SIZE']
+    try:
+        result = move_policy(policy_id, shard, batch_size=batch_size,
+                             progress=lambda copied: logger.info(f"Copied {copied} rules"))
+    except (LookupError, ValueError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Policy {policy_id}: {result['rules']} rules moved "
+               f"from {result['source']} to {result['target']}")
+
+
+@shards_cli.command('rebalance')
+@click.option('--dry-run', is_flag=True, help='Only print the planned moves.')
+@click.option('--batch-size', default=None, type=int,
+              help='Rules copied per transaction, defaults to SHARD_MOVE_BATCH_SIZE.')
+def shards_rebalance(dry_run: bool, batch_size: int):
+    """Spread the rules evenly over the shards, the main database being drained."""
+    shards = rule_shards()
+    if not shards.enabled:
+        raise click.ClickException("No rule shard configured, see RULE_SHARDS")
+    batch_size = batch_size or current_app.config['SHARD_MOVE_BATCH_SIZE']
+    moves = plan_moves(shard_loads(db.session), list(shards.engines))
+    db.session.close()
+    for policy_id, source, target, rules in moves:
+        click.echo(f"Policy {policy_id}: {rules} rules from {source} to {target}")
+        if not dry_run:
+            try:
+                move_policy(policy_id, target, batch_size=batch_size)
+            except LookupError as e:
+                click.echo(f"Skipped: {e}")
+    click.echo(f"{len(moves)} policies {'to move' if dry_run else 'moved'}")
@@ -5,6 +5,115 @@ class Config:
     """Base configuration."""
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///jouerflux.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Read replica used by the GET endpoints, a SQLite file gets a query-only engine by default
+    READ_DATABASE_URL = os.getenv('READ_DATABASE_URL')
+
+    # Rule shards as comma-separated name=URL pairs, e.g. "a=sqlite:///rules-a.db", see
+    # app.shards; new policies are spread over them, empty keeps every rule in this database
+    RULE_SHARDS = os.getenv('RULE_SHARDS', '')
+    # Rules copied per transaction when a policy moves between shards
+    SHARD_MOVE_BATCH_SIZE = int(os.getenv('SHARD_MOVE_BATCH_SIZE', '5000'))
+
+    # Engine profile: auto (from the database URL), sqlite, postgresql or none
+    DB_PROFILE = os.getenv('DB_PROFILE', 'auto')
+    # SQLite profile, applied as pragmas on every connection
+    SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+    # PostgreSQL profile, connection pool sizing
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+
+    # JSON encoder of the responses: auto (orjson when installed), orjson or stdlib
+    JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+
+    # Request and SQL instrumentation exposed on /metrics, nothing is hooked when disabled
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    # Statements slower than this are logged with their fingerprint
+    SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+
+    # Admission control, per worker process: concurrent requests by endpoint as comma-separated
+    # endpoint=count pairs, "*" for the endpoints not listed; empty disables the limits
+    ADMISSION_LIMITS = os.getenv('ADMISSION_LIMITS', '')
+    # Requests waiting for a slot of an endpoint, and the longest wait in seconds, before a 503
+    ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '16'))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '5'))
+    # Retry-After of the 503 responses, in seconds
+    ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '1'))
+    # Per-client token buckets answering 429 beyond the rate: 0 disables them, a burst of 0
+    # allows one second of requests. Buckets are per worker process too, so a client spread
+    # over every worker gets up to workers x the rate
+    RATE_LIMIT_PER_SECOND = float(os.getenv('RATE_LIMIT_PER_SECOND', '0'))
+    RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '0'))
+    # Header naming the client behind a proxy, e.g. X-Forwarded-For; empty uses the peer address
+    RATE_LIMIT_CLIENT_HEADER = os.getenv('RATE_LIMIT_CLIENT_HEADER', '')
+    # Largest page size of the listings, larger per_page and limit values are lowered to it;
+    # unset, pages are as large as requested
+    MAX_PER_PAGE = int(os.getenv('MAX_PER_PAGE')) if os.getenv('MAX_PER_PAGE') else None
+
+    # Name search: auto uses the FTS5 / pg_trgm index when present, scan always uses ILIKE
+    SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'auto')
+
+    # Change feed: entries per response, longest long-poll and SSE stream, in seconds
+    CHANGES_PAGE_SIZE = int(os.getenv('CHANGES_PAGE_SIZE', '500'))
+    CHANGES_MAX_WAIT = float(os.getenv('CHANGES_MAX_WAIT', '25'))
+    CHANGES_STREAM_SECONDS = float(os.getenv('CHANGES_STREAM_SECONDS', '300'))
+    # Seconds between two reads of the last sequence number by the waiting requests
+    CHANGES_POLL_INTERVAL = float(os.getenv('CHANGES_POLL_INTERVAL', '1'))
+    # Seconds between two SSE keep-alive comments
+    CHANGES_HEARTBEAT = float(os.getenv('CHANGES_HEARTBEAT', '15'))
+    # Long-polls and streams waiting at once per worker process, beyond which they get a 503
+    # at once so that the other requests keep threads to run on; 0 disables the cap
+    CHANGES_MAX_WAITERS = int(os.getenv('CHANGES_MAX_WAITERS', '16'))
+
+    # Background jobs: threads per process, and the sizes above which a mutation becomes a job
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', '1'))
+    JOB_POLICY_RULES = int(os.getenv('JOB_POLICY_RULES', '10000'))
+    JOB_BULK_PAIRS = int(os.getenv('JOB_BULK_PAIRS', '10000'))
+    # Rows deleted per transaction by the jobs, and the pause letting other writers in between
+    DELETE_BATCH_SIZE = int(os.getenv('DELETE_BATCH_SIZE', '5000'))
+    DELETE_BATCH_PAUSE_MS = float(os.getenv('DELETE_BATCH_PAUSE_MS', '10'))
+
+    # Number of flows parsed and matched at once by the batch evaluation
+    BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', '10000'))
+
+    # Number of rows inserted per transaction by the bulk rule import
+    BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '5000'))
+    # Maximum number of row errors listed in a bulk import report
+    BULK_MAX_ERRORS = int(os.getenv('BULK_MAX_ERRORS', '1000'))
+
+    # Number of rules fetched per round trip by the server-side export cursor
+    EXPORT_YIELD_PER = int(os.getenv('EXPORT_YIELD_PER', '1000'))
+
+    # Streamed listings: rows read per round trip by the cursor of the expanded collections,
+    # and characters of JSON encoded and compressed per chunk
+    LISTING_YIELD_PER = int(os.getenv('LISTING_YIELD_PER', '1000'))
+    STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', str(64 * 1024)))
+    # Content codings of the streamed listings by preference, those not installed are skipped
+    # (zstd needs zstandard, br needs brotli); empty sends them uncompressed
+    RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'zstd,br,gzip')
+
+    # Pre-fork server started by python -m app.serve; 0 workers means 2 x CPUs + 1.
+    # Threaded workers (gthread) keep serving while change feed requests wait; sync serves
+    # one request at a time per worker
+    SERVE_BIND = os.getenv('SERVE_BIND', '0.0.0.0:5000')
+    SERVE_WORKERS = int(os.getenv('SERVE_WORKERS', '0'))
+    SERVE_WORKER_CLASS = os.getenv('SERVE_WORKER_CLASS', 'gthread')
+    SERVE_THREADS = int(os.getenv('SERVE_THREADS', '32'))
+    SERVE_TIMEOUT = int(os.getenv('SERVE_TIMEOUT', '30'))
+    SERVE_GRACEFUL_TIMEOUT = int(os.getenv('SERVE_GRACEFUL_TIMEOUT', '30'))
+    # Recycle each worker after this many requests (0 disables), jittered to stagger restarts
+    SERVE_MAX_REQUESTS = int(os.getenv('SERVE_MAX_REQUESTS', '0'))
+    SERVE_MAX_REQUESTS_JITTER = int(os.getenv('SERVE_MAX_REQUESTS_JITTER', '0'))
+
+    # Create missing tables on boot: auto skips it when a migrations directory exists
+    DB_CREATE_ALL = os.getenv('DB_CREATE_ALL', 'auto')
+
+    # OpenAPI spec compiled by "flask docs build", served instead of parsing the YAML files
+    APISPEC_PATH = os.getenv('APISPEC_PATH', os.path.join(os.path.dirname(__file__),
+                                                          'swagger', 'apispec.json'))
 
     SWAGGER = {
         'title': 'JouerFlux API',
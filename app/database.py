@@ -0,0 +1,198 @@
+"This file contains the database engine profiles and the read/write session routing"
+import logging
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, create_engine, event
+from sqlalchemy.engine import make_url
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DB_PROFILES = ('auto', 'sqlite', 'postgresql', 'none')
+
+# Requests served by the read engine when there is one
+READ_METHODS = ('GET', 'HEAD')
+
+READ_ENGINE_KEY = 'jouerflux.read_engine'
+
+SHARDS_KEY = 'jouerflux.shards'
+
+
+def _is_memory(url) -> bool:
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def resolve_profile(config, url=None) -> str:
+    """Return the engine profile of a configuration, guessing it from the URL on auto.
+
+    Args:
+        config (Config): The application configuration.
+        url (str, optional): The database URL, defaults to SQLALCHEMY_DATABASE_URI.
+
+    Returns:
+        str: One of "sqlite", "postgresql" or "none".
+
+    Raises:
+        ValueError: If the profile is not supported.
+    """
+    profile = config['DB_PROFILE']
+    if profile not in DB_PROFILES:
+        raise ValueError(f"Invalid DB_PROFILE '{profile}'. Valid values are: {list(DB_PROFILES)}")
+    if profile == 'auto':
+        backend = make_url(url or config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+        profile = backend if backend in DB_PROFILES else 'none'
+    return profile
+
+
+def engine_options(config, url=None) -> dict:
+    """Build the create_engine options of a profile.
+
+    Args:
+        config (Config): The application configuration.
+        url (str, optional): The database URL, defaults to SQLALCHEMY_DATABASE_URI.
+
+    Returns:
+        dict: The engine options.
+    """
+    url = url or config['SQLALCHEMY_DATABASE_URI']
+    profile = resolve_profile(config, url)
+    if profile == 'postgresql':
+        return {
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            'pool_recycle': config['DB_POOL_RECYCLE'],
+            'pool_pre_ping': True,
+        }
+    if profile == 'sqlite' and not _is_memory(make_url(url)):
+        # The busy timeout is also set as a pragma, this covers the connect itself
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}}
+    return {}
+
+
+def install_sqlite_pragmas(engine, config, read_only: bool = False):
+    """Tune every new SQLite connection of an engine.
+
+    WAL lets readers run while a writer commits, the busy timeout makes writers
+    wait for each other instead of failing, and synchronous=NORMAL is durable
+    enough in WAL mode while saving an fsync per commit. Foreign keys are
+    enforced, so that ON DELETE CASCADE removes the rules and associations of
+    deleted rows.
+
+    Args:
+        engine (Engine): The SQLite engine.
+        config (Config): The application configuration.
+        read_only (bool, optional): Whether writes are refused. Defaults to False.
+    """
+    pragmas = [
+        ('journal_mode', 'WAL'),
+        ('busy_timeout', config['SQLITE_BUSY_TIMEOUT']),
+        ('synchronous', config['SQLITE_SYNCHRONOUS']),
+        ('mmap_size', config['SQLITE_MMAP_SIZE']),
+        ('foreign_keys', 'ON'),
+    ]
+    if read_only:
+        pragmas.append(('query_only', 'ON'))
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def configure_engines(app):
+    """Apply the engine profile to the configuration, before ``db.init_app``.
+
+    Args:
+        app (Flask): The Flask application.
+    """
+    options = engine_options(app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def init_engines(app, db):
+    """Install the profile hooks on the engines and create the read engine.
+
+    Reads go to READ_DATABASE_URL when set; otherwise a SQLite file database
+    gets a second, query-only engine, since WAL readers never wait for the
+    writer. Other databases without a replica keep a single engine.
+
+    Args:
+        app (Flask): The Flask application.
+        db (SQLAlchemy): The Flask-SQLAlchemy extension.
+    """
+    profile = resolve_profile(app.config)
+    with app.app_context():
+        engines = list(db.engines.values())
+        primary = db.engine
+    if profile == 'sqlite':
+        for engine in engines:
+            install_sqlite_pragmas(engine, app.config)
+
+    read_url = app.config['READ_DATABASE_URL']
+    if read_url is None and profile == 'sqlite' and not _is_memory(primary.url):
+        read_url = primary.url
+    if read_url is None:
+        return
+
+    read_engine = create_engine(read_url, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    if read_engine.dialect.name == 'sqlite':
+        install_sqlite_pragmas(read_engine, app.config, read_only=True)
+    app.extensions[READ_ENGINE_KEY] = read_engine
+    logger.info(f"Routing {', '.join(READ_METHODS)} requests to "
+                f"{read_engine.url.render_as_string(hide_password=True)}")
+
+
+def app_engines(app, db) -> list:
+    """Return every engine of the application, the read and rule shard engines included.
+
+    Args:
+        app (Flask): The Flask application.
+        db (SQLAlchemy): The Flask-SQLAlchemy extension.
+
+    Returns:
+        list: The engines.
+    """
+    with app.app_context():
+        engines = list(db.engines.values())
+    read_engine = app.extensions.get(READ_ENGINE_KEY)
+    if read_engine is not None:
+        engines.append(read_engine)
+    shards = app.extensions.get(SHARDS_KEY)
+    if shards is not None:
+        engines.extend(shards.engines.values())
+    return engines
+
+
+class RoutingSession(Session):
+    """Session sending the queries of read-only requests to the read engine.
+
+    Only SELECT statements bound to the default engine are routed, and never
+    while flushing, so writes always reach the primary. When the rules are
+    sharded, the flush writes each rule through the connection of its shard.
+    """
+
+    @property
+    def connection_callable(self):
+        # Only set while flushing: SQLAlchemy refuses ORM bulk statements otherwise
+        if self._flushing:
+            shards = current_app.extensions.get(SHARDS_KEY)
+            if shards is not None and shards.enabled:
+                return self._flush_connection
+        return None
+
+    def _flush_connection(self, mapper, instance):
+        return current_app.extensions[SHARDS_KEY].flush_connection(self, mapper, instance)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if (bind is None and not self._flushing and has_request_context()
+                and request.method in READ_METHODS
+                and (clause is None or isinstance(clause, Select))):
+            read_engine = current_app.extensions.get(READ_ENGINE_KEY)
+            if read_engine is not None and engine is self._db.engines.get(None):
+                return read_engine
+        return engine
@@ -1,6 +1,27 @@
 "This file contains the extensions for the Flask application"
+import json
+import os
+from flasgger import Swagger
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from app.database import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
+
+
+class CachedSwagger(Swagger):
+    """Flasgger extension serving the spec compiled by ``flask docs build``.
+
+    The artifact is read on the first spec request of a process. Without it,
+    or in debug mode, the spec is built from the YAML files of the routes.
+    """
+
+    def get_apispecs(self, endpoint='apispec_1'):
+        path = self.app.config.get('APISPEC_PATH')
+        if self.app.debug or not path or not os.path.exists(path):
+            return super().get_apispecs(endpoint)
+        if endpoint not in self.apispecs:
+            with open(path, encoding='utf-8') as artifact:
+                self.apispecs.update(json.load(artifact))
+        return self.apispecs[endpoint]
@@ -0,0 +1,127 @@
+"This file contains the in-process runner of the background jobs"
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from app.extensions import db
+from app.models import Job
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+JOBS_KEY = 'jouerflux.jobs'
+
+JOB_STATUSES = ('pending', 'running', 'succeeded', 'failed')
+
+# Functions running each kind of job, see ``job_handler``
+JOB_HANDLERS = {}
+
+
+def job_handler(kind: str):
+    """Register the function running a kind of job.
+
+    The function gets the Job, whose ``progress`` it may update before each
+    commit, and its parameters; it returns the result stored on the job.
+    """
+    def register(function):
+        JOB_HANDLERS[kind] = function
+        return function
+    return register
+
+
+def job_dict(job: Job) -> dict:
+    """Serialize a job."""
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'result': job.result,
+        'error': job.error,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
+
+
+class JobRunner:
+    """Runs the jobs on a small thread pool of the serving process.
+
+    Jobs are stored in the database, so that any worker answers their status,
+    but run in the process that accepted them: a job interrupted by a restart
+    stays running and must be submitted again.
+    """
+
+    def __init__(self, app, workers: int = 1):
+        self.app = app
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # Created in the worker itself: threads do not survive the fork of a preloaded app
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='jouerflux-job')
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, kind: str, params: dict) -> Job:
+        """Record a job and schedule it.
+
+        Args:
+            kind (str): The kind of job, registered with ``job_handler``.
+            params (dict): The JSON parameters of the job.
+
+        Returns:
+            Job: The pending job, committed.
+        """
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        job = Job(kind=kind, params=params, status='pending')
+        db.session.add(job)
+        db.session.commit()
+        self._pool().submit(self._run, job.id)
+        logger.info(f"Submitted job {job.id} ({kind})")
+        return job
+
+    def _run(self, job_id: int):
+        with self.app.app_context():
+            job = db.session.get(Job, job_id)
+            job.status = 'running'
+            job.started_at = db.func.current_timestamp()
+            db.session.commit()
+            try:
+                result = JOB_HANDLERS[job.kind](job, job.params)
+            except Exception as e:
+                db.session.rollback()
+                logger.exception(f"Job {job_id} ({job.kind}) failed")
+                job.status, job.error = 'failed', str(e)
+            else:
+                job.status, job.result = 'succeeded', result
+                logger.info(f"Job {job_id} ({job.kind}) succeeded")
+            job.finished_at = db.func.current_timestamp()
+            db.session.commit()
+            db.session.remove()
+
+
+def init_jobs(app) -> JobRunner:
+    """Create the job runner of the application.
+
+    Args:
+        app (Flask): The Flask application.
+
+    Returns:
+        JobRunner: The runner, also stored in ``app.extensions``.
+    """
+    runner = JobRunner(app, app.config['JOB_WORKERS'])
+    app.extensions[JOBS_KEY] = runner
+    return runner
+
+
+def submit_job(kind: str, params: dict) -> Job:
+    """Submit a job to the runner of the current application, see ``JobRunner.submit``."""
+    return current_app.extensions[JOBS_KEY].submit(kind, params)
@@ -0,0 +1,74 @@
+"This file contains the JSON provider of the application, backed by orjson when it is installed"
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKENDS = ('auto', 'orjson', 'stdlib')
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider encoding and decoding with orjson.
+
+    Documents are equivalent to those of the stdlib provider: keys are sorted,
+    dates and decimals go through the same ``default`` hook, and responses are
+    pretty-printed in debug mode. Non-ASCII text is written as UTF-8 rather
+    than escaped. Values orjson refuses (integers above 64 bits) fall back to
+    the stdlib encoder.
+    """
+
+    def _option(self, indent: bool = False) -> int:
+        # Dates are left to ``default``, which renders them as HTTP dates like Flask
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._option()).decode()
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        try:
+            body = orjson.dumps(obj, default=self.default, option=self._option(indent)
+                                | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            return super().response(obj)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def json_provider(app):
+    """Build the JSON provider selected by JSON_BACKEND.
+
+    Args:
+        app (Flask): The Flask application.
+
+    Returns:
+        JSONProvider: orjson on auto when it is installed, the stdlib provider otherwise.
+
+    Raises:
+        ValueError: If the backend is not supported or not installed.
+    """
+    backend = app.config['JSON_BACKEND']
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f"Invalid JSON_BACKEND '{backend}'. Valid values are: {list(JSON_BACKENDS)}")
+    if backend == 'orjson' and orjson is None:
+        raise ValueError("JSON_BACKEND 'orjson' requires the orjson package")
+    if backend == 'stdlib' or orjson is None:
+        return DefaultJSONProvider(app)
+    return OrjsonProvider(app)
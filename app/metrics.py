@@ -0,0 +1,258 @@
+"This file contains the request and SQL instrumentation exposed in the Prometheus text format"
+import logging
+import re
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from flask import has_request_context, request, request_finished, request_started
+from sqlalchemy import event
+from app.database import app_engines
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = 'jouerflux.metrics'
+# WSGI environment key of the start time, SQL count and SQL time of the current request
+STATE_KEY = 'jouerflux.metrics.request'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+# Literals, then the expanded parameter lists of IN clauses, are folded in fingerprints
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LISTS = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)")
+_SPACES = re.compile(r'\s+')
+
+
+def fingerprint(statement: str) -> tuple:
+    """Normalize a SQL statement so that executions of the same query match.
+
+    Args:
+        statement (str): The statement sent to the database.
+
+    Returns:
+        tuple: The short hexadecimal fingerprint and the normalized statement.
+    """
+    normalized = _SPACES.sub(' ', statement).strip()
+    normalized = _PARAMETER_LISTS.sub('(?)', _LITERALS.sub('?', normalized))
+    return f"{zlib.crc32(normalized.encode()):08x}", normalized
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in values]
+
+
+class Histogram:
+    """Histogram with cumulative buckets, a sum and a count per label set."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(values)
+            if state is None:
+                state = self._values[values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> list:
+        with self._lock:
+            values = sorted((key, (list(counts), total, count))
+                            for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    """Metrics of the process, rendered in the Prometheus text format.
+
+    Each worker process of app.serve holds its own registry: a scrape
+    returns the metrics of the worker that served it.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labels, **kwargs)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        """Return the counter of a name, registering it on first use."""
+        return self._get(Counter, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets=LATENCY_BUCKETS) -> Histogram:
+        """Return the histogram of a name, registering it on first use."""
+        return self._get(Histogram, name, documentation, labels, buckets=buckets)
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Instrumentation:
+    """Request latency, per-request SQL counts and timings, and the slow query log."""
+
+    def __init__(self, registry: Registry, slow_query_seconds: float):
+        self.registry = registry
+        self.slow_query_seconds = slow_query_seconds
+        self.requests = registry.counter(
+            'jouerflux_http_requests_total', 'HTTP requests served.',
+            ('endpoint', 'method', 'status'))
+        self.latency = registry.histogram(
+            'jouerflux_http_request_duration_seconds', 'Time spent serving a request.',
+            ('endpoint', 'method'))
+        self.request_queries = registry.histogram(
+            'jouerflux_http_request_queries', 'SQL statements executed per request.',
+            ('endpoint',), buckets=QUERY_COUNT_BUCKETS)
+        self.request_db_time = registry.histogram(
+            'jouerflux_http_request_db_seconds', 'Time spent in SQL statements per request.',
+            ('endpoint',))
+        self.queries = registry.counter(
+            'jouerflux_db_queries_total', 'SQL statements executed.')
+        self.query_time = registry.counter(
+            'jouerflux_db_query_seconds_total', 'Time spent in SQL statements.')
+        self.slow_queries = registry.counter(
+            'jouerflux_db_slow_queries_total', 'SQL statements slower than SLOW_QUERY_MS.',
+            ('fingerprint',))
+
+    # Flask signals
+
+    def request_started(self, sender, **extra):
+        # Kept in the WSGI environment, which a streamed body re-pushing the
+        # request context still sees, unlike g
+        request.environ[STATE_KEY] = [time.perf_counter(), 0, 0.0]
+
+    def request_finished(self, sender, response, **extra):
+        state = request.environ.get(STATE_KEY)
+        if state is None:
+            return
+        endpoint = request.endpoint or 'unmatched'
+        method, status = request.method, response.status_code
+        # The body of a streamed response is produced after this signal: the
+        # request is recorded once the server has sent it and closed the response
+        response.call_on_close(lambda: self.record(state, endpoint, method, status))
+
+    def record(self, state: list, endpoint: str, method: str, status: int):
+        """Record a served request, with the SQL statements run until its body was sent."""
+        started, queries, db_time = state
+        self.latency.observe(time.perf_counter() - started, endpoint, method)
+        self.requests.inc(endpoint, method, status)
+        self.request_queries.observe(queries, endpoint)
+        self.request_db_time.observe(db_time, endpoint)
+
+    # SQLAlchemy cursor events
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_metrics_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['_metrics_started'].pop()
+        self.queries.inc()
+        self.query_time.inc(amount=elapsed)
+        if has_request_context():
+            state = request.environ.get(STATE_KEY)
+            if state is not None:
+                state[1] += 1
+                state[2] += elapsed
+        if elapsed >= self.slow_query_seconds:
+            key, normalized = fingerprint(statement)
+            self.slow_queries.inc(key)
+            logger.warning(f"Slow query {key} ({elapsed * 1000:.1f} ms): {normalized[:500]}")
+
+    def instrument_engine(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def connect(self, app):
+        request_started.connect(self.request_started, app, weak=False)
+        request_finished.connect(self.request_finished, app, weak=False)
+
+
+def init_metrics(app, db):
+    """Instrument the application when METRICS_ENABLED is set.
+
+    Nothing is hooked otherwise, so disabled metrics cost nothing.
+
+    Args:
+        app (Flask): The Flask application.
+        db (SQLAlchemy): The Flask-SQLAlchemy extension, its engines are measured.
+
+    Returns:
+        Registry: The metrics registry, or None when metrics are disabled.
+    """
+    if not app.config['METRICS_ENABLED']:
+        return None
+    registry = Registry()
+    instrumentation = Instrumentation(registry, app.config['SLOW_QUERY_MS'] / 1000)
+    instrumentation.connect(app)
+    for engine in app_engines(app, db):
+        instrumentation.instrument_engine(engine)
+    app.extensions[METRICS_KEY] = registry
+    return registry
@@ -1,11 +1,20 @@
 "This file contains the models for the firewall application"
+from sqlalchemy.orm import validates
 from app.extensions import db
+from app.utils.common import address_columns
 from app.utils.schema import ActionEnum, ProtocolEnum
 
 firewall_policy = db.Table(
     'firewall_policy',
-    db.Column('firewall_id', db.Integer, db.ForeignKey('firewall.id'), primary_key=True),
-    db.Column('policy_id', db.Integer, db.ForeignKey('policy.id'), primary_key=True)
+    db.Column('firewall_id', db.Integer, db.ForeignKey('firewall.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('policy_id', db.Integer, db.ForeignKey('policy.id', ondelete='CASCADE'),
+              primary_key=True),
+    # Fractional key ordering the policies of a firewall, see app.utils.ordering
+    db.Column('position', db.Float, nullable=False, server_default='0'),
+    # Unique like the primary key it extends: the planner then knows the policies come out
+    # distinct and reads the rules of each one in index order, without sorting them
+    db.Index('ix_firewall_policy_position', 'firewall_id', 'position', 'policy_id', unique=True)
 )
 
 
@@ -16,13 +25,17 @@ class Firewall(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
+    # Bumped whenever the firewall, its policies or their rules change
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     __table_args__ = (
         db.UniqueConstraint('name', name='uq_firewall_name'),
     )
+    # Association rows are deleted by the database, the collections are not loaded
     policies = db.relationship(
         'Policy',
         secondary=firewall_policy,
-        back_populates='firewalls'
+        back_populates='firewalls',
+        passive_deletes=True
     )
     def __repr__(self):
         return f"<Firewall {self.name}>"
@@ -35,14 +48,21 @@ class Policy(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    rules = db.relationship('Rule', backref='policy', cascade="all, delete-orphan")
+    # Bumped whenever the policy, its rules or its firewalls change
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Rule shard holding the rules of the policy, None for this database (see app.shards)
+    shard = db.Column(db.String(50), nullable=True)
+    # Rules are deleted by the database (ON DELETE CASCADE), without being loaded
+    rules = db.relationship('Rule', backref='policy', cascade="all, delete-orphan",
+                            passive_deletes=True)
     __table_args__ = (
         db.UniqueConstraint('name', name='uq_policy_name'),
     )
     firewalls = db.relationship(
         'Firewall',
         secondary=firewall_policy,
-        back_populates='policies'
+        back_populates='policies',
+        passive_deletes=True
     )
     def __repr__(self):
         return f"<Policy {self.name}>"
@@ -56,7 +76,33 @@ class Rule(db.Model):
     source_ip = db.Column(db.String(45), nullable=False)
     destination_ip = db.Column(db.String(45), nullable=False)
     port = db.Column(db.Integer, nullable=True)
-    policy_id = db.Column(db.Integer, db.ForeignKey('policy.id'), nullable=False)
+    # Last port of a port range, None for a single port
+    port_end = db.Column(db.Integer, nullable=True)
+    policy_id = db.Column(db.Integer, db.ForeignKey('policy.id', ondelete='CASCADE'),
+                          nullable=False)
+    # Fractional key ordering the rules of a policy, see app.utils.ordering
+    position = db.Column(db.Float, nullable=False, server_default='0')
+    # Normalized address ranges, derived from source_ip and destination_ip
+    src_version = db.Column(db.SmallInteger, nullable=True)
+    src_start = db.Column(db.LargeBinary(16), nullable=True)
+    src_end = db.Column(db.LargeBinary(16), nullable=True)
+    dst_version = db.Column(db.SmallInteger, nullable=True)
+    dst_start = db.Column(db.LargeBinary(16), nullable=True)
+    dst_end = db.Column(db.LargeBinary(16), nullable=True)
+    __table_args__ = (
+        # Serves the ordered reads of a policy, and the lookups by policy
+        db.Index('ix_rule_policy_position', 'policy_id', 'position'),
+        db.Index('ix_rule_src_range', 'src_version', 'src_start', 'src_end'),
+        db.Index('ix_rule_dst_range', 'dst_version', 'dst_start', 'dst_end'),
+    )
+
+    @validates('source_ip', 'destination_ip')
+    def validate_address(self, key, value):
+        """Keep the normalized range columns in sync with the addresses."""
+        prefix = 'src' if key == 'source_ip' else 'dst'
+        for column, normalized in address_columns(prefix, value).items():
+            setattr(self, column, normalized)
+        return value
 
     def __repr__(self):
         return (f"<Rule {self.action.value.upper()} {self.protocol.value.upper()} "
@@ -70,5 +116,102 @@ class Rule(db.Model):
             'source_ip': self.source_ip,
             'destination_ip': self.destination_ip,
             'protocol': self.protocol.value,
-            'port': self.port
+            'port': self.port,
+            'port_end': self.port_end,
+            'position': self.position
         }
+
+
+class RuleSequence(db.Model):
+    """Next rule ID, allocated here when the rules are sharded so that IDs stay unique."""
+    __tablename__ = 'rule_sequence'
+
+    id = db.Column(db.Integer, primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+
+class ChangeLog(db.Model):
+    """Append-only log of the changes seen by the enforcement agents.
+
+    Rule entries carry their policy; association, firewall and policy entries
+    carry the firewall they concern, so a feed can be filtered by firewall.
+    """
+    __tablename__ = 'change_log'
+
+    seq = db.Column(db.Integer, primary_key=True)
+    # rule, policy, firewall or firewall_policy
+    entity = db.Column(db.String(20), nullable=False)
+    # create, update, delete, attach, detach, move or reorder
+    op = db.Column(db.String(10), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=True)
+    firewall_id = db.Column(db.Integer, nullable=True)
+    policy_id = db.Column(db.Integer, nullable=True)
+    # The serialized rule of rule creations and updates
+    payload = db.Column(db.JSON, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
+    __table_args__ = (
+        db.Index('ix_change_log_firewall', 'firewall_id', 'seq'),
+        db.Index('ix_change_log_policy', 'policy_id', 'seq'),
+        # Sequence numbers are never reused, even after the last entries are deleted
+        {'sqlite_autoincrement': True},
+    )
+
+    def __repr__(self):
+        return f"<ChangeLog {self.seq} {self.entity} {self.op}>"
+
+
+class RuleContent(db.Model):
+    """Content of a rule frozen in snapshots, stored once per distinct content."""
+    __tablename__ = 'rule_content'
+
+    # BLAKE2b digest of the canonical content
+    digest = db.Column(db.LargeBinary(16), primary_key=True)
+    content = db.Column(db.JSON, nullable=False)
+
+
+class RulesetContent(db.Model):
+    """Ordered list of rule digests forming an effective ruleset, stored once per distinct list."""
+    __tablename__ = 'ruleset_content'
+
+    # BLAKE2b digest of the concatenated rule digests
+    digest = db.Column(db.LargeBinary(16), primary_key=True)
+    rule_count = db.Column(db.Integer, nullable=False)
+    # The rule digests in evaluation order, 16 bytes each
+    rules = db.Column(db.LargeBinary, nullable=False)
+
+
+class RulesetSnapshot(db.Model):
+    """Effective ruleset of a firewall frozen at a point in time.
+
+    The firewall is not a foreign key: snapshots outlive the firewall.
+    """
+    __tablename__ = 'ruleset_snapshot'
+
+    id = db.Column(db.Integer, primary_key=True)
+    firewall_id = db.Column(db.Integer, nullable=False, index=True)
+    firewall_version = db.Column(db.Integer, nullable=False)
+    digest = db.Column(db.LargeBinary(16), db.ForeignKey('ruleset_content.digest'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f"<RulesetSnapshot {self.id} of firewall {self.firewall_id}>"
+
+
+class Job(db.Model):
+    """Background job running a heavy mutation, polled through GET /jobs/<id>."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    # pending, running, succeeded or failed
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    params = db.Column(db.JSON, nullable=True)
+    # Updated by the job as it goes, e.g. the rows deleted so far
+    progress = db.Column(db.JSON, nullable=True)
+    result = db.Column(db.JSON, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.kind} {self.status}>"
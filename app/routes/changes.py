@@ -0,0 +1,135 @@
+"This file contains the change feed read by the enforcement agents"
+import logging
+import time
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from flasgger.utils import swag_from
+from app.extensions import db
+from app.utils.changes import change_notifier, changes_since, latest_sequence
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('changes', __name__, url_prefix='/changes')
+
+EVENT_STREAM = 'text/event-stream'
+
+
+def _feed_args() -> dict:
+    """Read the cursor, the firewall filter, the page size and the wait of a feed request.
+
+    Raises:
+        ValueError: If a parameter is not a number or out of range.
+    """
+    since = request.headers.get('Last-Event-ID') or request.args.get('since', default='0')
+    firewall_id = request.args.get('firewall_id')
+    max_limit = current_app.config['CHANGES_PAGE_SIZE']
+    try:
+        args = {
+            'since': int(since),
+            'firewall_id': int(firewall_id) if firewall_id is not None else None,
+            'limit': int(request.args.get('limit', default=max_limit)),
+            'wait': float(request.args.get('wait', default='0')),
+        }
+    except ValueError:
+        raise ValueError("since, firewall_id and limit must be integers, wait a number of seconds")
+    if args['since'] < 0 or args['wait'] < 0 or not 1 <= args['limit'] <= max_limit:
+        raise ValueError(f"since and wait must be positive, limit between 1 and {max_limit}")
+    args['wait'] = min(args['wait'], current_app.config['CHANGES_MAX_WAIT'])
+    return args
+
+
+def _load_latest() -> int:
+    latest = latest_sequence()
+    # Waiting requests hold no database connection
+    db.session.close()
+    return latest
+
+
+def _busy() -> Response:
+    """Reject a waiting request beyond CHANGES_MAX_WAITERS, before it holds a thread."""
+    logger.warning(f"Rejected a change feed request, {change_notifier.waiters} already waiting")
+    response = jsonify({'error': 'Too many change feed requests waiting, retry later'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(current_app.config['ADMISSION_RETRY_AFTER'])
+    return response
+
+
+def _wait(seen: int, timeout: float) -> bool:
+    return change_notifier.wait(seen, timeout, _load_latest,
+                                current_app.config['CHANGES_POLL_INTERVAL'])
+
+
+@swag_from('/app/swagger/changes/get.yaml', methods=['get'])
+@bp.route('/', methods=['GET'])
+def list_changes() -> Response:
+    """Return the change entries after a cursor, optionally waiting for them.
+
+    With ``wait`` the request is held until an entry arrives or the wait
+    expires (long-poll); with ``Accept: text/event-stream`` the entries are
+    pushed as Server-Sent Events until CHANGES_STREAM_SECONDS elapse. Beyond
+    CHANGES_MAX_WAITERS such requests in the process, they get a 503 at once.
+
+    Returns:
+        Response: The entries and the next cursor, or the event stream.
+    """
+    try:
+        args = _feed_args()
+    except ValueError as e:
+        logger.error(f"Invalid change feed parameters: {e}")
+        return jsonify({'error': str(e)}), 400
+    stream = request.accept_mimetypes.best_match(['application/json', EVENT_STREAM]) == EVENT_STREAM
+    waits = stream or args['wait'] > 0
+    if waits and not change_notifier.enter(current_app.config['CHANGES_MAX_WAITERS']):
+        return _busy()
+    if stream:
+        response = _event_stream(args['since'], args['firewall_id'], args['limit'])
+        # Released when the server closes the response, even if the stream never started
+        response.call_on_close(change_notifier.leave)
+        return response
+
+    deadline = time.monotonic() + args['wait']
+    try:
+        while True:
+            # Read before the query, so that a commit in between wakes the wait
+            seen = change_notifier.latest
+            changes = changes_since(args['since'], args['firewall_id'], args['limit'])
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                break
+            db.session.close()
+            if not _wait(seen, remaining):
+                break
+    finally:
+        if waits:
+            change_notifier.leave()
+
+    return jsonify({
+        'changes': changes,
+        'next_since': changes[-1]['seq'] if changes else args['since'],
+        'has_more': len(changes) == args['limit']
+    }), 200
+
+
+def _event_stream(since: int, firewall_id: int, limit: int) -> Response:
+    """Push the change entries as Server-Sent Events, the event ID being the cursor."""
+    heartbeat = current_app.config['CHANGES_HEARTBEAT']
+    deadline = time.monotonic() + current_app.config['CHANGES_STREAM_SECONDS']
+    dumps = current_app.json.dumps
+
+    def generate():
+        cursor = since
+        while True:
+            seen = change_notifier.latest
+            changes = changes_since(cursor, firewall_id, limit)
+            db.session.close()
+            for change in changes:
+                cursor = change['seq']
+                yield f"id: {cursor}\nevent: change\ndata: {dumps(change)}\n\n"
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if len(changes) < limit and not _wait(seen, min(heartbeat, remaining)):
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(generate()), mimetype=EVENT_STREAM,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -1,10 +1,22 @@
 "This file contains the routes for managing firewall policies in a Flask application"
 import logging
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify, url_for
 from flasgger.utils import swag_from
+from pydantic import ValidationError
+from sqlalchemy import delete, exists, insert, select, update
 from app import db
-from app.models import Firewall, Policy
-from app.utils.common import paginate_query
+from app.jobs import job_dict, job_handler, submit_job
+from app.models import Firewall, Policy, firewall_policy
+from app.utils.associations import (attach_pairs, detach_pairs, missing_ids, spec_ids,
+                                    spec_size)
+from app.utils.changes import association_entry, record_changes
+from app.utils.common import pagination_args, pagination_envelope, paginate_query, safe_commit
+from app.utils.ordering import POLICY_ORDER, schedule_rebalance
+from app.utils.projection import Projection
+from app.utils.responses import JsonArray, json_stream_response
+from app.utils.ruleset import ruleset_cache
+from app.utils.schema import BulkAssociationCheck, OrderCheck
+from app.utils.versions import bump_versions
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,30 +26,104 @@ bp = Blueprint('firewall_policy', __name__, url_prefix='/firewall-policy')
 @swag_from('/app/swagger/firewall_policy/add_to_firewall.yaml', methods=['post'])
 @bp.route('/<int:firewall_id>/add/<int:policy_id>', methods=['POST'])
 def add_policy_to_firewall(firewall_id: int, policy_id: int) -> tuple:
-    """_summary_
+    """Attach a policy to a firewall.
+
+    The policy goes last, or right before or after the policy named by the
+    ``before`` or ``after`` field of the optional JSON body.
 
     Args:
-        firewall_id (int): _description_
-        policy_id (int): _description_
+        firewall_id (int): The ID of the firewall.
+        policy_id (int): The ID of the policy.
 
     Returns:
-        tuple: _description_
+        tuple: A tuple containing the response data and status code.
     """
     firewall = Firewall.query.get_or_404(firewall_id)
     policy = Policy.query.get_or_404(policy_id)
+    try:
+        order = OrderCheck.model_validate(request.get_json(silent=True) or {})
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), 400
 
-    if policy in firewall.policies:
+    # Checked on the association row, the policies collection is never loaded
+    attached = db.session.scalar(select(exists().where(
+        firewall_policy.c.firewall_id == firewall.id,
+        firewall_policy.c.policy_id == policy.id)))
+    if attached:
         return jsonify({'message': 'Policy already associated with firewall'}), 400
 
-    firewall.policies.append(policy)
-    db.session.commit()
+    try:
+        position, cramped = POLICY_ORDER.place(db.session, firewall.id, before=order.before,
+                                               after=order.after)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    # Written with Core, the ORM cannot set the position of an association row
+    db.session.execute(insert(firewall_policy).values(firewall_id=firewall.id,
+                                                      policy_id=policy.id, position=position))
+    bump_versions(db.session, firewall_ids=[firewall.id], policy_ids=[policy.id])
+    record_changes(db.session, [association_entry('attach', firewall.id, policy.id, position)])
+    if not safe_commit(db.session):
+        return jsonify({'error': 'Failed to add policy to firewall'}), 500
+    ruleset_cache.invalidate(firewall_ids=[firewall_id])
+    if cramped:
+        schedule_rebalance(POLICY_ORDER, firewall_id)
     return jsonify({'message': 'Policy added to firewall'}), 200
 
+@swag_from('/app/swagger/firewall_policy/move.yaml', methods=['post'])
+@bp.route('/<int:firewall_id>/move/<int:policy_id>', methods=['POST'])
+def move_policy_in_firewall(firewall_id: int, policy_id: int) -> tuple:
+    """Move a policy right before or after another policy of a firewall.
+
+    Only the association row of the moved policy is written: its key is set
+    halfway between the keys of its new neighbours.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+        policy_id (int): The ID of the moved policy.
+
+    Returns:
+        tuple: A tuple containing the response data and status code.
+    """
+    try:
+        order = OrderCheck.model_validate(request.json)
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), 400
+    if order.before is None and order.after is None:
+        return jsonify({'error': 'Give either before or after'}), 400
+
+    attached = db.session.execute(select(firewall_policy.c.policy_id).where(
+        firewall_policy.c.firewall_id == firewall_id,
+        firewall_policy.c.policy_id == policy_id)).first()
+    if attached is None:
+        return jsonify({'message': 'Policy not associated with firewall'}), 404
+    try:
+        position, cramped = POLICY_ORDER.place(db.session, firewall_id, policy_id,
+                                               before=order.before, after=order.after)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    db.session.execute(update(firewall_policy)
+                       .where(firewall_policy.c.firewall_id == firewall_id,
+                              firewall_policy.c.policy_id == policy_id)
+                       .values(position=position))
+    bump_versions(db.session, firewall_ids=[firewall_id])
+    record_changes(db.session, [association_entry('move', firewall_id, policy_id, position)])
+    if not safe_commit(db.session):
+        return jsonify({'error': 'Failed to move policy'}), 500
+    ruleset_cache.invalidate(firewall_ids=[firewall_id])
+    if cramped:
+        schedule_rebalance(POLICY_ORDER, firewall_id)
+    return jsonify({'firewall_id': firewall_id, 'policy_id': policy_id, 'position': position}), 200
+
 @swag_from('/app/swagger/firewall_policy/remove_from_firewall.yaml', methods=['delete'])
 @bp.route('/<int:firewall_id>/remove/<int:policy_id>', methods=['DELETE'])
 def remove_policy_from_firewall(firewall_id: int, policy_id: int) -> tuple:
     """Remove a policy from a firewall.
 
+    The association row is deleted with Core, without loading the policies
+    collection of the firewall.
+
     Args:
         firewall_id (int): The ID of the firewall.
         policy_id (int): The ID of the policy.
@@ -45,48 +131,135 @@ def remove_policy_from_firewall(firewall_id: int, policy_id: int) -> tuple:
     Returns:
         tuple: A tuple containing the response data and status code.
     """
-    firewall = Firewall.query.get_or_404(firewall_id)
-    policy = Policy.query.get_or_404(policy_id)
+    Firewall.query.get_or_404(firewall_id)
+    Policy.query.get_or_404(policy_id)
 
-    if policy not in firewall.policies:
+    removed = db.session.execute(delete(firewall_policy).where(
+        firewall_policy.c.firewall_id == firewall_id,
+        firewall_policy.c.policy_id == policy_id)).rowcount
+    if not removed:
+        db.session.rollback()
         return jsonify({'message': 'Policy not associated with firewall'}), 400
-
-    firewall.policies.remove(policy)
-    db.session.commit()
+    bump_versions(db.session, firewall_ids=[firewall_id], policy_ids=[policy_id])
+    record_changes(db.session, [association_entry('detach', firewall_id, policy_id)])
+    if not safe_commit(db.session):
+        return jsonify({'error': 'Failed to remove policy from firewall'}), 500
+    # Core writes are not seen by the flush listeners
+    ruleset_cache.invalidate(firewall_ids=[firewall_id])
     return "", 204
 
 @swag_from('/app/swagger/firewall_policy/get_by_firewall.yaml', methods=['get'])
 @bp.route('/<int:firewall_id>/policies', methods=['GET'])
 def get_policies_of_firewall(firewall_id: int) -> tuple :
-    """_summary_
+    """List the policies attached to a firewall, in evaluation order.
+
+    Policies are ordered by their position in the firewall, then by ID; the
+    cursors hold both, so that pages neither overlap nor skip a policy.
 
     Args:
-        firewall_id (int): _description_
+        firewall_id (int): The ID of the firewall.
 
     Returns:
-        tuple: _description_
+        tuple: The streamed JSON listing, or an error tuple.
     """
-    firewall = Firewall.query.get_or_404(firewall_id)
-    filters = []
-    if firewall:
-        filters.append(Policy.firewalls.any(id=firewall.id))
-
+    Firewall.query.get_or_404(firewall_id)
     try :
-        page = request.args.get('page', default=1, type=int)
-        per_page = request.args.get('per_page', default=25, type=int)
+        pagination = pagination_args(default_per_page=25, keyed=True)
     except ValueError as e:
         logger.error(f"Invalid pagination parameters: {e}")
         return jsonify({'error': 'Invalid pagination parameters'}), 400
-    paginated = paginate_query(Policy, filters=filters, page=page, per_page=per_page)
-    results = [{'id': fw.id,
-                'name': fw.name,
-                'rules': [r.to_dict()
-                          for r in fw.rules]}
-               for fw in paginated.items]
-    return jsonify({
-        'total': paginated.total,
-        'pages': paginated.pages,
-        'page': page,
-        'per_page': per_page,
-        'results': results
-    }), 200
+    try:
+        projection = Projection.from_request(Policy, default_expand=('rules',))
+    except ValueError as e:
+        logger.error(f"Invalid projection: {e}")
+        return jsonify({'error': str(e)}), 400
+    attached = Policy.query.join(firewall_policy, firewall_policy.c.policy_id == Policy.id)
+    paginated = paginate_query(Policy, filters=[firewall_policy.c.firewall_id == firewall_id],
+                               options=projection.options(), query=attached,
+                               order_by=firewall_policy.c.position, **pagination)
+    results = JsonArray(projection.stream_all(paginated.items,
+                                              current_app.config['LISTING_YIELD_PER']))
+    return json_stream_response(pagination_envelope(paginated, results, **pagination))
+
+def _apply_bulk_association(dto: BulkAssociationCheck, firewall_ids: set, policy_ids: set) -> dict:
+    """Write the detached then the attached pairs of a request in one transaction.
+
+    Raises:
+        RuntimeError: If the transaction could not be committed.
+    """
+    connection = db.session.connection()
+    detached = detach_pairs(connection, dto.detach) if dto.detach is not None else []
+    requested, attached = attach_pairs(connection, dto.attach) if dto.attach is not None else (0, [])
+    if attached or detached:
+        bump_versions(db.session, firewall_ids=firewall_ids, policy_ids=policy_ids)
+        record_changes(db.session, [association_entry(op, *pair)
+                                    for op, pairs in (('detach', detached), ('attach', attached))
+                                    for pair in pairs])
+    if not safe_commit(db.session):
+        raise RuntimeError('Failed to update the associations')
+    if attached or detached:
+        # Core writes are not seen by the flush listeners
+        ruleset_cache.invalidate(firewall_ids=firewall_ids)
+
+    logger.info(f"Bulk association: {len(attached)} attached, "
+                f"{requested - len(attached)} skipped, {len(detached)} detached")
+    return {
+        'attached': len(attached),
+        'skipped': requested - len(attached),
+        'detached': len(detached)
+    }
+
+
+@job_handler('bulk_associate')
+def _bulk_associate_job(job, params: dict) -> dict:
+    """Run a large bulk association in the background."""
+    dto = BulkAssociationCheck.model_validate(params['request'])
+    return _apply_bulk_association(dto, set(params['firewall_ids']), set(params['policy_ids']))
+
+
+@swag_from('/app/swagger/firewall_policy/bulk.yaml', methods=['post'])
+@bp.route('/bulk', methods=['POST'])
+def bulk_associate() -> tuple:
+    """Attach and detach many policies and firewalls in one transaction.
+
+    The association table is written with set-based statements, without
+    loading the collections of the firewalls or policies. Detached pairs are
+    removed before the new pairs are attached. Requests of more than
+    JOB_BULK_PAIRS pairs run as a background job, answered with 202 Accepted.
+
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    try:
+        dto = BulkAssociationCheck.model_validate(request.json)
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), 400
+
+    firewall_ids, policy_ids = set(), set()
+    pairs = 0
+    for spec in (dto.detach, dto.attach):
+        if spec is not None:
+            spec_firewall_ids, spec_policy_ids = spec_ids(spec)
+            firewall_ids |= spec_firewall_ids
+            policy_ids |= spec_policy_ids
+            pairs += spec_size(spec)
+
+    connection = db.session.connection()
+    for model, ids, label in ((Firewall, firewall_ids, 'firewall'), (Policy, policy_ids, 'policy')):
+        missing = missing_ids(connection, model, ids)
+        if missing:
+            db.session.rollback()
+            return jsonify({'error': f"Unknown {label} ids: {missing}"}), 404
+
+    if pairs > current_app.config['JOB_BULK_PAIRS']:
+        db.session.rollback()
+        job = submit_job('bulk_associate', {'request': dto.model_dump(exclude_none=True),
+                                            'firewall_ids': sorted(firewall_ids),
+                                            'policy_ids': sorted(policy_ids)})
+        return jsonify(job_dict(job)), 202, {'Location': url_for('jobs.get_job', job_id=job.id)}
+
+    try:
+        result = _apply_bulk_association(dto, firewall_ids, policy_ids)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(result), 200
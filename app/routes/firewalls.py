@@ -1,13 +1,25 @@
 "This module provides routes for managing firewalls in the JouerFlux application."
+import json
 import logging
-from flask import jsonify, request, Blueprint
+import time
+from flask import abort, current_app, jsonify, request, stream_with_context, Blueprint, Response
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from pydantic import ValidationError
 from flasgger.utils import swag_from
-from app.models import Firewall
+from app.models import Firewall, Rule, RulesetContent, RulesetSnapshot
 from app.extensions import db
 import app.utils.common as common_utils
-from app.utils.schema import NameCheck
+from app.utils.analysis import analyze_rules
+from app.utils.export import MIMETYPES, exporter_for
+from app.utils.projection import Projection
+from app.utils.ruleset import DEFAULT_ACTION, effective_rule_rows, ruleset_cache
+from app.utils.search import name_filter
+from app.utils.schema import FlowCheck, NameCheck
+from app.utils.serializers import serializer_for
+from app.utils.snapshots import (diff_snapshots, load_contents, ruleset_rules, snapshot_dict,
+                                 split_digests, take_snapshot)
+from app.utils.streams import chunked, iter_records, stream_format
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,24 +36,27 @@ def list_firewalls()-> tuple:
     """
     logger.info("Fetching all firewalls")
     try :
-        page = request.args.get('page', default=1, type=int)
-        per_page = request.args.get('per_page', default=10, type=int)
+        pagination = common_utils.pagination_args(default_per_page=10)
     except ValueError as e:
         logger.error(f"Invalid pagination parameters: {e}")
         return jsonify({'error': 'Invalid pagination parameters'}), 400
+    try:
+        projection = Projection.from_request(Firewall)
+    except ValueError as e:
+        logger.error(f"Invalid projection: {e}")
+        return jsonify({'error': str(e)}), 400
     filters = []
     name = request.args.get('name', default=None, type=str)
     if name:
-        filters.append(Firewall.name.ilike(f"%{name}%"))
-    paginated = common_utils.paginate_query(Firewall, filters=filters, page=page, per_page=per_page)
-    results = [{'id': fw.id, 'name': fw.name} for fw in paginated.items]
-    return jsonify({
-            'total': paginated.total,
-            'pages': paginated.pages,
-            'page': page,
-            'per_page': per_page,
-            'results': results
-        }), 200
+        try:
+            filters.append(name_filter(Firewall, name, request.args.get('match', default='contains')))
+        except ValueError as e:
+            logger.error(f"Invalid name search: {e}")
+            return jsonify({'error': str(e)}), 400
+    paginated = common_utils.paginate_query(Firewall, filters=filters,
+                                            options=projection.options(), **pagination)
+    results = projection.serialize_all(paginated.items)
+    return jsonify(common_utils.pagination_envelope(paginated, results, **pagination)), 200
 
 @swag_from('/app/swagger/firewall/get_by_id.yaml', methods=['get'])
 @bp.route('/<int:firewall_id>', methods=['GET'])
@@ -54,12 +69,24 @@ def get_firewall(firewall_id: int) -> tuple:
         tuple: A tuple containing the JSON response and the HTTP status code.
     """
     logger.info(f"Fetching firewall with ID: {firewall_id}")
-    firewall = Firewall.query.get_or_404(firewall_id)
-    return jsonify({
-        'id': firewall.id,
-        'name': firewall.name,
-        'policies': [{'id': p.id, 'name': p.name} for p in firewall.policies]
-    }), 200
+    # Only the version is read when the client copy is still current
+    version = db.session.execute(
+        select(Firewall.version).where(Firewall.id == firewall_id)).scalar()
+    if version is None:
+        abort(404)
+    etag = common_utils.version_etag(version)
+    if request.if_none_match.contains(etag):
+        return common_utils.not_modified(etag)
+    try:
+        projection = Projection.from_request(Firewall, default_expand=('policies',))
+    except ValueError as e:
+        logger.error(f"Invalid projection: {e}")
+        return jsonify({'error': str(e)}), 400
+    firewall = (Firewall.query.options(*projection.options())
+                .filter_by(id=firewall_id).first_or_404())
+    response = jsonify(projection.serialize(firewall))
+    response.set_etag(etag)
+    return response, 200
 
 
 @swag_from('/app/swagger/firewall/post.yaml', methods=['post'])
@@ -113,3 +140,227 @@ def delete_firewall(firewall_id: int) -> tuple:
     db.session.commit()
 
     return "", 204
+
+
+@swag_from('/app/swagger/firewall/evaluate.yaml', methods=['post'])
+@bp.route('/<int:firewall_id>/evaluate', methods=['POST'])
+def evaluate_flow(firewall_id: int) -> tuple:
+    """Evaluate a flow against the rules of a firewall.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    data = request.json
+    try:
+        dto = FlowCheck.model_validate(data)
+
+    except ValidationError as e:
+        logger.error(f"Validation error: {e}")
+        return jsonify({'error': str(e)}), 400
+
+    compiled = ruleset_cache.get(firewall_id)
+    if compiled is None:
+        abort(404)
+
+    rule = compiled.lookup(dto.protocol.value, dto.source_ip, dto.destination_ip, dto.port)
+    return jsonify({
+        'action': rule['action'] if rule else DEFAULT_ACTION.value,
+        'matched': rule is not None,
+        'rule': rule
+    }), 200
+
+
+@swag_from('/app/swagger/firewall/evaluate_batch.yaml', methods=['post'])
+@bp.route('/<int:firewall_id>/evaluate/batch', methods=['POST'])
+def evaluate_flows(firewall_id: int) -> Response:
+    """Evaluate a stream of flows against the rules of a firewall.
+
+    Flows are read as NDJSON or CSV and evaluated in chunks; one verdict line is
+    streamed back per flow, in input order, followed by a summary line.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+
+    Returns:
+        Response: The streamed NDJSON verdicts.
+    """
+    try:
+        fmt = stream_format(request)
+    except ValueError as e:
+        logger.error(f"Invalid batch format: {e}")
+        return jsonify({'error': str(e)}), 400
+
+    compiled = ruleset_cache.get(firewall_id)
+    if compiled is None:
+        abort(404)
+
+    # NumPy is imported on the first batch only, it weighs on every cold start
+    from app.utils.batch import evaluate_records, rule_arrays
+    arrays = rule_arrays(compiled)
+    chunk_size = current_app.config['BATCH_CHUNK_SIZE']
+    records = iter_records(request.stream, fmt)
+
+    def generate():
+        started = time.perf_counter()
+        flows = errors = 0
+        for chunk in chunked(records, chunk_size):
+            lines, chunk_errors = evaluate_records(arrays, chunk)
+            flows += len(chunk)
+            errors += chunk_errors
+            yield ''.join(lines)
+
+        elapsed = time.perf_counter() - started
+        logger.info(f"Evaluated {flows} flows against firewall {firewall_id} in {elapsed:.3f}s")
+        yield json.dumps({'summary': {
+            'flows': flows,
+            'errors': errors,
+            'seconds': round(elapsed, 6),
+            'flows_per_sec': round(flows / elapsed, 1) if elapsed else None
+        }}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@swag_from('/app/swagger/firewall/export.yaml', methods=['get'])
+@bp.route('/<int:firewall_id>/export', methods=['GET'])
+def export_firewall(firewall_id: int) -> Response:
+    """Export the rules of a firewall for a real firewall.
+
+    Rules are read with a server-side cursor and streamed in evaluation order,
+    so the whole document is never built in memory.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+
+    Returns:
+        Response: The streamed ruleset.
+    """
+    firewall = Firewall.query.get_or_404(firewall_id)
+    fmt = request.args.get('format', default='nft', type=str)
+    try:
+        exporter = exporter_for(fmt, firewall)
+    except ValueError as e:
+        logger.error(f"Invalid export format: {e}")
+        return jsonify({'error': str(e)}), 400
+
+    yield_per = current_app.config['EXPORT_YIELD_PER']
+    logger.info(f"Exporting firewall {firewall_id} as {fmt}")
+
+    def generate():
+        yield exporter.header()
+        convert = serializer_for(Rule).convert
+        rows = effective_rule_rows(db.session, firewall_id, yield_per=yield_per)
+        for partition in chunked(rows, yield_per):
+            chunk = []
+            for row in partition:
+                entry = convert(row)
+                entry['policy_id'] = row.policy_id
+                chunk.append(exporter.rule(entry))
+            yield ''.join(chunk)
+        yield exporter.footer()
+
+    return Response(stream_with_context(generate()), mimetype=MIMETYPES[fmt], headers={
+        'Content-Disposition': f'attachment; filename="{firewall.name}.{fmt}"'
+    })
+
+
+@swag_from('/app/swagger/firewall/analysis.yaml', methods=['get'])
+@bp.route('/<int:firewall_id>/analysis', methods=['GET'])
+def analyze_firewall(firewall_id: int) -> tuple:
+    """Report the shadowed, redundant and conflicting rules of a firewall.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    max_conflicts = request.args.get('max_conflicts', default=1000, type=int)
+    compiled = ruleset_cache.get(firewall_id)
+    if compiled is None:
+        abort(404)
+
+    started = time.perf_counter()
+    report = analyze_rules(compiled.rules, max_conflicts=max_conflicts)
+    logger.info(f"Analyzed {len(compiled)} rules of firewall {firewall_id} "
+                f"in {time.perf_counter() - started:.3f}s")
+    report['firewall_id'] = firewall_id
+    return jsonify(report), 200
+
+
+@swag_from('/app/swagger/firewall/snapshot_create.yaml', methods=['post'])
+@bp.route('/<int:firewall_id>/snapshots', methods=['POST'])
+def create_snapshot(firewall_id: int) -> tuple:
+    """Freeze the effective ruleset of a firewall into an immutable snapshot.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    started = time.perf_counter()
+    snapshot, stored = take_snapshot(db.session, firewall_id)
+    if snapshot is None:
+        abort(404)
+    rule_count = db.session.execute(select(RulesetContent.rule_count)
+                                    .where(RulesetContent.digest == snapshot.digest)).scalar_one()
+    if not common_utils.safe_commit(db.session):
+        return jsonify({'error': 'Failed to create the snapshot'}), 500
+    logger.info(f"Snapshot {snapshot.id} of firewall {firewall_id}: {rule_count} rules "
+                f"in {time.perf_counter() - started:.3f}s")
+    result = snapshot_dict(snapshot, rule_count)
+    result['deduplicated'] = stored
+    return jsonify(result), 201
+
+
+def _snapshot_or_404(firewall_id: int, snapshot_id: int) -> RulesetSnapshot:
+    snapshot = db.session.get(RulesetSnapshot, snapshot_id)
+    if snapshot is None or snapshot.firewall_id != firewall_id:
+        abort(404)
+    return snapshot
+
+
+@swag_from('/app/swagger/firewall/snapshot_get.yaml', methods=['get'])
+@bp.route('/<int:firewall_id>/snapshots/<int:snapshot_id>', methods=['GET'])
+def get_snapshot(firewall_id: int, snapshot_id: int) -> tuple:
+    """Return a snapshot with its frozen rules, in evaluation order.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+        snapshot_id (int): The ID of the snapshot.
+
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    snapshot = _snapshot_or_404(firewall_id, snapshot_id)
+    digests = split_digests(ruleset_rules(db.session, snapshot.digest))
+    contents = load_contents(db.session, digests)
+    result = snapshot_dict(snapshot, len(digests))
+    result['rules'] = [contents[digest] for digest in digests]
+    return jsonify(result), 200
+
+
+@swag_from('/app/swagger/firewall/snapshot_diff.yaml', methods=['get'])
+@bp.route('/<int:firewall_id>/snapshots/<int:base_id>/diff/<int:head_id>', methods=['GET'])
+def diff_snapshot(firewall_id: int, base_id: int, head_id: int) -> tuple:
+    """Compute the rules added and removed between two snapshots of a firewall.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+        base_id (int): The ID of the older snapshot.
+        head_id (int): The ID of the newer snapshot.
+
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    base = _snapshot_or_404(firewall_id, base_id)
+    head = _snapshot_or_404(firewall_id, head_id)
+    started = time.perf_counter()
+    diff = diff_snapshots(db.session, base, head)
+    logger.info(f"Diff of snapshots {base_id} and {head_id}: {len(diff['added'])} added, "
+                f"{len(diff['removed'])} removed in {time.perf_counter() - started:.3f}s")
+    return jsonify({'firewall_id': firewall_id, 'base': base_id, 'head': head_id, **diff}), 200
@@ -0,0 +1,23 @@
+"This file contains the route reporting the status of the background jobs"
+from flask import Blueprint, jsonify
+from flasgger.utils import swag_from
+from app.extensions import db
+from app.jobs import job_dict
+from app.models import Job
+
+bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+
+@swag_from('/app/swagger/jobs/get.yaml', methods=['get'])
+@bp.route('/<int:job_id>', methods=['GET'])
+def get_job(job_id: int) -> tuple:
+    """Get the status, progress and result of a background job.
+
+    Args:
+        job_id (int): The ID of the job.
+
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    job = db.get_or_404(Job, job_id)
+    return jsonify(job_dict(job)), 200
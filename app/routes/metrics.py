@@ -0,0 +1,18 @@
+"This file contains the route exposing the application metrics to Prometheus"
+from flask import Blueprint, Response, current_app
+from flasgger.utils import swag_from
+from app.metrics import METRICS_KEY
+
+bp = Blueprint('metrics', __name__)
+
+
+@swag_from('/app/swagger/metrics/get.yaml', methods=['get'])
+@bp.route('/metrics', methods=['GET'])
+def export_metrics() -> Response:
+    """Render the metrics of this process in the Prometheus text format.
+
+    Returns:
+        Response: The text exposition of the metrics.
+    """
+    registry = current_app.extensions[METRICS_KEY]
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
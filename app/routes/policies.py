@@ -1,12 +1,26 @@
 """Manage firewall policies and routes for the JouerFlux application."""
 import logging
-from flask import Blueprint, request, jsonify
+from flask import abort, Blueprint, Response, current_app, request, jsonify, url_for
 from pydantic import ValidationError
 from flasgger.utils import swag_from
 from app.extensions import db
-from app.models import Policy
-from app.utils.common import paginate_query, safe_commit
+from app.jobs import job_dict, job_handler, submit_job
+from sqlalchemy import delete, select
+from app.models import ActionEnum, Policy, ProtocolEnum, Rule
+from app.shards import rule_shards
+from app.utils.changes import record_changes, rule_entry
+from app.utils.common import (not_modified, pagination_args, pagination_envelope,
+                              paginate_query, safe_commit, version_etag)
+from app.utils.compaction import compact_rules
+from app.utils.deletes import count_rules, delete_policy_in_batches
+from app.utils.projection import Projection
+from app.utils.responses import JsonArray, json_stream_response
+from app.utils.ruleset import ruleset_cache
+from app.utils.streams import chunked
+from app.utils.versions import bump_versions
+from app.utils.search import name_filter
 from app.utils.schema import NameCheck
+from app.utils.serializers import serializer_for
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,37 +29,39 @@ bp = Blueprint('policies', __name__, url_prefix='/policies')
 
 @swag_from('/app/swagger/policy/get_list.yaml', methods=['get'])
 @bp.route('/', methods=['GET'])
-def list_all_policies()-> tuple:
+def list_all_policies()-> Response:
     """List all firewall policies.
 
+    The page is streamed, rules included, and compressed when the client accepts it.
+
     Returns:
-        tuple: A tuple containing the JSON response and the HTTP status code.
+        Response: The streamed JSON listing, or an error tuple.
     """
     try :
-        page = request.args.get('page', default=1, type=int)
-        per_page = request.args.get('per_page', default=25, type=int)
+        pagination = pagination_args(default_per_page=25)
     except ValueError as e:
         logger.error(f"Invalid pagination parameters: {e}")
         return jsonify({'error': 'Invalid pagination parameters'}), 400
+    try:
+        projection = Projection.from_request(Policy, default_expand=('rules',))
+    except ValueError as e:
+        logger.error(f"Invalid projection: {e}")
+        return jsonify({'error': str(e)}), 400
     filters = []
     name = request.args.get('name', default=None, type=str)
     if name:
-        filters.append(Policy.name.ilike(f"%{name}%"))
-
-    paginated = paginate_query(Policy, filters=filters, page=page, per_page=per_page)
-    results = [{'id': fw.id,
-                'name': fw.name, 
-                'rules': [r.to_dict() 
-                          for r in fw.rules]}
-               for fw in paginated.items]
-
-    return jsonify({
-        'total': paginated.total,
-        'pages': paginated.pages,
-        'page': page,
-        'per_page': per_page,
-        'results': results
-    }), 200
+        try:
+            filters.append(name_filter(Policy, name, request.args.get('match', default='contains')))
+        except ValueError as e:
+            logger.error(f"Invalid name search: {e}")
+            return jsonify({'error': str(e)}), 400
+
+    paginated = paginate_query(Policy, filters=filters,
+                               options=projection.options(), **pagination)
+    # Rule-heavy pages are streamed from a cursor rather than built in memory
+    results = JsonArray(projection.stream_all(paginated.items,
+                                              current_app.config['LISTING_YIELD_PER']))
+    return json_stream_response(pagination_envelope(paginated, results, **pagination))
 
 @swag_from('/app/swagger/policy/get_by_id.yaml', methods=['get'])
 @bp.route('/<int:policy_id>', methods=['GET'])
@@ -56,12 +72,24 @@ def list_policies(policy_id: int) -> tuple:
     Returns:
         tuple: A tuple containing the JSON response and the HTTP status code.
     """
-    policies = Policy.query.get_or_404(policy_id)
-    return jsonify({
-        'id': policies.id,
-        'name': policies.name,
-        'rules': [r.to_dict() for r in policies.rules]
-    })
+    # Only the version is read when the client copy is still current
+    version = db.session.execute(
+        select(Policy.version).where(Policy.id == policy_id)).scalar()
+    if version is None:
+        abort(404)
+    etag = version_etag(version)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    try:
+        projection = Projection.from_request(Policy, default_expand=('rules',))
+    except ValueError as e:
+        logger.error(f"Invalid projection: {e}")
+        return jsonify({'error': str(e)}), 400
+    policies = (Policy.query.options(*projection.options())
+                .filter_by(id=policy_id).first_or_404())
+    response = jsonify(projection.serialize(policies))
+    response.set_etag(etag)
+    return response
 
 @swag_from('/app/swagger/policy/post.yaml', methods=['post'])
 @bp.route('/', methods=['POST'])
@@ -96,15 +124,93 @@ def create_policy() -> tuple:
 @bp.route('/<int:policy_id>', methods=['DELETE'])
 def delete_policy(policy_id: int) -> tuple:
     """Delete a policy by ID.
+
+    Its rules and associations are deleted by the database (ON DELETE
+    CASCADE). Policies of more than JOB_POLICY_RULES rules are deleted in
+    bounded batches by a background job, answered with 202 Accepted.
     Args:
         policy_id (int): The ID of the policy to delete.
     Returns:
         tuple: A tuple containing the HTTP status code.
     """
     policy = Policy.query.get_or_404(policy_id)
+    if count_rules(db.session, policy_id) > current_app.config['JOB_POLICY_RULES']:
+        job = submit_job('delete_policy', {'policy_id': policy_id})
+        return jsonify(job_dict(job)), 202, {'Location': url_for('jobs.get_job', job_id=job.id)}
     db.session.delete(policy)
 
     if not safe_commit(db.session):
         return jsonify({'error': 'Failed to delete policy'}), 500
 
     return "", 204
+
+@job_handler('delete_policy')
+def _delete_policy_job(job, params: dict) -> dict:
+    """Delete a large policy in batches, reporting the deleted rules on the job."""
+    def progress(deleted: int, total: int):
+        job.progress = {'rules_deleted': deleted, 'rules_total': total}
+
+    return delete_policy_in_batches(db.session, params['policy_id'],
+                                    batch_size=current_app.config['DELETE_BATCH_SIZE'],
+                                    pause=current_app.config['DELETE_BATCH_PAUSE_MS'] / 1000,
+                                    progress=progress)
+
+@swag_from('/app/swagger/policy/optimize.yaml', methods=['post'])
+@bp.route('/<int:policy_id>/optimize', methods=['POST'])
+def optimize_policy(policy_id: int) -> tuple:
+    """Compact the rules of a policy into a smaller equivalent set.
+
+    With dry_run=true (the default) the proposed rules are only returned;
+    otherwise the removed rules are deleted and the merged ones inserted in a
+    single transaction.
+    Args:
+        policy_id (int): The ID of the policy to optimize.
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    dry_run = request.args.get('dry_run', default='true', type=str).lower()
+    if dry_run not in ('true', 'false'):
+        return jsonify({'error': "Invalid dry_run. Valid values are: ['true', 'false']"}), 400
+    dry_run = dry_run == 'true'
+
+    Policy.query.get_or_404(policy_id)
+    shards = rule_shards()
+    serializer = serializer_for(Rule)
+    rules = serializer.rows(db.session.execute(
+        serializer.select().where(Rule.policy_id == policy_id)
+        .order_by(Rule.position, Rule.id),
+        bind_arguments=shards.bind_arguments(shards.placement(db.session, policy_id))))
+    plan = compact_rules(rules)
+
+    if not dry_run and plan['removed']:
+        connection = shards.writer(db.session, policy_id)
+        for ids in chunked(plan['removed'], 500):
+            connection.execute(delete(Rule).where(Rule.id.in_(ids)))
+        bump_versions(db.session, policy_ids=[policy_id])
+        record_changes(db.session, [rule_entry('delete', rule_id, policy_id)
+                                    for rule_id in plan['removed']])
+        added = [Rule(action=ActionEnum(rule['action']),
+                      protocol=ProtocolEnum(rule['protocol']),
+                      source_ip=rule['source_ip'],
+                      destination_ip=rule['destination_ip'],
+                      port=rule['port'],
+                      port_end=rule['port_end'],
+                      policy_id=policy_id) for rule in plan['added']]
+        db.session.add_all(added)
+        if not safe_commit(db.session):
+            logger.error(f"Failed to optimize policy {policy_id}")
+            return jsonify({'error': 'Failed to optimize policy'}), 500
+        ruleset_cache.invalidate(policy_ids=[policy_id])
+        for entry, rule in zip(plan['added'], added):
+            entry['id'] = rule.id
+        logger.info(f"Optimized policy {policy_id}: {len(rules)} -> "
+                    f"{len(plan['kept']) + len(plan['added'])} rules")
+
+    return jsonify({
+        'policy_id': policy_id,
+        'dry_run': dry_run,
+        'before': len(rules),
+        'after': len(plan['kept']) + len(plan['added']),
+        'removed': plan['removed'],
+        'rules': plan['kept'] + plan['added']
+    }), 200
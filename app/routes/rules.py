@@ -1,11 +1,26 @@
 "This file contains the routes for managing firewall rules in a Flask application"
-from flask import Blueprint, request, jsonify
+import logging
+from flask import abort, Blueprint, current_app, request, jsonify
 from flasgger.utils import swag_from
 from pydantic import ValidationError
+from sqlalchemy import and_, insert, or_
+from sqlalchemy.exc import SQLAlchemyError
 from app.extensions import db
 from app.models import ActionEnum, ProtocolEnum, Rule, Policy
-from app.utils.common import safe_commit
-from app.utils.schema import RuleCheck
+from app.shards import rule_shards
+from app.utils.bulk import validate_rule_rows
+from app.utils.changes import record_changes, rule_entry, rule_payload
+from app.utils.common import (address_range, format_prefix, pagination_args,
+                              pagination_envelope, safe_commit)
+from app.utils.ordering import RULE_ORDER, schedule_rebalance
+from app.utils.ruleset import ruleset_cache
+from app.utils.schema import OrderCheck, RuleCheck
+from app.utils.serializers import serializer_for
+from app.utils.streams import chunked, iter_records, stream_format
+from app.utils.versions import bump_versions
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 bp = Blueprint('rules', __name__, url_prefix='/rules')
 
@@ -18,15 +33,64 @@ def list_rules(policy_id: int) -> tuple:
     Returns:
         tuple: A tuple containing the JSON response and the HTTP status code.
     """
-    rules = Rule.query.filter_by(policy_id=policy_id).all()
-    return jsonify([
-        r.to_dict() for r in rules
-    ])
+    serializer = serializer_for(Rule)
+    shards = rule_shards()
+    rows = db.session.execute(serializer.select()
+                              .where(Rule.policy_id == policy_id)
+                              .order_by(Rule.position, Rule.id),
+                              bind_arguments=shards.bind_arguments(
+                                  shards.placement(db.session, policy_id)))
+    return jsonify(serializer.rows(rows))
+
+@swag_from('/app/swagger/rule/search.yaml', methods=['get'])
+@bp.route('/search', methods=['GET'])
+def search_rules() -> tuple:
+    """Search the rules covering an address, a prefix or a port.
+
+    Containment is answered with range predicates on the indexed normalized
+    address columns instead of parsing every rule. Sharded rules are searched
+    in every shard and merged by ID.
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    filters = []
+    try:
+        for param, prefix in (('src', 'src'), ('dst', 'dst')):
+            value = request.args.get(param, default=None, type=str)
+            if value:
+                version, start, end = address_range(value)
+                filters += [getattr(Rule, f'{prefix}_version') == version,
+                            getattr(Rule, f'{prefix}_start') <= start,
+                            getattr(Rule, f'{prefix}_end') >= end]
+        port = request.args.get('port', default=None)
+        if port is not None:
+            port = int(port)
+            # A rule without port matches any port only if its protocol carries ports
+            filters.append(or_(and_(Rule.port.is_(None),
+                                    Rule.protocol.in_((ProtocolEnum.TCP, ProtocolEnum.UDP,
+                                                       ProtocolEnum.ALL))),
+                               and_(Rule.port_end.is_(None), Rule.port == port),
+                               and_(Rule.port <= port, Rule.port_end >= port)))
+        pagination = pagination_args(default_per_page=25)
+    except ValueError as e:
+        logger.error(f"Invalid search parameters: {e}")
+        return jsonify({'error': str(e)}), 400
+
+    paginated = rule_shards().paginate(db.session, filters=filters, **pagination)
+    results = []
+    for rule in paginated.items:
+        entry = rule.to_dict()
+        entry['policy_id'] = rule.policy_id
+        results.append(entry)
+    return jsonify(pagination_envelope(paginated, results, **pagination)), 200
 
 @swag_from('/app/swagger/rule/post.yaml', methods=['post'])
 @bp.route('/policy/<int:policy_id>', methods=['POST'])
 def create_rule(policy_id: int) -> tuple:
     """Create a new rule for a specific policy.
+
+    The rule goes last, or right before or after the rule named by the
+    ``before`` or ``after`` field.
     Args:
         policy_id (int): The ID of the policy to which the rule will be added.
     Returns:
@@ -37,16 +101,29 @@ def create_rule(policy_id: int) -> tuple:
 
     try:
         dto = RuleCheck.model_validate(data)
+        order = OrderCheck.model_validate(data)
 
     except ValidationError as e:
         return jsonify({'error': str(e)}), 400
 
+    position, cramped = None, False
+    if order.before is not None or order.after is not None:
+        try:
+            position, cramped = RULE_ORDER.place(db.session, policy.id, before=order.before,
+                                                 after=order.after)
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 400
+
     rule = Rule(
         action=ActionEnum(dto.action.value),
         protocol=ProtocolEnum(dto.protocol.value),
-        source_ip=str(dto.source_ip),
-        destination_ip=str(dto.destination_ip),
+        source_ip=format_prefix(dto.source_ip),
+        destination_ip=format_prefix(dto.destination_ip),
         port=dto.port,
+        port_end=dto.port_end,
+        # Appended by the flush when None
+        position=position,
         policy=policy
     )
     db.session.add(rule)
@@ -54,7 +131,116 @@ def create_rule(policy_id: int) -> tuple:
     if not safe_commit(db.session):
         return jsonify({'error': 'Failed to create rule'}), 500
 
-    return jsonify(rule.to_dict()), 201
+    result = rule.to_dict()
+    if cramped:
+        schedule_rebalance(RULE_ORDER, policy_id)
+    return jsonify(result), 201
+
+@swag_from('/app/swagger/rule/move.yaml', methods=['post'])
+@bp.route('/<int:rule_id>/move', methods=['POST'])
+def move_rule(rule_id: int) -> tuple:
+    """Move a rule right before or after another rule of its policy.
+
+    Only the moved rule is written: its key is set halfway between the keys
+    of its new neighbours.
+    Args:
+        rule_id (int): The ID of the rule to move.
+    Returns:
+        tuple: A tuple containing the JSON response and the HTTP status code.
+    """
+    rule = rule_shards().find_rule(db.session, rule_id)
+    if rule is None:
+        abort(404)
+    try:
+        order = OrderCheck.model_validate(request.json)
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), 400
+    if order.before is None and order.after is None:
+        return jsonify({'error': 'Give either before or after'}), 400
+
+    try:
+        rule.position, cramped = RULE_ORDER.place(db.session, rule.policy_id, rule.id,
+                                                  before=order.before, after=order.after)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    if not safe_commit(db.session):
+        return jsonify({'error': 'Failed to move rule'}), 500
+
+    result = rule.to_dict()
+    if cramped:
+        schedule_rebalance(RULE_ORDER, rule.policy_id)
+    return jsonify(result), 200
+
+@swag_from('/app/swagger/rule/bulk.yaml', methods=['post'])
+@bp.route('/policy/<int:policy_id>/bulk', methods=['POST'])
+def import_rules(policy_id: int) -> tuple:
+    """Import a stream of rules into a specific policy.
+
+    The NDJSON or CSV body is read in chunks of BULK_CHUNK_SIZE rows; each chunk
+    is validated at once and inserted in its own transaction, so invalid rows
+    and failed chunks do not abort the others.
+    Args:
+        policy_id (int): The ID of the policy to which the rules will be added.
+    Returns:
+        tuple: A tuple containing the JSON report and the HTTP status code.
+    """
+    policy = Policy.query.get_or_404(policy_id)
+    try:
+        fmt = stream_format(request)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    shards = rule_shards()
+    chunk_size = current_app.config['BULK_CHUNK_SIZE']
+    max_errors = current_app.config['BULK_MAX_ERRORS']
+    inserted = failed = unwritten = 0
+    errors = []
+    first_row = 1
+    for chunk in chunked(iter_records(request.stream, fmt), chunk_size):
+        rows, chunk_errors = validate_rule_rows(policy.id, chunk, first_row=first_row)
+        first_row += len(chunk)
+        if rows:
+            try:
+                connection = shards.writer(db.session, policy.id)
+                keys = RULE_ORDER.append_keys(connection, policy.id, len(rows))
+                for (_, row), key in zip(rows, keys):
+                    row['position'] = key
+                if shards.enabled:
+                    for (_, row), rule_id in zip(rows, shards.allocate_ids(db.session, len(rows))):
+                        row['id'] = rule_id
+                rule_ids = connection.execute(
+                    insert(Rule).returning(Rule.id, sort_by_parameter_order=True),
+                    [row for _, row in rows]).scalars().all()
+                bump_versions(db.session, policy_ids=[policy.id])
+                record_changes(db.session, [rule_entry('create', rule_id, policy.id,
+                                                       rule_payload(rule_id, row))
+                                            for rule_id, (_, row) in zip(rule_ids, rows)])
+                db.session.commit()
+            except SQLAlchemyError as e:
+                # The chunk is reported and the next ones still run
+                db.session.rollback()
+                logger.error(f"Failed to insert rows {rows[0][0]}-{rows[-1][0]}: {e}")
+                unwritten += len(rows)
+                chunk_errors += [{'row': row, 'error': 'Failed to insert rule'}
+                                 for row, _ in rows]
+            else:
+                inserted += len(rows)
+                ruleset_cache.invalidate(policy_ids=[policy.id])
+        failed += len(chunk_errors)
+        errors.extend(chunk_errors[:max_errors - len(errors)])
+
+    logger.info(f"Imported {inserted} rules into policy {policy_id}, {failed} failed")
+    status = 201
+    if failed and not inserted:
+        # Nothing written: the client's rows are at fault unless the database refused them all
+        status = 500 if unwritten == failed else 400
+    return jsonify({
+        'inserted': inserted,
+        'failed': failed,
+        'errors': errors,
+        'errors_truncated': failed > len(errors)
+    }), status
 
 @swag_from('/app/swagger/rule/delete.yaml', methods=['delete'])
 @bp.route('/<int:rule_id>', methods=['DELETE'])
@@ -65,7 +251,9 @@ def delete_rule(rule_id: int) -> tuple:
     Returns:
         tuple: A tuple containing the HTTP status code.
     """
-    rule = Rule.query.get_or_404(rule_id)
+    rule = rule_shards().find_rule(db.session, rule_id)
+    if rule is None:
+        abort(404)
     db.session.delete(rule)
     if not safe_commit(db.session):
         return jsonify({'error': 'Failed to delete rule'}), 500
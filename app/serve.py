@@ -0,0 +1,120 @@
+"""Production entry point: a pre-fork gunicorn server sharing one preloaded application.
+
+The application is created and its caches warmed once in the master process,
+then forked into the workers, which share the warmed memory copy-on-write.
+
+Usage:
+    python -m app.serve [--bind 0.0.0.0:5000] [--workers 4]
+
+Signals sent to the master:
+    HUP         rolling restart: caches are warmed again, new workers are
+                forked, then the old ones finish their requests and exit
+    TTIN/TTOU   add or remove one worker
+    TERM        graceful shutdown
+"""
+import argparse
+import logging
+import multiprocessing
+from gunicorn.app.base import BaseApplication
+from sqlalchemy import select
+from app import create_app
+from app.database import app_engines
+from app.extensions import db
+from app.models import Firewall
+from app.utils.ruleset import ruleset_cache
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def default_workers() -> int:
+    """Return the usual worker count: 2 x CPUs + 1."""
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def warm_caches(app) -> int:
+    """Compile the ruleset and the rule columns of every firewall.
+
+    NumPy is imported here, in the master, only when there are rulesets to
+    warm; the workers inherit it instead of importing it on their first batch.
+    Pooled connections are closed afterwards, so that no database connection
+    is shared with the forked workers.
+
+    Args:
+        app (Flask): The Flask application.
+
+    Returns:
+        int: The number of warmed firewalls.
+    """
+    with app.app_context():
+        firewall_ids = db.session.execute(select(Firewall.id)).scalars().all()
+        if firewall_ids:
+            from app.utils.batch import rule_arrays
+        for firewall_id in firewall_ids:
+            compiled = ruleset_cache.get(firewall_id)
+            if compiled is not None:
+                rule_arrays(compiled)
+        db.session.remove()
+    for engine in app_engines(app, db):
+        engine.dispose()
+    logger.info(f"Warmed the rulesets of {len(firewall_ids)} firewalls")
+    return len(firewall_ids)
+
+
+class PreforkServer(BaseApplication):
+    """Gunicorn application serving a Flask application created before forking."""
+
+    def __init__(self, app, options: dict):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('preload_app', True)
+        self.cfg.set('on_reload', self._on_reload)
+        self.cfg.set('post_fork', self._post_fork)
+
+    def load(self):
+        return self.application
+
+    def _on_reload(self, server):
+        # Workers forked by the rolling restart start from fresh caches
+        warm_caches(self.application)
+
+    def _post_fork(self, server, worker):
+        # Never reuse a connection opened by the master
+        for engine in app_engines(self.application, db):
+            engine.dispose(close=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bind', default=None, help='Address to listen on (SERVE_BIND).')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (SERVE_WORKERS, 0 for 2 x CPUs + 1).')
+    args = parser.parse_args()
+
+    app = create_app()
+    config = app.config
+    workers = args.workers or config['SERVE_WORKERS'] or default_workers()
+    if config['RATE_LIMIT_PER_SECOND'] > 0 and workers > 1:
+        logger.warning(f"Rate limits hold per worker: up to {workers} x "
+                       f"{config['RATE_LIMIT_PER_SECOND']} requests per second per client")
+    warm_caches(app)
+    PreforkServer(app, {
+        'bind': args.bind or config['SERVE_BIND'],
+        'workers': workers,
+        'worker_class': config['SERVE_WORKER_CLASS'],
+        'threads': config['SERVE_THREADS'],
+        'timeout': config['SERVE_TIMEOUT'],
+        'graceful_timeout': config['SERVE_GRACEFUL_TIMEOUT'],
+        'max_requests': config['SERVE_MAX_REQUESTS'],
+        'max_requests_jitter': config['SERVE_MAX_REQUESTS_JITTER'],
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+"This file contains the horizontal sharding of the rules across databases, keyed by policy"
+import hashlib
+import heapq
+import logging
+from flask import current_app
+from sqlalchemy import (Column, Index, MetaData, Table, create_engine, delete, event, func,
+                        insert, inspect, select, update)
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from app.database import SHARDS_KEY, engine_options, install_sqlite_pragmas
+from app.extensions import db
+from app.models import Policy, Rule, RuleSequence
+from app.utils.common import (ESTIMATE_COUNT_CAP, CursorPage, capped_page_size, encode_cursor,
+                              paginate_query)
+from app.utils.streams import chunked
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Name of the application database, holding the rules of the policies placed on no shard
+MAIN_SHARD = 'main'
+
+# Policy IDs looked up per statement when grouping them by shard
+PLACEMENTS_PER_STATEMENT = 500
+
+
+def parse_shards(value: str) -> dict:
+    """Parse the RULE_SHARDS setting.
+
+    Args:
+        value (str): Comma-separated name=URL pairs, e.g. "a=sqlite:///rules-a.db".
+
+    Returns:
+        dict: The database URL of each shard, by name.
+
+    Raises:
+        ValueError: If a pair is malformed or a name is repeated or reserved.
+    """
+    urls = {}
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        name, separator, url = (part.strip() for part in pair.partition('='))
+        if not separator or not name or not url:
+            raise ValueError(f"Invalid rule shard '{pair.strip()}', expected name=URL")
+        if name == MAIN_SHARD or name in urls:
+            raise ValueError(f"Duplicate or reserved rule shard name '{name}'")
+        urls[name] = url
+    return urls
+
+
+def _shard_rule_table(metadata: MetaData) -> Table:
+    """Copy the rule table for the shards, without its foreign key: policies are not there."""
+    source = Rule.__table__
+    table = Table(source.name, metadata, *(
+        Column(column.name, column.type, primary_key=column.primary_key,
+               nullable=column.nullable, autoincrement=False,
+               server_default=column.server_default.arg if column.server_default else None)
+        for column in source.columns))
+    for index in source.indexes:
+        Index(index.name, *(table.c[column.name] for column in index.columns),
+              unique=index.unique)
+    return table
+
+
+# Tables of a shard database, created by ``RuleShards.create_all``
+shard_metadata = MetaData()
+_shard_rule_table(shard_metadata)
+
+
+def lock_placement(connection, policy_id: int):
+    """Lock the placement of a policy until the end of the transaction.
+
+    An UPDATE locks the policy row on PostgreSQL and the whole database on
+    SQLite, so the rules of the policy cannot move in between.
+
+    Args:
+        connection (Connection): A connection to the main database.
+        policy_id (int): The ID of the policy.
+
+    Returns:
+        str: The shard holding the rules of the policy, None if it does not exist.
+    """
+    found = connection.execute(update(Policy).where(Policy.id == policy_id)
+                               .values(shard=Policy.shard)).rowcount
+    if not found:
+        return None
+    shard = connection.execute(select(Policy.shard).where(Policy.id == policy_id)).scalar()
+    return shard or MAIN_SHARD
+
+
+class ScatterPage:
+    """A page of results gathered from every shard, read like a Flask-SQLAlchemy Pagination."""
+
+    def __init__(self, items, page, per_page, total=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+
+    @property
+    def pages(self) -> int:
+        """The number of pages, 0 when the total is unknown."""
+        if not self.total:
+            return 0
+        return -(-self.total // self.per_page)
+
+
+class RuleShards:
+    """Router of the rules to the database of their policy.
+
+    The rules of a policy live in a single shard, named on the policy; the
+    rules of policies placed on no shard stay in the main database. Rule
+    statements run on the connection of their shard within the session
+    transaction and are committed with it, database by database: a commit
+    spanning several shards is not atomic. Reads spanning several policies
+    scatter to every shard and gather the results.
+
+    Without shards, every method answers with the main database at no cost.
+    """
+
+    def __init__(self, engines: dict):
+        self.engines = engines
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the rules are spread over shards."""
+        return bool(self.engines)
+
+    def names(self) -> list:
+        """Return the names of the databases holding rules, the main one first."""
+        return [MAIN_SHARD, *self.engines]
+
+    def engine(self, name: str):
+        """Return the engine of a shard, the default engine for the main database."""
+        if name == MAIN_SHARD:
+            return db.engine
+        self.bind_arguments(name)
+        return self.engines[name]
+
+    def bind_arguments(self, name: str) -> dict:
+        """Return the bind arguments of the statements of a shard.
+
+        The main database keeps the routing of the session, reads of GET
+        requests included.
+
+        Raises:
+            ValueError: If the shard is unknown.
+        """
+        if name == MAIN_SHARD:
+            return {}
+        if name not in self.engines:
+            raise ValueError(f"Unknown rule shard '{name}'. Valid values are: {self.names()}")
+        return {'bind': self.engines[name]}
+
+    def connection(self, session, name: str):
+        """Return the connection of a shard in the session transaction."""
+        return session.connection(bind_arguments=self.bind_arguments(name))
+
+    def pick(self, policy_name: str) -> str:
+        """Choose the shard of a new policy, spreading the policies by a hash of their name."""
+        names = list(self.engines)
+        digest = hashlib.blake2b(policy_name.encode(), digest_size=8).digest()
+        return names[int.from_bytes(digest, 'big') % len(names)]
+
+    def placement(self, session, policy_id: int) -> str:
+        """Return the shard holding the rules of a policy, for reading them."""
+        if not self.enabled:
+            return MAIN_SHARD
+        shard = session.execute(select(Policy.shard).where(Policy.id == policy_id)).scalar()
+        return shard or MAIN_SHARD
+
+    def placements(self, session, policy_ids) -> dict:
+        """Group policy IDs by the shard holding their rules.
+
+        Returns:
+            dict: The policy IDs of each shard, by shard name.
+        """
+        policy_ids = list(policy_ids)
+        if not self.enabled:
+            return {MAIN_SHARD: policy_ids} if policy_ids else {}
+        groups = {}
+        for chunk in chunked(policy_ids, PLACEMENTS_PER_STATEMENT):
+            for policy_id, shard in session.execute(
+                    select(Policy.id, Policy.shard).where(Policy.id.in_(chunk))):
+                groups.setdefault(shard or MAIN_SHARD, []).append(policy_id)
+        return groups
+
+    def lock(self, session, policy_id: int) -> str:
+        """Return the shard holding the rules of a policy, for writing them.
+
+        The placement is locked until the commit (see ``lock_placement``),
+        once per transaction.
+        """
+        if not self.enabled:
+            return MAIN_SHARD
+        locked = session.info.setdefault('locked_placements', {})
+        if policy_id not in locked:
+            locked[policy_id] = lock_placement(session.connection(), policy_id) or MAIN_SHARD
+        return locked[policy_id]
+
+    def writer(self, session, policy_id: int):
+        """Return the connection writing the rules of a policy, see ``lock``."""
+        return self.connection(session, self.lock(session, policy_id))
+
+    def flush_connection(self, session, mapper, instance):
+        """Return the connection flushing an entity: the shard of its policy for a rule."""
+        if mapper.class_ is Rule:
+            policy_id = instance.policy_id if instance.policy_id is not None else instance.policy.id
+            return self.writer(session, policy_id)
+        return session.connection(bind_arguments={'mapper': mapper})
+
+    def allocate_ids(self, session, count: int) -> list:
+        """Allocate rule IDs unique across the shards, in the session transaction.
+
+        The sequence row of the main database is created by the first
+        allocation, after the highest ID of every shard.
+
+        Args:
+            session (Session): The session holding the transaction.
+            count (int): The number of IDs.
+
+        Returns:
+            list: The IDs, increasing.
+        """
+        connection = session.connection()
+        allocated = connection.execute(update(RuleSequence).where(RuleSequence.id == 1)
+                                       .values(next_id=RuleSequence.next_id + count)).rowcount
+        if allocated:
+            end = connection.execute(select(RuleSequence.next_id)
+                                     .where(RuleSequence.id == 1)).scalar()
+            return list(range(end - count, end))
+        start = max(session.execute(select(func.max(Rule.id)),
+                                    bind_arguments=self.bind_arguments(name)).scalar() or 0
+                    for name in self.names()) + 1
+        connection.execute(insert(RuleSequence).values(id=1, next_id=start + count))
+        return list(range(start, start + count))
+
+    def locate(self, session, rule_id: int):
+        """Return the shard holding a rule, looked up in every shard.
+
+        A policy being moved has copies of its rules in two shards, the one
+        its placement names is returned.
+
+        Returns:
+            str: The name of the shard, None if the rule does not exist.
+        """
+        if not self.enabled:
+            return MAIN_SHARD
+        for name in self.names():
+            policy_id = session.execute(select(Rule.policy_id).where(Rule.id == rule_id),
+                                        bind_arguments=self.bind_arguments(name)).scalar()
+            if policy_id is not None:
+                return self.placement(session, policy_id)
+        return None
+
+    def find_rule(self, session, rule_id: int):
+        """Return a rule by ID, read from its shard (see ``locate``); None if it does not exist."""
+        name = self.locate(session, rule_id)
+        if name is None:
+            return None
+        return session.get(Rule, rule_id, bind_arguments=self.bind_arguments(name))
+
+    def _count(self, session, filters: list, count: str):
+        if count == 'none':
+            return None
+        counted = select(func.count()).select_from(Rule).where(*filters)
+        if count == 'exact':
+            return sum(session.execute(counted, bind_arguments=self.bind_arguments(name)).scalar()
+                       for name in self.names())
+        # IDs are allocated across the shards, the highest one approximates the total
+        highest = max(session.execute(select(func.max(Rule.id)),
+                                      bind_arguments=self.bind_arguments(name)).scalar() or 0
+                      for name in self.names())
+        if not filters:
+            return highest
+        capped = select(func.count()).select_from(
+            select(Rule.id).where(*filters).limit(ESTIMATE_COUNT_CAP).subquery())
+        totals = [session.execute(capped, bind_arguments=self.bind_arguments(name)).scalar()
+                  for name in self.names()]
+        if max(totals) < ESTIMATE_COUNT_CAP:
+            return sum(totals)
+        return max(sum(totals), highest)
+
+    def paginate(self, session, filters=None, page=1, per_page=10, after=None, limit=None,
+                 count='exact', options=None):
+        """Paginate the rules of every shard, see ``paginate_query``.
+
+        Each shard returns its first rows by ID, merged into the page: deep
+        pages read ``page * per_page`` rows per shard, cursors only one page.
+
+        Returns:
+            obj: A ScatterPage, a CursorPage in cursor mode.
+        """
+        filters = list(filters or ())
+        if not self.enabled:
+            return paginate_query(Rule, filters=filters, page=page, per_page=per_page,
+                                  after=after, limit=limit, count=count, options=options)
+        statement = select(Rule).where(*filters)
+        if options:
+            statement = statement.options(*options)
+        if limit is None:
+            page, per_page = max(page, 1), capped_page_size(max(per_page, 1))
+            wanted = page * per_page
+        else:
+            limit = capped_page_size(limit)
+            wanted = limit + 1
+            if after is not None:
+                statement = statement.where(Rule.id > after)
+        statement = statement.order_by(Rule.id).limit(wanted)
+        gathered = [session.scalars(statement, bind_arguments=self.bind_arguments(name)).all()
+                    for name in self.names()]
+        items, seen = [], set()
+        for rule in heapq.merge(*gathered, key=lambda rule: rule.id):
+            # The rules of a policy being moved are in two shards for a while
+            if rule.id not in seen:
+                seen.add(rule.id)
+                items.append(rule)
+        total = self._count(session, filters, count)
+
+        if limit is None:
+            return ScatterPage(items[wanted - per_page:wanted], page, per_page, total=total)
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = encode_cursor(items[-1].id)
+        return CursorPage(items, limit, next_cursor=next_cursor, total=total)
+
+    def create_all(self):
+        """Create the missing tables of every shard."""
+        for engine in self.engines.values():
+            shard_metadata.create_all(engine)
+
+
+def init_shards(app) -> RuleShards:
+    """Create the engines of the rule shards listed in RULE_SHARDS.
+
+    Shards get the engine profile of their URL, SQLite pragmas included.
+
+    Args:
+        app (Flask): The Flask application.
+
+    Returns:
+        RuleShards: The router, also stored in ``app.extensions``.
+    """
+    engines = {}
+    for name, url in parse_shards(app.config['RULE_SHARDS']).items():
+        engine = create_engine(url, **engine_options(app.config, url))
+        if engine.dialect.name == 'sqlite':
+            install_sqlite_pragmas(engine, app.config)
+        engines[name] = engine
+    shards = RuleShards(engines)
+    app.extensions[SHARDS_KEY] = shards
+    if engines:
+        logger.info(f"Sharding the rules across {', '.join(engines)}")
+    return shards
+
+
+def rule_shards() -> RuleShards:
+    """Return the rule shards of the current application."""
+    return current_app.extensions[SHARDS_KEY]
+
+
+@event.listens_for(db.session, 'before_flush')
+def _route_rules(session, flush_context, instances):
+    """Place the new policies, number the new rules and delete the rules of deleted policies.
+
+    The main database deletes the rules of its policies itself (ON DELETE
+    CASCADE), the shards have no foreign key to do so.
+    """
+    shards = current_app.extensions.get(SHARDS_KEY)
+    if shards is None or not shards.enabled:
+        return
+    new_rules = []
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Policy) and obj.shard is None:
+                obj.shard = shards.pick(obj.name)
+            elif isinstance(obj, Rule) and obj.id is None:
+                new_rules.append(obj)
+        for rule, rule_id in zip(new_rules, shards.allocate_ids(session, len(new_rules))
+                                 if new_rules else ()):
+            rule.id = rule_id
+        for obj in session.deleted:
+            if isinstance(obj, Policy):
+                shard = shards.lock(session, obj.id)
+                if shard != MAIN_SHARD:
+                    shards.connection(session, shard).execute(
+                        delete(Rule).where(Rule.policy_id == obj.id))
+
+
+def _bound_rule_id(orm_context):
+    """Return the rule ID a load by primary key is bound to, None if it is not one.
+
+    The ORM loads an entity with ``WHERE rule.id = :pk`` and passes the ID as
+    a parameter of the execution.
+    """
+    whereclause = orm_context.statement.whereclause
+    if whereclause is None:
+        return None
+    column = Rule.__table__.c.id
+    for element in visitors.iterate(whereclause):
+        if (isinstance(element, BinaryExpression) and isinstance(element.right, BindParameter)
+                and element.left.shares_lineage(column)):
+            return orm_context.parameters.get(element.right.key, element.right.value)
+    return None
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _refresh_rules(orm_context):
+    """Load the expired attributes of a rule from its shard, the ORM only knows its ID."""
+    if not orm_context.is_column_load or orm_context.bind_mapper is not inspect(Rule):
+        return None
+    shards = current_app.extensions.get(SHARDS_KEY)
+    if shards is None or not shards.enabled or 'bind' in orm_context.bind_arguments:
+        return None
+    rule_id = _bound_rule_id(orm_context)
+    if rule_id is None:
+        return None
+    name = shards.locate(orm_context.session, rule_id)
+    if name is None:
+        return None
+    return orm_context.invoke_statement(bind_arguments={**orm_context.bind_arguments,
+                                                        **shards.bind_arguments(name)})
+
+
+@event.listens_for(db.session, 'after_commit')
+def _release_placements(session):
+    """Forget the placements locked by the committed transaction."""
+    session.info.pop('locked_placements', None)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_placements(session):
+    """Forget the placements locked by a rolled back transaction."""
+    session.info.pop('locked_placements', None)
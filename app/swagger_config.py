@@ -54,9 +54,29 @@ template_swagger = {
                     "source_ip": {"type": "string"},
                     "destination_ip": {"type": "string"},
                     "protocol": {"type": "string"},
+                    "port": {"type": "integer"},
+                    "port_end": {"type": "integer"},
+                    "position": {"type": "number",
+                                 "description": "Ordering key of the rule in its policy"}
+                }
+            },
+            "FlowInput": {
+                "type": "object",
+                "properties": {
+                    "protocol": {"type": "string"},
+                    "source_ip": {"type": "string"},
+                    "destination_ip": {"type": "string"},
                     "port": {"type": "integer"}
                 }
             },
+            "Verdict": {
+                "type": "object",
+                "properties": {
+                    "action": {"type": "string"},
+                    "matched": {"type": "boolean"},
+                    "rule": {"$ref": "#/definitions/Rule"}
+                }
+            },
             "RuleInput": {
                 "type": "object",
                 "properties": {
@@ -64,7 +84,69 @@ template_swagger = {
                     "source_ip": {"type": "string"},
                     "destination_ip": {"type": "string"},
                     "protocol": {"type": "string"},
-                    "port": {"type": "integer"}
+                    "port": {"type": "integer"},
+                    "port_end": {"type": "integer"},
+                    "before": {"type": "integer", "description": "Insert right before this rule"},
+                    "after": {"type": "integer", "description": "Insert right after this rule"}
+                }
+            },
+            "OrderInput": {
+                "type": "object",
+                "description": "The neighbour, in the same policy or firewall",
+                "properties": {
+                    "before": {"type": "integer"},
+                    "after": {"type": "integer"}
+                }
+            },
+            "PairSet": {
+                "type": "object",
+                "description": "Explicit pairs, or the cartesian product of firewall_ids and policy_ids",
+                "properties": {
+                    "pairs": {
+                        "type": "array",
+                        "items": {"type": "array", "items": {"type": "integer"},
+                                  "minItems": 2, "maxItems": 2}
+                    },
+                    "firewall_ids": {"type": "array", "items": {"type": "integer"}},
+                    "policy_ids": {"type": "array", "items": {"type": "integer"}}
+                }
+            },
+            "Snapshot": {
+                "type": "object",
+                "properties": {
+                    "id":               {"type": "integer"},
+                    "firewall_id":      {"type": "integer"},
+                    "firewall_version": {"type": "integer"},
+                    "digest":           {"type": "string", "description": "BLAKE2b digest of the ruleset, hex"},
+                    "rule_count":       {"type": "integer"},
+                    "created_at":       {"type": "string"},
+                    "deduplicated":     {"type": "boolean", "description": "Creation only"}
+                }
+            },
+            "SnapshotRule": {
+                "type": "object",
+                "properties": {
+                    "policy_id":      {"type": "integer"},
+                    "action":         {"type": "string"},
+                    "protocol":       {"type": "string"},
+                    "source_ip":      {"type": "string"},
+                    "destination_ip": {"type": "string"},
+                    "port":           {"type": "integer"},
+                    "port_end":       {"type": "integer"}
+                }
+            },
+            "Job": {
+                "type": "object",
+                "properties": {
+                    "id":          {"type": "integer"},
+                    "kind":        {"type": "string", "enum": ["delete_policy", "bulk_associate"]},
+                    "status":      {"type": "string", "enum": ["pending", "running", "succeeded", "failed"]},
+                    "progress":    {"type": "object"},
+                    "result":      {"type": "object"},
+                    "error":       {"type": "string"},
+                    "created_at":  {"type": "string"},
+                    "started_at":  {"type": "string"},
+                    "finished_at": {"type": "string"}
                 }
             }
         }
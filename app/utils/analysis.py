@@ -0,0 +1,266 @@
+"This file contains the shadowed, redundant and conflicting rule analyzer"
+from bisect import bisect_left, bisect_right
+from app.utils.common import gc_paused
+from app.utils.ruleset import parse_prefix
+from app.utils.schema import ProtocolEnum
+
+ALL_PROTOCOLS = ProtocolEnum.ALL.value
+ANY_PORT = (0, 65535)
+
+
+def port_range(rule: dict) -> tuple:
+    """Return the inclusive port interval matched by a rule.
+
+    Args:
+        rule (dict): The rule, as returned by ``Rule.to_dict``.
+
+    Returns:
+        tuple: The first and last port.
+    """
+    if rule['port'] is None:
+        return ANY_PORT
+    if rule.get('port_end') is None:
+        return rule['port'], rule['port']
+    return rule['port'], rule['port_end']
+
+
+class _Prefix:
+    """An address prefix with its inclusive integer interval."""
+    __slots__ = ('version', 'start', 'end', 'length', 'bits', 'key')
+
+    def __init__(self, value: str):
+        self.version, self.start, self.length, self.bits = parse_prefix(value)
+        self.end = self.start | ((1 << (self.bits - self.length)) - 1)
+        self.key = (self.version, self.start, self.length)
+
+    def contains(self, other: '_Prefix') -> bool:
+        return (self.version == other.version
+                and self.start <= other.start and self.end >= other.end)
+
+    def supernet_key(self, length: int) -> tuple:
+        mask = ~((1 << (self.bits - length)) - 1)
+        return self.version, self.start & mask, length
+
+
+class _Rule:
+    """A rule normalized to intervals, with its evaluation order."""
+    __slots__ = ('index', 'data', 'action', 'protocol', 'port_lo', 'port_hi', 'src', 'dst')
+
+    def __init__(self, index: int, data: dict):
+        self.index = index
+        self.data = data
+        self.action = data['action']
+        self.protocol = data['protocol']
+        self.port_lo, self.port_hi = port_range(data)
+        self.src = _Prefix(data['source_ip'])
+        self.dst = _Prefix(data['destination_ip'])
+
+    def match_key(self) -> tuple:
+        return self.protocol, self.port_lo, self.port_hi, self.src.key, self.dst.key
+
+    def covers(self, other: '_Rule') -> bool:
+        """Whether every packet matched by other is also matched by this rule."""
+        return ((self.protocol == ALL_PROTOCOLS or self.protocol == other.protocol)
+                and self.port_lo <= other.port_lo and self.port_hi >= other.port_hi
+                and self.src.contains(other.src) and self.dst.contains(other.dst))
+
+
+class _PortIndex:
+    """Rules of one cell indexed by port: single ports hashed, ranges listed."""
+    __slots__ = ('exact', 'ranges', 'ports')
+
+    def __init__(self):
+        self.exact = {}
+        self.ranges = []
+        self.ports = ()
+
+    def add(self, rule: _Rule):
+        if rule.port_lo == rule.port_hi:
+            self.exact.setdefault(rule.port_lo, []).append(rule)
+        else:
+            self.ranges.append(rule)
+
+    def freeze(self):
+        self.ports = sorted(self.exact)
+
+    def overlapping(self, lo: int, hi: int):
+        """Yield the rules whose port interval overlaps [lo, hi]."""
+        if lo == hi:
+            yield from self.exact.get(lo, ())
+        else:
+            for port in self.ports[bisect_left(self.ports, lo):bisect_right(self.ports, hi)]:
+                yield from self.exact[port]
+        for rule in self.ranges:
+            if rule.port_lo <= hi and rule.port_hi >= lo:
+                yield rule
+
+
+class _SourceGroup:
+    """Rules sharing one source prefix, indexed by destination prefix and protocol."""
+    __slots__ = ('prefix', 'parent', 'cells', 'lengths', 'keys')
+
+    def __init__(self, prefix: _Prefix):
+        self.prefix = prefix
+        self.parent = None
+        self.cells = {}
+        self.lengths = {}
+        self.keys = []
+
+    def add(self, rule: _Rule):
+        cell = self.cells.setdefault(rule.dst.key, {})
+        cell.setdefault(rule.protocol, _PortIndex()).add(rule)
+
+    def freeze(self):
+        for version, start, length in self.cells:
+            self.lengths.setdefault(version, set()).add(length)
+        self.lengths = {version: sorted(lengths) for version, lengths in self.lengths.items()}
+        # Sorted destination prefixes, subnets of a prefix form a contiguous range
+        self.keys = sorted(self.cells)
+        for cell in self.cells.values():
+            for index in cell.values():
+                index.freeze()
+
+    def cells_overlapping(self, dst: _Prefix, subnets: bool):
+        """Yield the cells whose destination prefix contains dst, then its subnets.
+
+        The cell of dst itself comes with a flag, so callers can avoid reporting
+        pairs of equal prefixes twice.
+        """
+        for length in self.lengths.get(dst.version, ()):
+            if length > dst.length:
+                break
+            cell = self.cells.get(dst.supernet_key(length))
+            if cell is not None:
+                yield cell, length == dst.length
+        if subnets:
+            low = bisect_left(self.keys, (dst.version, dst.start, dst.length + 1))
+            high = bisect_right(self.keys, (dst.version, dst.end, dst.bits + 1))
+            for key in self.keys[low:high]:
+                yield self.cells[key], False
+
+
+def _build_groups(rules: list) -> dict:
+    """Group rules by source prefix and link each group to its closest supernet.
+
+    Groups are swept in (start, longest interval first) order with a stack of
+    open intervals; CIDR prefixes never partially overlap, so the top of the
+    stack is always the closest enclosing prefix.
+    """
+    groups = {}
+    for rule in rules:
+        group = groups.get(rule.src.key)
+        if group is None:
+            group = groups[rule.src.key] = _SourceGroup(rule.src)
+        group.add(rule)
+
+    stack = []
+    for group in sorted(groups.values(), key=lambda g: (g.prefix.version, g.prefix.start,
+                                                        g.prefix.length)):
+        prefix = group.prefix
+        while stack and (stack[-1].prefix.version != prefix.version
+                         or stack[-1].prefix.end < prefix.start):
+            stack.pop()
+        group.parent = stack[-1] if stack else None
+        stack.append(group)
+        group.freeze()
+    return groups
+
+
+def _overlapping_pairs(rules: list, groups: dict):
+    """Yield every pair of rules matching common packets exactly once."""
+    for rule in rules:
+        own = groups[rule.src.key]
+        group = own
+        while group is not None:
+            ancestor = group is not own
+            for cell, same_dst in group.cells_overlapping(rule.dst, subnets=ancestor):
+                if rule.protocol == ALL_PROTOCOLS:
+                    indexes = cell.values()
+                else:
+                    indexes = [index for index in (cell.get(rule.protocol),
+                                                   cell.get(ALL_PROTOCOLS)) if index]
+                for index in indexes:
+                    for other in index.overlapping(rule.port_lo, rule.port_hi):
+                        # Pairs with equal prefixes are seen from both rules, keep one
+                        if ancestor or not same_dst or other.index < rule.index:
+                            yield rule, other
+            group = group.parent
+
+
+def find_overlaps(rules: list) -> tuple:
+    """Classify the overlapping pairs of a ruleset.
+
+    Args:
+        rules (list): The rules in evaluation order, as returned by ``Rule.to_dict``.
+
+    Returns:
+        tuple: The normalized rules, the earliest covering rule of every covered
+            rule (by index) and the conflicting pairs between rules that fire.
+    """
+    with gc_paused():
+        normalized = [_Rule(index, data) for index, data in enumerate(rules)]
+        groups = _build_groups(normalized)
+
+        covered_by = {}
+        conflicts = []
+        for rule, other in _overlapping_pairs(normalized, groups):
+            first, last = (rule, other) if rule.index < other.index else (other, rule)
+            if first.covers(last):
+                best = covered_by.get(last.index)
+                if best is None or first.index < best.index:
+                    covered_by[last.index] = first
+            elif first.action != last.action:
+                conflicts.append((first, last))
+
+    # A rule that never fires cannot conflict with anything
+    conflicts = [(first, last) for first, last in conflicts
+                 if first.index not in covered_by and last.index not in covered_by]
+    return normalized, covered_by, conflicts
+
+
+def analyze_rules(rules: list, max_conflicts: int = 1000) -> dict:
+    """Report the rules of a ruleset that never fire or contradict each other.
+
+    - shadowed: fully covered by an earlier rule with the opposite action;
+    - redundant: fully covered by an earlier rule with the same action;
+    - conflicts: partially overlapping ALLOW/DENY pairs.
+
+    Only pairs of overlapping rules are compared: source prefixes are swept in
+    sorted order, destination prefixes and ports are looked up in sorted or
+    hashed indexes, so the cost grows with n log n plus the number of overlaps.
+
+    Args:
+        rules (list): The rules in evaluation order, as returned by ``Rule.to_dict``.
+        max_conflicts (int, optional): Maximum number of conflicts listed. Defaults to 1000.
+
+    Returns:
+        dict: The shadowed, redundant and conflicting rules.
+    """
+    normalized, covered_by, conflicts = find_overlaps(rules)
+
+    shadowed, redundant = [], []
+    for index in sorted(covered_by):
+        rule, by = normalized[index], covered_by[index]
+        entry = {
+            'rule_id': rule.data['id'],
+            'policy_id': rule.data.get('policy_id'),
+            'by_rule_id': by.data['id'],
+            'by_policy_id': by.data.get('policy_id'),
+            'duplicate': rule.match_key() == by.match_key()
+        }
+        (redundant if rule.action == by.action else shadowed).append(entry)
+
+    conflicts.sort(key=lambda pair: (pair[1].index, pair[0].index))
+    return {
+        'rules': len(rules),
+        'shadowed': shadowed,
+        'redundant': redundant,
+        'conflicts': [{
+            'rule_id': last.data['id'],
+            'policy_id': last.data.get('policy_id'),
+            'with_rule_id': first.data['id'],
+            'with_policy_id': first.data.get('policy_id')
+        } for first, last in conflicts[:max_conflicts]],
+        'conflicts_total': len(conflicts),
+        'conflicts_truncated': len(conflicts) > max_conflicts
+    }
@@ -0,0 +1,170 @@
+"This file contains the set-based writes of the firewall_policy association table"
+from sqlalchemy import and_, delete, func, insert, select, true, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models import Firewall, Policy, firewall_policy
+from app.utils.ordering import ORDER_GAP, POLICY_ORDER
+from app.utils.streams import chunked
+
+# Bound parameters per statement, well under the limits of SQLite (32766) and PostgreSQL (65535)
+MAX_BOUND_PARAMETERS = 10000
+
+# Pairs written per statement, three bound parameters each (firewall_id, policy_id, position)
+PAIRS_PER_STATEMENT = MAX_BOUND_PARAMETERS // 3
+
+# Dialects supporting INSERT ... ON CONFLICT DO NOTHING
+UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+FIREWALL_ID = firewall_policy.c.firewall_id
+POLICY_ID = firewall_policy.c.policy_id
+POSITION = firewall_policy.c.position
+
+
+def missing_ids(connection, model, ids) -> list:
+    """Return the IDs that do not exist in the table of a model.
+
+    Args:
+        connection (Connection): The connection to query.
+        model (obj): The SQLAlchemy model.
+        ids (iterable): The IDs to check.
+
+    Returns:
+        list: The unknown IDs, sorted.
+    """
+    ids = set(ids)
+    found = set()
+    for chunk in chunked(sorted(ids), PAIRS_PER_STATEMENT):
+        found.update(connection.execute(select(model.id).where(model.id.in_(chunk))).scalars())
+    return sorted(ids - found)
+
+
+def _insert(connection):
+    upsert = UPSERT_INSERTS.get(connection.dialect.name)
+    if upsert is None or not connection.dialect.insert_returning:
+        return None
+    return upsert(firewall_policy).on_conflict_do_nothing()
+
+
+def _pair_rows(pairs, last_keys: dict) -> list:
+    """Build the rows of pairs appended after the last policy of their firewall."""
+    rows = []
+    for firewall_id, policy_id in pairs:
+        position = last_keys[firewall_id] = (last_keys.get(firewall_id) or 0.0) + ORDER_GAP
+        rows.append({'firewall_id': firewall_id, 'policy_id': policy_id, 'position': position})
+    return rows
+
+
+def attach_pairs(connection, spec) -> tuple:
+    """Insert the pairs of a spec that are not associated yet.
+
+    Explicit pairs are written as multi-row inserts; a cartesian spec is a
+    single INSERT ... SELECT over the firewall and policy tables. Existing
+    pairs are skipped by ON CONFLICT DO NOTHING, the inserted ones read back
+    with RETURNING; on databases without them, the missing pairs are selected
+    with NOT EXISTS first. Attached policies go last on their firewall, in
+    policy ID order.
+
+    Args:
+        connection (Connection): The connection of the transaction.
+        spec (PairSetCheck): The pairs to attach.
+
+    Returns:
+        tuple: The number of requested pairs and the list of attached
+            (firewall_id, policy_id, position) triples.
+    """
+    statement = _insert(connection)
+    attached = []
+    if spec.pairs is not None:
+        pairs = sorted(set(spec.pairs))
+        last_keys = POLICY_ORDER.last_keys(connection, {pair[0] for pair in pairs})
+        for chunk in chunked(pairs, PAIRS_PER_STATEMENT):
+            if statement is not None:
+                attached.extend(tuple(row) for row in connection.execute(
+                    statement.values(_pair_rows(chunk, last_keys))
+                    .returning(FIREWALL_ID, POLICY_ID, POSITION)))
+                continue
+            existing = {tuple(row) for row in connection.execute(
+                select(FIREWALL_ID, POLICY_ID).where(tuple_(FIREWALL_ID, POLICY_ID).in_(chunk)))}
+            rows = _pair_rows([pair for pair in chunk if pair not in existing], last_keys)
+            if rows:
+                connection.execute(insert(firewall_policy).values(rows))
+                attached.extend((row['firewall_id'], row['policy_id'], row['position'])
+                                for row in rows)
+        return len(pairs), attached
+
+    firewall_ids, policy_ids = set(spec.firewall_ids), set(spec.policy_ids)
+    last_key = (select(func.max(POSITION)).where(FIREWALL_ID == Firewall.id)
+                .scalar_subquery())
+    rank = func.row_number().over(partition_by=Firewall.id, order_by=Policy.id)
+    source = (select(Firewall.id, Policy.id, func.coalesce(last_key, 0.0) + ORDER_GAP * rank)
+              .join_from(Firewall, Policy, true())
+              .where(Firewall.id.in_(firewall_ids), Policy.id.in_(policy_ids)))
+    if statement is not None:
+        attached = [tuple(row) for row in connection.execute(
+            statement.from_select(['firewall_id', 'policy_id', 'position'], source)
+            .returning(FIREWALL_ID, POLICY_ID, POSITION))]
+    else:
+        attached = [tuple(row) for row in connection.execute(source.where(
+            ~select(FIREWALL_ID).where(and_(FIREWALL_ID == Firewall.id,
+                                            POLICY_ID == Policy.id)).exists()))]
+        for chunk in chunked(attached, PAIRS_PER_STATEMENT):
+            connection.execute(insert(firewall_policy).values(
+                [{'firewall_id': firewall_id, 'policy_id': policy_id, 'position': position}
+                 for firewall_id, policy_id, position in chunk]))
+    return len(firewall_ids) * len(policy_ids), attached
+
+
+def detach_pairs(connection, spec) -> list:
+    """Delete the pairs of a spec.
+
+    Args:
+        connection (Connection): The connection of the transaction.
+        spec (PairSetCheck): The pairs to detach.
+
+    Returns:
+        list: The detached pairs.
+    """
+    if spec.pairs is None:
+        conditions = [[FIREWALL_ID.in_(set(spec.firewall_ids)), POLICY_ID.in_(set(spec.policy_ids))]]
+    else:
+        conditions = [[tuple_(FIREWALL_ID, POLICY_ID).in_(chunk)]
+                      for chunk in chunked(sorted(set(spec.pairs)), PAIRS_PER_STATEMENT)]
+    detached = []
+    for condition in conditions:
+        if connection.dialect.delete_returning:
+            detached.extend(tuple(row) for row in connection.execute(
+                delete(firewall_policy).where(*condition).returning(FIREWALL_ID, POLICY_ID)))
+            continue
+        pairs = [tuple(row) for row in connection.execute(
+            select(FIREWALL_ID, POLICY_ID).where(*condition))]
+        if pairs:
+            connection.execute(delete(firewall_policy).where(*condition))
+            detached.extend(pairs)
+    return detached
+
+
+def spec_ids(spec) -> tuple:
+    """Return the firewall and policy IDs named by a spec.
+
+    Args:
+        spec (PairSetCheck): The pairs.
+
+    Returns:
+        tuple: The sets of firewall IDs and of policy IDs.
+    """
+    if spec.pairs is None:
+        return set(spec.firewall_ids), set(spec.policy_ids)
+    return {pair[0] for pair in spec.pairs}, {pair[1] for pair in spec.pairs}
+
+
+def spec_size(spec) -> int:
+    """Return the number of pairs named by a spec.
+
+    Args:
+        spec (PairSetCheck): The pairs.
+
+    Returns:
+        int: The number of pairs, before removing duplicates.
+    """
+    if spec.pairs is None:
+        return len(set(spec.firewall_ids)) * len(set(spec.policy_ids))
+    return len(spec.pairs)
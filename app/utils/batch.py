@@ -0,0 +1,211 @@
+"This file contains the vectorized evaluation of flow batches against a compiled ruleset"
+import ipaddress
+import json
+import threading
+import weakref
+import numpy as np
+from app.utils.ruleset import DEFAULT_ACTION, parse_prefix
+from app.utils.schema import ProtocolEnum, check_port
+
+# Small-int codes used to store protocols in NumPy arrays
+PROTOCOL_CODES = {protocol.value: code for code, protocol in enumerate(ProtocolEnum)}
+ALL_CODE = PROTOCOL_CODES[ProtocolEnum.ALL.value]
+
+# Number of rules compared against a chunk of flows at once
+RULE_BLOCK_SIZE = 256
+
+_MASK64 = (1 << 64) - 1
+
+
+def _split128(values: list) -> tuple:
+    """Split 128-bit integers into high and low uint64 columns."""
+    high = np.array([value >> 64 for value in values], dtype=np.uint64)
+    low = np.array([value & _MASK64 for value in values], dtype=np.uint64)
+    return high, low
+
+
+def _ge128(a_high, a_low, b_high, b_low):
+    """Compare 128-bit integers stored as uint64 pairs: a >= b."""
+    return (a_high > b_high) | ((a_high == b_high) & (a_low >= b_low))
+
+
+class _AddressColumns:
+    """Addresses of one side of a flow or rule, stored per IP version."""
+
+    def __init__(self, versions: list, starts: list, ends: list):
+        self.version = np.array(versions, dtype=np.uint8)
+        v4 = [value if version == 4 else 0 for version, value in zip(versions, starts)]
+        self.v4_start = np.array(v4, dtype=np.uint32)
+        v4 = [value if version == 4 else 0 for version, value in zip(versions, ends)]
+        self.v4_end = np.array(v4, dtype=np.uint32)
+        v6 = [value if version == 6 else 0 for version, value in zip(versions, starts)]
+        self.v6_start_high, self.v6_start_low = _split128(v6)
+        v6 = [value if version == 6 else 0 for version, value in zip(versions, ends)]
+        self.v6_end_high, self.v6_end_low = _split128(v6)
+
+    def contains(self, flows: '_AddressColumns', rows, rules: slice):
+        """Build the (flows x rules) mask of rule ranges containing the flow addresses."""
+        version = self.version[rules]
+        flow_version = flows.version[rows][:, None]
+        mask = np.zeros((len(rows), len(version)), dtype=bool)
+        if (version == 4).any():
+            address = flows.v4_start[rows][:, None]
+            mask |= ((flow_version == 4) & (version == 4)
+                     & (address >= self.v4_start[rules]) & (address <= self.v4_end[rules]))
+        if (version == 6).any():
+            high = flows.v6_start_high[rows][:, None]
+            low = flows.v6_start_low[rows][:, None]
+            mask |= ((flow_version == 6) & (version == 6)
+                     & _ge128(high, low, self.v6_start_high[rules], self.v6_start_low[rules])
+                     & _ge128(self.v6_end_high[rules], self.v6_end_low[rules], high, low))
+        return mask
+
+
+class RuleArrays:
+    """Column-oriented copy of a compiled ruleset, in evaluation order."""
+
+    def __init__(self, rules: list):
+        self.size = len(rules)
+        self.protocol = np.array([PROTOCOL_CODES[r['protocol']] for r in rules], dtype=np.uint8)
+        self.has_port = np.array([r['port'] is not None for r in rules], dtype=bool)
+        self.port = np.array([r['port'] or 0 for r in rules], dtype=np.uint16)
+        self.port_end = np.array([(r['port'] or 0) if r.get('port_end') is None else r['port_end']
+                                  for r in rules], dtype=np.uint16)
+        self.source = self._ranges([r['source_ip'] for r in rules])
+        self.destination = self._ranges([r['destination_ip'] for r in rules])
+        # Verdicts are pre-rendered once per rule, the last one is the default
+        self.verdicts = [json.dumps({'action': r['action'], 'rule_id': r['id']}) + '\n'
+                         for r in rules]
+        self.verdicts.append(json.dumps({'action': DEFAULT_ACTION.value, 'rule_id': None}) + '\n')
+
+    @staticmethod
+    def _ranges(values: list) -> _AddressColumns:
+        versions, starts, ends = [], [], []
+        for value in values:
+            version, start, length, bits = parse_prefix(value)
+            versions.append(version)
+            starts.append(start)
+            ends.append(start | ((1 << (bits - length)) - 1))
+        return _AddressColumns(versions, starts, ends)
+
+    def match(self, flows: 'FlowChunk'):
+        """Find the first matching rule of every flow of a chunk.
+
+        Rules are compared block by block in evaluation order; flows that already
+        matched are dropped from the following blocks.
+
+        Args:
+            flows (FlowChunk): The flows to evaluate.
+
+        Returns:
+            ndarray: The index of the matching rule per flow, -1 when none matches.
+        """
+        result = np.full(flows.size, -1, dtype=np.int64)
+        pending = np.flatnonzero(flows.valid)
+        for start in range(0, self.size, RULE_BLOCK_SIZE):
+            if not len(pending):
+                break
+            rules = slice(start, min(start + RULE_BLOCK_SIZE, self.size))
+            protocol = self.protocol[rules]
+            mask = ((protocol == ALL_CODE)
+                    | (flows.protocol[pending][:, None] == protocol))
+            port = flows.port[pending][:, None]
+            mask &= (~self.has_port[rules]
+                     | (flows.has_port[pending][:, None]
+                        & (port >= self.port[rules]) & (port <= self.port_end[rules])))
+            mask &= self.source.contains(flows.source, pending, rules)
+            mask &= self.destination.contains(flows.destination, pending, rules)
+
+            hit = mask.any(axis=1)
+            result[pending[hit]] = start + mask[hit].argmax(axis=1)
+            pending = pending[~hit]
+        return result
+
+
+class FlowChunk:
+    """Column-oriented chunk of flows parsed from records.
+
+    Records are validated one by one in Python with the rules of FlowCheck
+    (``check_port`` for the port), so a flow rejected by the single-flow
+    evaluation is rejected here too; only the matching is vectorized.
+    """
+
+    def __init__(self, records: list):
+        self.size = len(records)
+        self.errors = [None] * self.size
+        protocols, ports, has_ports = [], [], []
+        src_versions, src_values, dst_versions, dst_values = [], [], [], []
+        for index, record in enumerate(records):
+            try:
+                protocol = ProtocolEnum(record.get('protocol'))
+                source = ipaddress.ip_address(record.get('source_ip'))
+                destination = ipaddress.ip_address(record.get('destination_ip'))
+                port = record.get('port')
+                port = check_port(protocol, None if port is None else int(port))
+                protocol = PROTOCOL_CODES[protocol.value]
+            except (TypeError, ValueError) as e:
+                self.errors[index] = f"Invalid flow: {e}"
+                protocol, source, destination, port = 0, None, None, None
+
+            protocols.append(protocol)
+            has_ports.append(port is not None)
+            ports.append(port or 0)
+            src_versions.append(source.version if source is not None else 0)
+            src_values.append(int(source) if source is not None else 0)
+            dst_versions.append(destination.version if destination is not None else 0)
+            dst_values.append(int(destination) if destination is not None else 0)
+
+        self.valid = np.array([error is None for error in self.errors], dtype=bool)
+        self.protocol = np.array(protocols, dtype=np.uint8)
+        self.has_port = np.array(has_ports, dtype=bool)
+        self.port = np.array(ports, dtype=np.uint16)
+        self.source = _AddressColumns(src_versions, src_values, src_values)
+        self.destination = _AddressColumns(dst_versions, dst_values, dst_values)
+
+
+_arrays_lock = threading.Lock()
+_arrays = weakref.WeakKeyDictionary()
+
+
+def rule_arrays(compiled) -> RuleArrays:
+    """Return the column-oriented view of a compiled ruleset, building it once.
+
+    The view lives as long as the compiled ruleset, so it is dropped together
+    with it when the ruleset cache is invalidated.
+
+    Args:
+        compiled (CompiledRuleset): The compiled ruleset.
+
+    Returns:
+        RuleArrays: The rule columns.
+    """
+    with _arrays_lock:
+        arrays = _arrays.get(compiled)
+    if arrays is None:
+        arrays = RuleArrays(compiled.rules)
+        with _arrays_lock:
+            _arrays[compiled] = arrays
+    return arrays
+
+
+def evaluate_records(arrays: RuleArrays, records: list) -> tuple:
+    """Evaluate a chunk of streamed records and render the verdicts.
+
+    Args:
+        arrays (RuleArrays): The rule columns of the firewall.
+        records (list): Pairs of record and read error, as yielded by ``iter_records``.
+
+    Returns:
+        tuple: The NDJSON verdict lines, in input order, and the number of errors.
+    """
+    flows = FlowChunk([record or {} for record, _ in records])
+    matches = arrays.match(flows)
+    lines, errors = [], 0
+    for (_, read_error), flow_error, index in zip(records, flows.errors, matches.tolist()):
+        error = read_error or flow_error
+        if error:
+            errors += 1
+            lines.append(json.dumps({'error': error}) + '\n')
+        else:
+            lines.append(arrays.verdicts[index])
+    return lines, errors
@@ -0,0 +1,64 @@
+"This file contains the batch validation used by the bulk rule import"
+from pydantic import ValidationError
+from app.models import ActionEnum, ProtocolEnum
+from app.utils.common import address_columns, format_prefix
+from app.utils.schema import RuleListCheck
+
+
+def _format_errors(errors: list) -> str:
+    return '; '.join(f"{'.'.join(str(part) for part in error['loc'][1:]) or 'row'}: {error['msg']}"
+                     for error in errors)
+
+
+def validate_rule_rows(policy_id: int, chunk: list, first_row: int = 1) -> tuple:
+    """Validate a chunk of streamed records as rules of a policy.
+
+    The chunk is validated with one list-level call; when some records are
+    invalid they are reported and the remaining ones validated again.
+
+    Args:
+        policy_id (int): The ID of the policy receiving the rules.
+        chunk (list): Pairs of record and read error, as yielded by ``iter_records``.
+        first_row (int, optional): The row number of the first record. Defaults to 1.
+
+    Returns:
+        tuple: The rows ready to insert, as (row number, row) pairs, and the
+            errors (list of dict with the row number and the message).
+    """
+    errors = {}
+    candidates = []
+    for offset, (record, read_error) in enumerate(chunk):
+        if read_error:
+            errors[first_row + offset] = read_error
+        else:
+            candidates.append((first_row + offset, record))
+
+    try:
+        dtos = RuleListCheck.validate_python([record for _, record in candidates])
+    except ValidationError as e:
+        by_index = {}
+        for error in e.errors():
+            by_index.setdefault(error['loc'][0], []).append(error)
+        for index, item_errors in by_index.items():
+            errors[candidates[index][0]] = _format_errors(item_errors)
+        candidates = [candidate for index, candidate in enumerate(candidates)
+                      if index not in by_index]
+        dtos = RuleListCheck.validate_python([record for _, record in candidates])
+
+    rows = []
+    for dto in dtos:
+        source_ip, destination_ip = format_prefix(dto.source_ip), format_prefix(dto.destination_ip)
+        rows.append({
+            'action': ActionEnum(dto.action.value),
+            'protocol': ProtocolEnum(dto.protocol.value),
+            'source_ip': source_ip,
+            'destination_ip': destination_ip,
+            'port': dto.port,
+            'port_end': dto.port_end,
+            'policy_id': policy_id,
+            **address_columns('src', source_ip),
+            **address_columns('dst', destination_ip)
+        })
+    row_numbers = [row for row, _ in candidates]
+    errors = [{'row': row, 'error': message} for row, message in sorted(errors.items())]
+    return list(zip(row_numbers, rows)), errors
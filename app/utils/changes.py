@@ -0,0 +1,285 @@
+"This file contains the change log feeding the enforcement agents with deltas"
+import threading
+import time
+from sqlalchemy import and_, event, func, insert, inspect, or_, select, text
+from app.extensions import db
+from app.models import ChangeLog, Firewall, Policy, Rule, firewall_policy
+from app.utils.serializers import serializer_for
+
+# Key of the PostgreSQL advisory lock serializing the writers of the log
+CHANGE_LOG_LOCK = 0x4a46434c
+
+_RULE_FIELDS = ('action', 'source_ip', 'destination_ip', 'protocol', 'port', 'port_end',
+                'position')
+
+
+def rule_payload(rule_id: int, values: dict) -> dict:
+    """Serialize the rule of a change entry from its column values.
+
+    Args:
+        rule_id (int): The ID of the rule.
+        values (dict): The column values, enums or their values.
+
+    Returns:
+        dict: The rule, as returned by the API.
+    """
+    payload = {'id': rule_id}
+    for field in _RULE_FIELDS:
+        value = values.get(field)
+        payload[field] = getattr(value, 'value', value)
+    return payload
+
+
+def rule_entry(op: str, rule_id: int, policy_id: int, payload: dict = None) -> dict:
+    """Build the change entry of a rule."""
+    return {'entity': 'rule', 'op': op, 'entity_id': rule_id, 'firewall_id': None,
+            'policy_id': policy_id, 'payload': payload}
+
+
+def association_entry(op: str, firewall_id: int, policy_id: int, position: float = None) -> dict:
+    """Build the change entry of an attached, moved or detached policy."""
+    return {'entity': 'firewall_policy', 'op': op, 'entity_id': None,
+            'firewall_id': firewall_id, 'policy_id': policy_id,
+            'payload': None if position is None else {'position': position}}
+
+
+def policy_entry(op: str, policy_id: int) -> dict:
+    """Build the change entry of a policy."""
+    return {'entity': 'policy', 'op': op, 'entity_id': policy_id, 'firewall_id': None,
+            'policy_id': policy_id, 'payload': None}
+
+
+def firewall_entry(op: str, firewall_id: int) -> dict:
+    """Build the change entry of a firewall."""
+    return {'entity': 'firewall', 'op': op, 'entity_id': firewall_id,
+            'firewall_id': firewall_id, 'policy_id': None, 'payload': None}
+
+
+def record_changes(session, entries):
+    """Append entries to the change log in the current transaction.
+
+    Changes made through the ORM are recorded by the flush listeners; Core
+    statements bypassing it (bulk inserts or deletes) must call this explicitly.
+
+    Args:
+        session (Session): The session holding the transaction.
+        entries (iterable): The entries, see ``rule_entry`` and ``association_entry``.
+    """
+    entries = list(entries)
+    if not entries:
+        return
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        # Sequence numbers are taken at insert time but visible at commit: the
+        # writers are serialized so that entries become visible in seq order
+        # and a reader's cursor never skips a transaction committed late.
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': CHANGE_LOG_LOCK})
+    connection.execute(insert(ChangeLog), entries)
+    session.info['changes_logged'] = True
+
+
+def _association_history(obj, relation: str) -> tuple:
+    history = inspect(obj).attrs[relation].history
+    return history.added, history.deleted
+
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_changes(session, flush_context, instances):
+    """Record the changes of this flush that the agents must see.
+
+    Collections are read before the flush, while the associations of deleted
+    entities still exist. New entities have no ID yet, they are kept as
+    objects and resolved after the flush.
+    """
+    pending = session.info.setdefault('pending_changes', {})
+    deleted_policies = {obj for obj in session.deleted if isinstance(obj, Policy)}
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Rule):
+                pending[('rule', 'create', obj)] = obj
+        for obj in session.dirty:
+            if not session.is_modified(obj):
+                continue
+            if isinstance(obj, Rule):
+                pending[('rule', 'update', obj)] = obj
+            elif isinstance(obj, (Firewall, Policy)):
+                relation = 'policies' if isinstance(obj, Firewall) else 'firewalls'
+                added, removed = _association_history(obj, relation)
+                for op, others in (('attach', added), ('detach', removed)):
+                    for other in others:
+                        firewall, policy = (obj, other) if isinstance(obj, Firewall) else (other, obj)
+                        # Both sides of the relationship hold the same change
+                        pending[('firewall_policy', op, firewall, policy)] = (firewall, policy)
+        for obj in session.deleted:
+            if isinstance(obj, Rule):
+                if obj.policy not in deleted_policies:
+                    pending[('rule', 'delete', obj)] = obj
+            elif isinstance(obj, Policy):
+                pending[('policy', 'delete', obj)] = obj
+                for firewall in obj.firewalls:
+                    pending[('firewall_policy', 'detach', firewall, obj)] = (firewall, obj)
+            elif isinstance(obj, Firewall):
+                pending[('firewall', 'delete', obj)] = obj
+
+
+def _entry(key: tuple, value) -> dict:
+    entity, op = key[:2]
+    if entity == 'firewall_policy':
+        firewall, policy = value
+        return association_entry(op, firewall.id, policy.id)
+    if entity == 'rule':
+        payload = None if op == 'delete' else value.to_dict()
+        return rule_entry(op, value.id, value.policy_id, payload)
+    if entity == 'policy':
+        return policy_entry(op, value.id)
+    return firewall_entry(op, value.id)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _write_changes(session, flush_context):
+    """Write the recorded changes in the transaction of the flush."""
+    pending = session.info.pop('pending_changes', None)
+    if pending:
+        record_changes(session, [_entry(key, value) for key, value in pending.items()])
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_changes(session):
+    """Wake the requests waiting for changes, once the entries are visible."""
+    if session.info.pop('changes_logged', False):
+        change_notifier.wake()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changes(session):
+    """Forget the changes recorded for a transaction that failed."""
+    session.info.pop('pending_changes', None)
+    session.info.pop('changes_logged', None)
+
+
+def changes_query(since: int, firewall_id: int = None, limit: int = 500):
+    """Build the query of the change entries after a cursor.
+
+    Filtered by firewall, the feed holds the entries of the firewall itself
+    (associations, deletion) and the rule and policy entries of the policies
+    currently attached to it.
+
+    Args:
+        since (int): The cursor, the sequence number of the last entry seen.
+        firewall_id (int, optional): Keep the entries concerning this firewall.
+        limit (int, optional): Maximum number of entries. Defaults to 500.
+
+    Returns:
+        Select: The SQLAlchemy select statement of the serialized columns.
+    """
+    statement = serializer_for(ChangeLog).select().where(ChangeLog.seq > since)
+    if firewall_id is not None:
+        attached = (select(firewall_policy.c.policy_id)
+                    .where(firewall_policy.c.firewall_id == firewall_id))
+        statement = statement.where(or_(
+            ChangeLog.firewall_id == firewall_id,
+            and_(ChangeLog.firewall_id.is_(None), ChangeLog.policy_id.in_(attached))
+        ))
+    return statement.order_by(ChangeLog.seq).limit(limit)
+
+
+def changes_since(since: int, firewall_id: int = None, limit: int = 500) -> list:
+    """Return the serialized change entries after a cursor, see ``changes_query``."""
+    return serializer_for(ChangeLog).rows(
+        db.session.execute(changes_query(since, firewall_id, limit)))
+
+
+def latest_sequence() -> int:
+    """Return the sequence number of the last change entry, 0 when the log is empty."""
+    return db.session.execute(select(func.max(ChangeLog.seq))).scalar() or 0
+
+
+class ChangeNotifier:
+    """Wakes the requests waiting for the change log to grow past their cursor.
+
+    Waiters sleep on a condition without holding a database connection. A
+    commit of this process wakes them at once; commits of other processes
+    are discovered by one waiter at a time, which reads the last sequence
+    number at most once per poll interval on behalf of all the others.
+    Each waiter holds a server thread, so their number is capped by ``enter``.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._latest = 0
+        self._checked_at = float('-inf')
+        self._checking = False
+        self.waiters = 0
+
+    @property
+    def latest(self) -> int:
+        """The last sequence number known to this process."""
+        return self._latest
+
+    def enter(self, limit: int) -> bool:
+        """Count a new waiting request, unless ``limit`` of them already wait.
+
+        Args:
+            limit (int): Maximum number of waiting requests, 0 for no limit.
+
+        Returns:
+            bool: Whether the request may wait, in which case it must call ``leave``.
+        """
+        with self._condition:
+            if limit and self.waiters >= limit:
+                return False
+            self.waiters += 1
+            return True
+
+    def leave(self):
+        """Forget a waiting request counted by ``enter``."""
+        with self._condition:
+            self.waiters -= 1
+
+    def publish(self, sequence: int):
+        """Record a sequence number read from the database and wake the waiters."""
+        with self._condition:
+            self._latest = max(self._latest, sequence)
+            self._condition.notify_all()
+
+    def wake(self):
+        """Make the next waiter read the last sequence number now."""
+        with self._condition:
+            self._checked_at = float('-inf')
+            self._condition.notify_all()
+
+    def wait(self, seen: int, timeout: float, load_latest, interval: float = 1.0) -> bool:
+        """Block until the log grows past a sequence number.
+
+        Args:
+            seen (int): The last sequence number seen by the caller.
+            timeout (float): Maximum seconds to wait.
+            load_latest (callable): Reads the last sequence number from the database.
+            interval (float, optional): Minimum seconds between two reads. Defaults to 1.
+
+        Returns:
+            bool: Whether the log grew, False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self._latest > seen:
+                    return True
+                now = time.monotonic()
+                if now >= deadline:
+                    return False
+                if self._checking or now - self._checked_at < interval:
+                    self._condition.wait(min(deadline - now,
+                                             max(self._checked_at + interval - now, 0.01)))
+                    continue
+                self._checking = True
+            try:
+                latest = load_latest()
+            finally:
+                with self._condition:
+                    self._checking = False
+                    self._checked_at = time.monotonic()
+            self.publish(latest)
+
+
+change_notifier = ChangeNotifier()
@@ -1,29 +1,358 @@
 "This file contains common utility functions for the Flask application"
+import base64
+import binascii
+import gc
 import ipaddress
+import json
 import logging
+import zlib
+from contextlib import contextmanager
+from flask import current_app, request
+from sqlalchemy import and_, func, or_, text
 from sqlalchemy.exc import SQLAlchemyError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def paginate_query(model, filters=None, page=1, per_page=10):
+COUNT_MODES = ('none', 'estimate', 'exact')
+
+# Above this many matching rows, filtered estimates fall back to the table size
+ESTIMATE_COUNT_CAP = 1000
+
+
+class CursorPage:
+    """A page of results fetched by keyset pagination."""
+
+    def __init__(self, items, limit, next_cursor=None, total=None):
+        self.items = items
+        self.limit = limit
+        self.next_cursor = next_cursor
+        self.total = total
+
+
+def encode_cursor(last_id: int, key=None) -> str:
+    """Encode the primary key of the last row of a page into an opaque cursor.
+
+    Args:
+        last_id (int): The primary key of the last row.
+        key (float, optional): The sort key of the last row, for listings ordered
+            by another column before the primary key. Defaults to None.
+
+    Returns:
+        str: The URL-safe cursor.
+    """
+    payload = {'id': last_id} if key is None else {'id': last_id, 'key': key}
+    payload = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, keyed: bool = False):
+    """Decode an opaque cursor built by encode_cursor.
+
+    Args:
+        cursor (str): The cursor sent by the client.
+        keyed (bool, optional): Whether the listing is ordered by a sort key
+            before the primary key. Defaults to False.
+
+    Returns:
+        int | tuple: The primary key to seek after, or the sort key and the
+            primary key when keyed.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+        last_id = payload['id']
+        key = payload['key'] if keyed else None
+    except (TypeError, KeyError, ValueError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor '{cursor}'") from e
+    if not isinstance(last_id, int) or (keyed and not isinstance(key, (int, float))):
+        raise ValueError(f"Invalid cursor '{cursor}'")
+    return (key, last_id) if keyed else last_id
+
+
+def pagination_args(default_per_page=10, keyed=False):
+    """Read the pagination parameters of the current request.
+
+    Cursor mode is enabled by the ``after`` or ``limit`` parameters, otherwise
+    the classic ``page``/``per_page`` mode is used.
+
+    Args:
+        default_per_page (int, optional): The page size when none is given. Defaults to 10.
+        keyed (bool, optional): Whether the cursors hold a sort key, see
+            ``paginate_query``'s ``order_by``. Defaults to False.
+
+    Returns:
+        dict: The keyword arguments for paginate_query.
+
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    args = request.args
+    count = args.get('count', default='exact', type=str)
+    if count not in COUNT_MODES:
+        raise ValueError(f"Invalid count '{count}'. Valid values are: {list(COUNT_MODES)}")
+
+    pagination = {
+        'page': args.get('page', default=1, type=int),
+        'per_page': args.get('per_page', default=default_per_page, type=int),
+        'count': count
+    }
+    if 'after' in args or 'limit' in args:
+        limit = int(args.get('limit', default=default_per_page))
+        if limit < 1:
+            raise ValueError(f"Invalid limit '{limit}'")
+        after = args.get('after', default='', type=str)
+        pagination['limit'] = limit
+        pagination['after'] = decode_cursor(after, keyed) if after else None
+    return pagination
+
+
+def pagination_envelope(paginated, results, page=1, per_page=10, **kwargs):
+    """Build the JSON envelope of a paginated listing.
+
+    Args:
+        paginated (obj): The result of paginate_query.
+        results (list): The serialized items of the page.
+        page (int, optional): The requested page. Defaults to 1.
+        per_page (int, optional): The requested page size. Defaults to 10. The envelope
+            reports the size of the pagination instead, lowered to MAX_PER_PAGE when set.
+
+    Returns:
+        dict: The response body.
+    """
+    if isinstance(paginated, CursorPage):
+        return {
+            'total': paginated.total,
+            'limit': paginated.limit,
+            'next_cursor': paginated.next_cursor,
+            'results': results
+        }
+    return {
+        'total': paginated.total,
+        'pages': paginated.pages,
+        'page': page,
+        'per_page': paginated.per_page,
+        'results': results
+    }
+
+
+def estimate_count(model, query, filtered=False):
+    """Estimate the number of rows of a query without a full COUNT(*).
+
+    Unfiltered queries read the table size from the planner statistics on
+    PostgreSQL, or from the highest primary key elsewhere. Filtered queries
+    count at most ESTIMATE_COUNT_CAP rows and fall back to the table size.
+
+    Args:
+        model (obj): The SQLAlchemy model queried.
+        query (Query): The filtered query.
+        filtered (bool, optional): Whether filters apply. Defaults to False.
+
+    Returns:
+        int: The estimated number of rows.
+    """
+    session = query.session
+    if filtered:
+        capped = query.with_entities(model.id).limit(ESTIMATE_COUNT_CAP).subquery()
+        total = session.query(func.count()).select_from(capped).scalar()
+        if total < ESTIMATE_COUNT_CAP:
+            return total
+
+    table = model.__table__
+    if session.get_bind().dialect.name == 'postgresql':
+        estimate = session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)"),
+            {'name': table.name}
+        ).scalar()
+        if estimate is not None and estimate >= 0:
+            return max(int(estimate), ESTIMATE_COUNT_CAP if filtered else 0)
+    estimate = session.query(func.max(model.id)).scalar() or 0
+    return max(estimate, ESTIMATE_COUNT_CAP) if filtered else estimate
+
+
+def max_page_size():
+    """Return the largest page size of the listings, MAX_PER_PAGE of the application.
+
+    Returns:
+        int: The cap, None when pages are as large as requested.
+    """
+    return current_app.config['MAX_PER_PAGE']
+
+
+def capped_page_size(size: int) -> int:
+    """Lower a requested page size to MAX_PER_PAGE, if set."""
+    cap = max_page_size()
+    return size if cap is None else min(size, cap)
+
+
+def paginate_query(model, filters=None, page=1, per_page=10,
+                   after=None, limit=None, count='exact', options=None,
+                   query=None, order_by=None):
     """paginate a query for a given model with optional filters.
     Args:
         model (obj): The SQLAlchemy model to query.
         filters (list, optional): A list of filter conditions to apply. Defaults to None.
         page (int, optional): The page number to retrieve. Defaults to 1.
         per_page (int, optional): The number of items per page. Defaults to 10.
+        after (int | tuple, optional): Seek after this primary key (cursor mode), or after
+            this sort key and primary key with ``order_by``. Defaults to None.
+        limit (int, optional): Page size in cursor mode, enables it when set. Defaults to None.
+        count (str, optional): How to compute the total: none, estimate or exact.
+            Defaults to exact.
+        options (list, optional): Loader options applied to the page query. Defaults to None.
+        query (Query, optional): The base query, e.g. joined to an association table.
+            Defaults to ``model.query``.
+        order_by (Column, optional): A sort key ordering the rows before the primary key;
+            cursors then hold both. Defaults to None.
+
+    ``per_page`` and ``limit`` are lowered to MAX_PER_PAGE when it is set, the envelope
+    reports the size used.
+    Both modes order the rows by primary key, after the sort key if any, so that pages
+    neither overlap nor skip rows.
 
     Returns:
-        obj: The paginated result.
+        obj: The paginated result, a CursorPage in cursor mode.
     """
-    query = model.query
+    if query is None:
+        query = model.query
     if filters:
         for condition in filters:
             query = query.filter(condition)
+    count_query = query
+    if options:
+        query = query.options(*options)
+    ordering = (model.id,) if order_by is None else (order_by, model.id)
+
+    if limit is None:
+        paginated = query.order_by(*ordering).paginate(
+            page=page, per_page=per_page, max_per_page=max_page_size(), error_out=False,
+            count=count == 'exact')
+        if count == 'estimate':
+            paginated.total = estimate_count(model, count_query, filtered=bool(filters))
+        return paginated
+
+    limit = capped_page_size(limit)
+    total = None
+    if count == 'exact':
+        total = count_query.count()
+    elif count == 'estimate':
+        total = estimate_count(model, count_query, filtered=bool(filters))
+
+    if order_by is None:
+        if after is not None:
+            query = query.filter(model.id > after)
+        # Fetch one extra row to know whether another page follows
+        items = query.order_by(model.id).limit(limit + 1).all()
+        keys = None
+    else:
+        if after is not None:
+            key, last_id = after
+            query = query.filter(or_(order_by > key, and_(order_by == key, model.id > last_id)))
+        rows = query.add_columns(order_by).order_by(*ordering).limit(limit + 1).all()
+        items, keys = [row[0] for row in rows], [row[1] for row in rows]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].id, None if keys is None else keys[limit - 1])
+    return CursorPage(items, limit, next_cursor=next_cursor, total=total)
+
+def format_prefix(network) -> str:
+    """Format a network, as a plain address when it holds a single host.
+
+    Args:
+        network (IPv4Network | IPv6Network): The network to format.
+
+    Returns:
+        str: "10.0.0.1" for a host, "10.0.0.0/8" otherwise.
+    """
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def address_range(value: str) -> tuple:
+    """Convert an address or CIDR prefix into its indexed range.
+
+    Bounds are 16-byte big-endian strings so that they compare like the
+    addresses, for both IPv4 and IPv6.
+
+    Args:
+        value (str): The address or prefix, e.g. "10.0.0.1" or "10.0.0.0/8".
+
+    Returns:
+        tuple: The IP version, the first and the last address of the range.
+
+    Raises:
+        ValueError: If the value is not a valid address or prefix.
+    """
+    network = ipaddress.ip_network(value, strict=False)
+    return (network.version,
+            int(network.network_address).to_bytes(16, 'big'),
+            int(network.broadcast_address).to_bytes(16, 'big'))
+
+
+def address_columns(prefix: str, value: str) -> dict:
+    """Build the normalized range columns of a rule address.
+
+    Args:
+        prefix (str): The column prefix, "src" or "dst".
+        value (str): The address or prefix.
+
+    Returns:
+        dict: The version, start and end columns.
+    """
+    version, start, end = address_range(value)
+    return {f'{prefix}_version': version, f'{prefix}_start': start, f'{prefix}_end': end}
+
+
+def version_etag(version: int) -> str:
+    """Build the ETag of an entity representation from its version.
+
+    The query string is part of the tag, since fields and expand change the
+    representation of the same version.
+
+    Args:
+        version (int): The version counter of the entity.
+
+    Returns:
+        str: The unquoted ETag.
+    """
+    return f"{version}-{zlib.crc32(request.query_string):08x}"
+
+
+def not_modified(etag: str):
+    """Build the 304 response answering a matching If-None-Match.
+
+    Args:
+        etag (str): The unquoted ETag of the current representation.
+
+    Returns:
+        Response: An empty 304 response carrying the ETag.
+    """
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+@contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector while building large acyclic structures.
+
+    Allocating hundreds of thousands of small objects otherwise triggers
+    repeated full collections that dominate the build time.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
-    return query.paginate(page=page, per_page=per_page, error_out=False)
 
 def validate_enum(value, enum_class):
     """Validate if a value is a valid member of an Enum class.
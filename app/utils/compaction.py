@@ -0,0 +1,169 @@
+"This file contains the ruleset compaction used to optimize a policy"
+import ipaddress
+from app.utils.analysis import find_overlaps
+from app.utils.common import format_prefix, gc_paused
+from app.utils.schema import ProtocolEnum
+
+PORT_PROTOCOLS = {ProtocolEnum.TCP.value, ProtocolEnum.UDP.value}
+
+# Upper bound on merge passes, each pass only ever removes rules
+MAX_PASSES = 16
+
+
+class _Item:
+    """A rule of the compacted set, either an original rule or a merge of several."""
+    __slots__ = ('position', 'action', 'protocol', 'src', 'dst', 'port', 'port_end',
+                 'ids', 'data')
+
+    def __init__(self, position, action, protocol, src, dst, port, port_end, ids, data=None):
+        self.position = position
+        self.action = action
+        self.protocol = protocol
+        self.src = src
+        self.dst = dst
+        self.port = port
+        self.port_end = port_end
+        self.ids = ids
+        self.data = data
+
+    @classmethod
+    def from_rule(cls, position: int, data: dict) -> '_Item':
+        return cls(position, data['action'], data['protocol'],
+                   ipaddress.ip_network(data['source_ip'], strict=False),
+                   ipaddress.ip_network(data['destination_ip'], strict=False),
+                   data['port'], data.get('port_end'), (data['id'],), data)
+
+    def merge(self, members: list, **changes) -> '_Item':
+        """Build the rule replacing members, self being one of them."""
+        if len(members) == 1 and all(getattr(self, k) == v for k, v in changes.items()):
+            return self
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        values['position'] = min(member.position for member in members)
+        values['ids'] = tuple(rule_id for member in members for rule_id in member.ids)
+        values['data'] = None
+        return _Item(**values)
+
+    def to_dict(self) -> dict:
+        if self.data is not None:
+            return self.data
+        return {
+            'id': None,
+            'action': self.action,
+            'source_ip': format_prefix(self.src),
+            'destination_ip': format_prefix(self.dst),
+            'protocol': self.protocol,
+            'port': self.port,
+            'port_end': self.port_end,
+            'replaces': sorted(self.ids)
+        }
+
+
+def _group(items: list, key) -> dict:
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups
+
+
+def _collapse_addresses(items: list, side: str) -> list:
+    """Replace rules differing only by one address with the collapsed prefixes.
+
+    Adjacent prefixes are joined into their supernet and prefixes contained in
+    another one are absorbed by it.
+    """
+    other = 'dst' if side == 'src' else 'src'
+    result = []
+    groups = _group(items, lambda item: (item.action, item.protocol, item.port, item.port_end,
+                                         getattr(item, other), getattr(item, side).version))
+    for group in groups.values():
+        if len(group) == 1:
+            result.extend(group)
+            continue
+        networks = list(ipaddress.collapse_addresses(getattr(item, side) for item in group))
+        if len(networks) == len(group):
+            result.extend(group)
+            continue
+        # Both lists are sorted by address, each rule falls in exactly one network
+        group.sort(key=lambda item: getattr(item, side))
+        position = 0
+        for network in networks:
+            members = []
+            while (position < len(group)
+                   and getattr(group[position], side).subnet_of(network)):
+                members.append(group[position])
+                position += 1
+            result.append(members[0].merge(members, **{side: network}))
+    return result
+
+
+def _merge_ports(items: list) -> list:
+    """Replace rules differing only by port with the union of their port ranges."""
+    result = [item for item in items if item.port is None]
+    groups = _group([item for item in items if item.port is not None],
+                    lambda item: (item.action, item.protocol, item.src, item.dst))
+    for group in groups.values():
+        if len(group) == 1:
+            result.extend(group)
+            continue
+        group.sort(key=lambda item: (item.port, item.port_end or item.port))
+        members, start, end = [], None, None
+        for item in group + [None]:
+            item_end = None if item is None else item.port_end or item.port
+            if item is not None and members and item.port <= end + 1:
+                members.append(item)
+                end = max(end, item_end)
+                continue
+            if members:
+                result.append(members[0].merge(
+                    members, port=start, port_end=end if end != start else None))
+            if item is not None:
+                members, start, end = [item], item.port, item_end
+    return result
+
+
+def compact_rules(rules: list) -> dict:
+    """Compute a smaller rule list matching exactly the same flows.
+
+    - rules covered by an earlier rule never fire and are dropped, exact
+      duplicates included;
+    - the remaining rules that conflict with no rule of the opposite action do
+      not depend on their position, so rules differing only by one address are
+      collapsed into supernets and rules differing only by port are merged into
+      port ranges, until nothing changes;
+    - conflicting rules are kept untouched.
+
+    Args:
+        rules (list): The rules in evaluation order, as returned by ``Rule.to_dict``.
+
+    Returns:
+        dict: The kept rules, the merged rules to add and the IDs of the removed rules.
+    """
+    normalized, covered_by, conflicts = find_overlaps(rules)
+    pinned = {rule.index for pair in conflicts for rule in pair}
+
+    with gc_paused():
+        fixed, free = [], []
+        for rule in normalized:
+            if rule.index in covered_by:
+                continue
+            item = _Item.from_rule(rule.index, rule.data)
+            (fixed if rule.index in pinned else free).append(item)
+
+        for _ in range(MAX_PASSES):
+            count = len(free)
+            free = _collapse_addresses(free, 'src')
+            free = _collapse_addresses(free, 'dst')
+            free = (_merge_ports([item for item in free if item.protocol in PORT_PROTOCOLS])
+                    + [item for item in free if item.protocol not in PORT_PROTOCOLS])
+            if len(free) == count:
+                break
+
+    items = sorted(fixed + free, key=lambda item: item.position)
+    kept = [item.data for item in items if item.data is not None]
+    kept_ids = {rule['id'] for rule in kept}
+    return {
+        'kept': kept,
+        'added': [item.to_dict() for item in items if item.data is None],
+        'removed': [rule['id'] for rule in rules if rule['id'] not in kept_ids]
+    }
@@ -0,0 +1,72 @@
+"This file contains the deletion of large policies in bounded batches"
+import time
+from sqlalchemy import delete, func, select
+from app.models import Policy, Rule, firewall_policy
+from app.shards import rule_shards
+from app.utils.changes import association_entry, policy_entry, record_changes
+from app.utils.ruleset import ruleset_cache
+from app.utils.versions import bump_versions
+
+
+def count_rules(session, policy_id: int) -> int:
+    """Return the number of rules of a policy."""
+    shards = rule_shards()
+    return session.execute(select(func.count()).select_from(Rule)
+                           .where(Rule.policy_id == policy_id),
+                           bind_arguments=shards.bind_arguments(
+                               shards.placement(session, policy_id))).scalar()
+
+
+def delete_policy_in_batches(session, policy_id: int, batch_size: int = 5000,
+                             pause: float = 0.0, progress=None) -> dict:
+    """Delete a policy and its rules in bounded transactions.
+
+    The policy is first detached from its firewalls in one transaction, so
+    their rulesets lose it at once; its rules are then deleted batch by batch,
+    each batch committed so that the write lock is released in between, and
+    the policy row last.
+
+    Args:
+        session (Session): The session to write with, committed after each batch.
+        policy_id (int): The ID of the policy.
+        batch_size (int, optional): Rules deleted per transaction. Defaults to 5000.
+        pause (float, optional): Seconds slept between two batches. Defaults to 0.
+        progress (callable, optional): Called with the deleted and total rule
+            counts before each commit, e.g. to update a job.
+
+    Returns:
+        dict: The counts of detached firewalls and deleted rules.
+    """
+    shards = rule_shards()
+    firewall_ids = session.execute(select(firewall_policy.c.firewall_id)
+                                   .where(firewall_policy.c.policy_id == policy_id)).scalars().all()
+    if firewall_ids:
+        bump_versions(session, firewall_ids=firewall_ids, policy_ids=[policy_id])
+        session.execute(delete(firewall_policy).where(firewall_policy.c.policy_id == policy_id))
+        record_changes(session, [association_entry('detach', firewall_id, policy_id)
+                                 for firewall_id in firewall_ids])
+    total = count_rules(session, policy_id)
+    deleted = 0
+    if progress is not None:
+        progress(deleted, total)
+    session.commit()
+    # Core writes are not seen by the flush listeners
+    ruleset_cache.invalidate(firewall_ids=firewall_ids, policy_ids=[policy_id])
+
+    while True:
+        batch = select(Rule.id).where(Rule.policy_id == policy_id).limit(batch_size)
+        count = shards.writer(session, policy_id).execute(
+            delete(Rule).where(Rule.id.in_(batch))).rowcount
+        if not count:
+            break
+        deleted += count
+        if progress is not None:
+            progress(deleted, total)
+        session.commit()
+        if pause:
+            time.sleep(pause)
+
+    session.execute(delete(Policy).where(Policy.id == policy_id))
+    record_changes(session, [policy_entry('delete', policy_id)])
+    session.commit()
+    return {'policy_id': policy_id, 'firewalls_detached': len(firewall_ids), 'rules_deleted': deleted}
@@ -0,0 +1,150 @@
+"This file contains the formatters used to export a firewall ruleset"
+import ipaddress
+from flask import current_app
+from app.utils.schema import ActionEnum, ProtocolEnum
+
+EXPORT_FORMATS = ('nft', 'iptables', 'ip6tables', 'ndjson')
+
+MIMETYPES = {
+    'nft': 'text/plain',
+    'iptables': 'text/plain',
+    'ip6tables': 'text/plain',
+    'ndjson': 'application/x-ndjson',
+}
+
+IPTABLES_ACTIONS = {ActionEnum.ALLOW: 'ACCEPT', ActionEnum.DENY: 'DROP'}
+NFT_ACTIONS = {ActionEnum.ALLOW: 'accept', ActionEnum.DENY: 'drop'}
+
+# Protocol names per IP version; ALL matches any protocol and has no name
+IPTABLES_PROTOCOLS = {
+    ProtocolEnum.TCP: {4: 'tcp', 6: 'tcp'},
+    ProtocolEnum.UDP: {4: 'udp', 6: 'udp'},
+    ProtocolEnum.ICMP: {4: 'icmp', 6: 'ipv6-icmp'},
+    ProtocolEnum.GRE: {4: 'gre', 6: 'gre'},
+    ProtocolEnum.ESP: {4: 'esp', 6: 'esp'},
+    ProtocolEnum.AH: {4: 'ah', 6: 'ah'},
+    ProtocolEnum.ALL: {4: None, 6: None},
+}
+
+CHAIN_NAME = 'JOUERFLUX'
+
+
+def _version(rule: dict):
+    """Return the IP version of a rule, None when source and destination differ."""
+    source = ipaddress.ip_network(rule['source_ip'], strict=False).version
+    destination = ipaddress.ip_network(rule['destination_ip'], strict=False).version
+    return source if source == destination else None
+
+
+def _ports(rule: dict, separator: str) -> str:
+    """Render the destination port of a rule, or its port range."""
+    if rule.get('port_end') is None:
+        return str(rule['port'])
+    return f"{rule['port']}{separator}{rule['port_end']}"
+
+
+class NdjsonExporter:
+    """One JSON object per rule, as returned by the API."""
+
+    def __init__(self, firewall):
+        self.firewall = firewall
+        self.dumps = current_app.json.dumps
+
+    def header(self) -> str:
+        return ''
+
+    def rule(self, rule: dict) -> str:
+        return self.dumps(rule) + '\n'
+
+    def footer(self) -> str:
+        return ''
+
+
+class IptablesExporter:
+    """iptables-restore (or ip6tables-restore) input for one address family.
+
+    Rules go to a dedicated chain ending with the default DROP, jumped to from
+    FORWARD like the forward hook of the nft export; rules of the other family
+    are kept as comments.
+    """
+
+    def __init__(self, firewall, version: int = 4):
+        self.firewall = firewall
+        self.version = version
+
+    def header(self) -> str:
+        return (f"# Generated by JouerFlux for firewall {self.firewall.name}\n"
+                "*filter\n"
+                f":{CHAIN_NAME} - [0:0]\n"
+                f"-A FORWARD -j {CHAIN_NAME}\n")
+
+    def rule(self, rule: dict) -> str:
+        if _version(rule) != self.version:
+            return f"# skipped rule {rule['id']}: not an IPv{self.version} rule\n"
+        parts = [f"-A {CHAIN_NAME}", f"-s {rule['source_ip']}", f"-d {rule['destination_ip']}"]
+        protocol = IPTABLES_PROTOCOLS[rule['protocol']][self.version]
+        if protocol:
+            parts.append(f"-p {protocol}")
+        if rule['port'] is not None:
+            parts.append(f"--dport {_ports(rule, ':')}")
+        parts.append(f'-m comment --comment "jouerflux rule {rule["id"]}"')
+        parts.append(f"-j {IPTABLES_ACTIONS[rule['action']]}")
+        return ' '.join(parts) + '\n'
+
+    def footer(self) -> str:
+        return f"-A {CHAIN_NAME} -j DROP\nCOMMIT\n"
+
+
+class NftExporter:
+    """nftables script with one inet table holding both address families."""
+
+    def __init__(self, firewall):
+        self.firewall = firewall
+
+    def header(self) -> str:
+        return (f"# Generated by JouerFlux for firewall {self.firewall.name}\n"
+                "table inet jouerflux {\n"
+                f"\tchain fw_{self.firewall.id} {{\n"
+                "\t\ttype filter hook forward priority 0; policy drop;\n")
+
+    def rule(self, rule: dict) -> str:
+        version = _version(rule)
+        if version is None:
+            return f"\t\t# skipped rule {rule['id']}: mixed address families\n"
+        family = 'ip' if version == 4 else 'ip6'
+        parts = [f"{family} saddr {rule['source_ip']}", f"{family} daddr {rule['destination_ip']}"]
+        protocol = IPTABLES_PROTOCOLS[rule['protocol']][version]
+        if rule['port'] is not None:
+            parts.append(f"{protocol} dport {_ports(rule, '-')}")
+        elif protocol:
+            parts.append(f"meta l4proto {protocol}")
+        parts.append(f'comment "jouerflux rule {rule["id"]}"')
+        parts.append(NFT_ACTIONS[rule['action']])
+        return '\t\t' + ' '.join(parts) + '\n'
+
+    def footer(self) -> str:
+        return "\t}\n}\n"
+
+
+def exporter_for(fmt: str, firewall):
+    """Build the exporter of a format.
+
+    Args:
+        fmt (str): One of EXPORT_FORMATS.
+        firewall (Firewall): The exported firewall.
+
+    Returns:
+        obj: An exporter with header, rule and footer methods.
+
+    Raises:
+        ValueError: If the format is not supported.
+    """
+    if fmt == 'nft':
+        return NftExporter(firewall)
+    if fmt == 'iptables':
+        return IptablesExporter(firewall, version=4)
+    if fmt == 'ip6tables':
+        return IptablesExporter(firewall, version=6)
+    if fmt == 'ndjson':
+        return NdjsonExporter(firewall)
+    raise ValueError(f"Invalid format '{fmt}'. Valid values are: {list(EXPORT_FORMATS)}")
@@ -0,0 +1,253 @@
+"This file contains the fractional ordering keys of the rules and of the attached policies"
+import logging
+from sqlalchemy import bindparam, event, func, select, tuple_, update
+from app.extensions import db
+from app.jobs import job_handler, submit_job
+from app.models import Firewall, Job, Policy, Rule, firewall_policy
+from app.shards import rule_shards
+from app.utils.changes import firewall_entry, policy_entry, record_changes
+from app.utils.ruleset import ruleset_cache
+from app.utils.versions import bump_versions
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Distance between consecutive keys when appending or rebalancing
+ORDER_GAP = 1024.0
+
+# A gap narrower than this fraction of its keys schedules a rebalance, about
+# 20 halvings before doubles run out of precision (2**-52)
+REBALANCE_PRECISION = 2.0 ** -32
+
+REBALANCE_JOB = 'rebalance_order'
+
+
+def key_between(before: float = None, after: float = None):
+    """Return an ordering key strictly between two keys.
+
+    Args:
+        before (float, optional): The key of the previous item, None at the start.
+        after (float, optional): The key of the next item, None at the end.
+
+    Returns:
+        float: The key, None if no double lies between the two keys.
+    """
+    if before is None and after is None:
+        return ORDER_GAP
+    if before is None:
+        return after - ORDER_GAP
+    if after is None:
+        return before + ORDER_GAP
+    key = (before + after) / 2
+    return key if before < key < after else None
+
+
+def keys_after(last: float, count: int) -> list:
+    """Return the keys of items appended after the key ``last`` (None when empty)."""
+    start = last or 0.0
+    return [start + ORDER_GAP * index for index in range(1, count + 1)]
+
+
+def is_cramped(before: float = None, after: float = None) -> bool:
+    """Tell whether the gap between two keys should be widened by a rebalance."""
+    if before is None or after is None:
+        return False
+    return after - before < max(abs(before), abs(after), ORDER_GAP) * REBALANCE_PRECISION
+
+
+class OrderedCollection:
+    """Items ordered by a fractional key within a scope.
+
+    Inserting or moving an item writes its own key only, halfway between
+    its new neighbours; items with equal keys are ordered by ID. When a gap
+    gets too narrow the scope is rebalanced, in the background, by rewriting
+    the keys evenly spaced.
+    """
+
+    def __init__(self, name: str, label: str, table, scope: str, item: str, parent, bump: str,
+                 entry):
+        self.name = name
+        self.label = label
+        self.table = table
+        self.scope = table.c[scope]
+        self.item = table.c[item]
+        self.position = table.c.position
+        self.parent = parent
+        # Versions bumped and change entry recorded by a rebalance
+        self.bump = bump
+        self.entry = entry
+
+    def connection(self, session, scope_id: int):
+        """Return the connection holding the items of a scope."""
+        return session.connection()
+
+    def lock(self, session, scope_id: int):
+        """Serialize the writers of a scope's keys on the row of its parent.
+
+        FOR UPDATE is not rendered on SQLite, whose writers are serialized anyway.
+        """
+        session.connection().execute(select(self.parent.id).where(self.parent.id == scope_id)
+                                     .with_for_update())
+
+    def last_keys(self, connection, scope_ids) -> dict:
+        """Return the last key of each scope, by scope ID; empty scopes are left out."""
+        return dict(connection.execute(
+            select(self.scope, func.max(self.position))
+            .where(self.scope.in_(set(scope_ids))).group_by(self.scope)).all())
+
+    def append_keys(self, connection, scope_id: int, count: int) -> list:
+        """Return the keys of ``count`` items appended to a scope."""
+        return keys_after(self.last_keys(connection, [scope_id]).get(scope_id), count)
+
+    def _key_of(self, connection, scope_id: int, item_id: int) -> float:
+        key = connection.execute(select(self.position).where(
+            self.scope == scope_id, self.item == item_id)).scalar()
+        if key is None:
+            raise ValueError(f"{self.label.capitalize()} {item_id} is not in "
+                             f"{self.parent.__tablename__} {scope_id}")
+        return key
+
+    def _neighbours(self, connection, scope_id: int, item_id: int, before: int, after: int) -> tuple:
+        others = [self.scope == scope_id]
+        if item_id is not None:
+            others.append(self.item != item_id)
+        if before is not None:
+            key = self._key_of(connection, scope_id, before)
+            previous = connection.execute(
+                select(self.position)
+                .where(*others, tuple_(self.position, self.item) < tuple_(key, before))
+                .order_by(self.position.desc(), self.item.desc()).limit(1)).scalar()
+            return previous, key
+        if after is not None:
+            key = self._key_of(connection, scope_id, after)
+            following = connection.execute(
+                select(self.position)
+                .where(*others, tuple_(self.position, self.item) > tuple_(key, after))
+                .order_by(self.position, self.item).limit(1)).scalar()
+            return key, following
+        return connection.execute(select(func.max(self.position)).where(*others)).scalar(), None
+
+    def place(self, session, scope_id: int, item_id: int = None, before: int = None,
+              after: int = None) -> tuple:
+        """Compute the key of an item inserted or moved in a scope.
+
+        Args:
+            session (Session): The session holding the transaction.
+            scope_id (int): The ID of the policy or firewall.
+            item_id (int, optional): The ID of the moved item, None for a new one.
+            before (int, optional): Place the item right before this item.
+            after (int, optional): Place the item right after this item.
+                Without ``before`` nor ``after``, the item goes last.
+
+        Returns:
+            tuple: The key, and whether the scope should be rebalanced.
+
+        Raises:
+            ValueError: If the anchor item is not in the scope, or is the item itself.
+        """
+        if item_id is not None and item_id in (before, after):
+            raise ValueError(f"A {self.label} cannot be placed relative to itself")
+        self.lock(session, scope_id)
+        connection = self.connection(session, scope_id)
+        previous, following = self._neighbours(connection, scope_id, item_id, before, after)
+        key = key_between(previous, following)
+        if key is None:
+            # Equal or adjacent keys, rare enough to rebalance in the request
+            self.rebalance(session, scope_id)
+            previous, following = self._neighbours(connection, scope_id, item_id, before, after)
+            key = key_between(previous, following)
+        return key, is_cramped(previous, following)
+
+    def rebalance(self, session, scope_id: int) -> int:
+        """Rewrite the keys of a scope evenly spaced, keeping their order.
+
+        Args:
+            session (Session): The session holding the transaction.
+            scope_id (int): The ID of the policy or firewall.
+
+        Returns:
+            int: The number of items of the scope.
+        """
+        self.lock(session, scope_id)
+        connection = self.connection(session, scope_id)
+        items = connection.execute(select(self.item).where(self.scope == scope_id)
+                                   .order_by(self.position, self.item)).scalars().all()
+        if not items:
+            return 0
+        connection.execute(
+            update(self.table)
+            .where(self.scope == bindparam('scope_key'), self.item == bindparam('item_key'))
+            .values(position=bindparam('key')),
+            [{'scope_key': scope_id, 'item_key': item_id, 'key': key}
+             for item_id, key in zip(items, keys_after(None, len(items)))])
+        bump_versions(session, **{self.bump: [scope_id]})
+        record_changes(session, [self.entry('reorder', scope_id)])
+        if self.table is Rule.__table__:
+            # Loaded rules must read their new keys
+            for obj in session.identity_map.values():
+                if isinstance(obj, Rule) and obj.policy_id == scope_id:
+                    session.expire(obj, ['position'])
+        logger.info(f"Rebalanced the {len(items)} {self.name} of "
+                    f"{self.parent.__tablename__} {scope_id}")
+        return len(items)
+
+
+class ShardedCollection(OrderedCollection):
+    """Rules ordered within their policy, read and written in the shard of the policy."""
+
+    def connection(self, session, scope_id: int):
+        return rule_shards().writer(session, scope_id)
+
+
+RULE_ORDER = ShardedCollection('rules', 'rule', Rule.__table__, 'policy_id', 'id', Policy,
+                               'policy_ids', policy_entry)
+POLICY_ORDER = OrderedCollection('policies', 'policy', firewall_policy, 'firewall_id', 'policy_id',
+                                 Firewall, 'firewall_ids', firewall_entry)
+ORDERED_COLLECTIONS = {collection.name: collection for collection in (RULE_ORDER, POLICY_ORDER)}
+
+
+def schedule_rebalance(collection: OrderedCollection, scope_id: int):
+    """Submit the rebalance of a scope, unless one is already pending or running.
+
+    Commits the session, call it after the change that narrowed the gap.
+
+    Returns:
+        Job: The submitted job, None if one was already there.
+    """
+    params = {'collection': collection.name, 'scope_id': scope_id}
+    pending = db.session.execute(select(Job.params).where(
+        Job.kind == REBALANCE_JOB, Job.status.in_(('pending', 'running')))).scalars()
+    if any(pending_params == params for pending_params in pending):
+        return None
+    return submit_job(REBALANCE_JOB, params)
+
+
+@job_handler(REBALANCE_JOB)
+def _rebalance_job(job, params: dict) -> dict:
+    """Widen the gaps between the keys of a policy's rules or a firewall's policies."""
+    collection = ORDERED_COLLECTIONS[params['collection']]
+    count = collection.rebalance(db.session, params['scope_id'])
+    db.session.commit()
+    # Core writes are not seen by the flush listeners
+    ruleset_cache.invalidate(**{collection.bump: [params['scope_id']]})
+    return {'rebalanced': count}
+
+
+@event.listens_for(db.session, 'before_flush')
+def _append_new_rules(session, flush_context, instances):
+    """Give the rules created without a key the keys following the last rule of their policy."""
+    by_policy = {}
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Rule) and obj.position is None:
+                policy_id = obj.policy.id if obj.policy is not None else obj.policy_id
+                by_policy.setdefault(policy_id, []).append(obj)
+        if not by_policy:
+            return
+        last = {}
+        for policy_id in by_policy:
+            last.update(RULE_ORDER.last_keys(RULE_ORDER.connection(session, policy_id),
+                                             [policy_id]))
+    for policy_id, rules in by_policy.items():
+        for rule, key in zip(rules, keys_after(last.get(policy_id), len(rules))):
+            rule.position = key
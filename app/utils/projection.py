@@ -0,0 +1,268 @@
+"This file contains the expand/fields projection layer shared by the listing endpoints"
+from bisect import bisect_left, bisect_right
+from enum import Enum
+from flask import request
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+from app.extensions import db
+from app.models import Firewall, Policy, Rule, firewall_policy
+from app.shards import rule_shards
+from app.utils.responses import JsonArray
+from app.utils.serializers import SERIALIZED_FIELDS, serializer_for
+
+# Related collections that can be expanded for each model
+EXPANSIONS = {
+    Firewall: {'policies': Policy},
+    Policy: {'rules': Rule, 'firewalls': Firewall},
+    Rule: {},
+}
+
+# Order of the collections kept in evaluation order, the others are sorted by ID
+COLLECTION_ORDER = {
+    (Policy, 'rules'): (Rule.position, Rule.id),
+    (Firewall, 'policies'): (firewall_policy.c.position, Policy.id),
+}
+
+
+def _split(value: str) -> list:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class Projection:
+    """Columns and related collections requested for a model.
+
+    ``fields`` restricts the columns of the model (``id,name``) or of an
+    expanded collection (``rules.id,rules.port``); ``expand`` names the related
+    collections to embed. Unrequested columns and collections are not loaded.
+    """
+
+    def __init__(self, model, fields=None, expand=()):
+        self.model = model
+        self.expand = {}
+        nested_fields = {}
+        top_fields = []
+        for field in fields or ():
+            relation, _, column = field.rpartition('.')
+            if relation:
+                nested_fields.setdefault(relation, []).append(column)
+            else:
+                top_fields.append(column)
+
+        for relation in expand:
+            related = EXPANSIONS[model].get(relation)
+            if related is None:
+                raise ValueError(f"Invalid expand '{relation}'. "
+                                 f"Valid values are: {list(EXPANSIONS[model])}")
+            self.expand[relation] = Projection(related, nested_fields.pop(relation, None))
+        if nested_fields:
+            raise ValueError(f"Invalid fields {list(nested_fields)}: collection not expanded")
+
+        self.fields = self._check_fields(model, top_fields)
+
+    @staticmethod
+    def _check_fields(model, fields: list) -> tuple:
+        allowed = SERIALIZED_FIELDS[model]
+        if not fields:
+            return allowed
+        invalid = [field for field in fields if field not in allowed]
+        if invalid:
+            raise ValueError(f"Invalid fields {invalid}. Valid values are: {list(allowed)}")
+        # Keep the serialization order of the model
+        return tuple(field for field in allowed if field in fields)
+
+    @classmethod
+    def from_request(cls, model, default_expand=()):
+        """Build the projection requested by the ``fields`` and ``expand`` parameters.
+
+        Args:
+            model (obj): The SQLAlchemy model listed.
+            default_expand (tuple, optional): Collections embedded when ``expand``
+                is absent. Defaults to none.
+
+        Returns:
+            Projection: The requested projection.
+
+        Raises:
+            ValueError: If a field or a collection is unknown.
+        """
+        expand = request.args.get('expand', default=None, type=str)
+        fields = request.args.get('fields', default=None, type=str)
+        return cls(model,
+                   fields=_split(fields) if fields else None,
+                   expand=default_expand if expand is None else _split(expand))
+
+    def _columns(self):
+        names = set(self.fields) | {'id'}
+        return [getattr(self.model, name) for name in SERIALIZED_FIELDS[self.model]
+                if name in names]
+
+    def options(self) -> list:
+        """Build the loader options implementing the projection.
+
+        Only the requested columns of the model are loaded; expanded collections
+        are fetched as rows by ``serialize_all``.
+
+        Returns:
+            list: The options to pass to ``Query.options``.
+        """
+        return [load_only(*self._columns())]
+
+    def _collection_query(self, relation: str, nested, ids: list) -> tuple:
+        """Build the SELECT ... IN of the serialized collection of entities.
+
+        Returns:
+            tuple: The serializer, the parent key column, the unordered statement
+                and the (bind arguments, entity IDs) groups to run it for.
+        """
+        prop = inspect(self.model).relationships[relation]
+        serializer = serializer_for(nested.model, nested.fields)
+        if prop.secondary is None:
+            (_, parent_key), = prop.local_remote_pairs
+            statement = serializer.select(parent_key)
+        else:
+            (_, parent_key), = prop.synchronize_pairs
+            statement = (serializer.select(parent_key)
+                         .join(prop.secondary, prop.secondaryjoin))
+        if nested.model is Rule:
+            # Rules are read from the shard of their policy
+            shards = rule_shards()
+            groups = [(shards.bind_arguments(name), policy_ids)
+                      for name, policy_ids in shards.placements(db.session, ids).items()]
+        else:
+            groups = [({}, ids)]
+        return serializer, parent_key, statement, groups
+
+    def _collection_rows(self, relation: str, nested, ids: list) -> dict:
+        """Fetch the serialized collection of each entity in one SELECT ... IN."""
+        serializer, parent_key, statement, groups = self._collection_query(relation, nested, ids)
+        order = COLLECTION_ORDER.get((self.model, relation), (nested.model.id,))
+        statement = statement.order_by(*order)
+
+        collections = {entity_id: [] for entity_id in ids}
+        convert, key_index = serializer.convert, len(serializer.fields)
+        for bind_arguments, group in groups:
+            for row in db.session.execute(statement.where(parent_key.in_(group)),
+                                          bind_arguments=bind_arguments):
+                collections[row[key_index]].append(convert(row))
+        return collections
+
+    def _collection_streams(self, relation: str, nested, ids: list, yield_per: int) -> dict:
+        """Open a cursor over the collection of entities, ordered by entity.
+
+        Returns:
+            dict: The _CollectionStream handing out the rows of each entity, by entity ID.
+        """
+        serializer, parent_key, statement, groups = self._collection_query(relation, nested, ids)
+        order = COLLECTION_ORDER.get((self.model, relation), (nested.model.id,))
+        statement = (statement.order_by(parent_key, *order)
+                     .execution_options(yield_per=yield_per))
+        streams = {}
+        for bind_arguments, group in groups:
+            rows = db.session.execute(statement.where(parent_key.in_(group)),
+                                      bind_arguments=bind_arguments)
+            stream = _CollectionStream(rows, len(serializer.fields), serializer.convert)
+            streams.update(dict.fromkeys(group, stream))
+        return streams
+
+    def serialize_all(self, objs) -> list:
+        """Serialize entities loaded with the options of this projection.
+
+        Args:
+            objs (list): The entities to serialize.
+
+        Returns:
+            list: The requested fields and expanded collections of each entity.
+        """
+        ids = [obj.id for obj in objs]
+        collections = {relation: self._collection_rows(relation, nested, ids)
+                       for relation, nested in self.expand.items() if ids}
+        results = []
+        for obj in objs:
+            data = {}
+            for field in self.fields:
+                value = getattr(obj, field)
+                data[field] = value.value if isinstance(value, Enum) else value
+            for relation, rows in collections.items():
+                data[relation] = rows[obj.id]
+            results.append(data)
+        return results
+
+    def stream_all(self, objs, yield_per: int = 1000):
+        """Serialize entities like ``serialize_all``, reading their collections from cursors.
+
+        Each expanded collection is a JsonArray consumed while the response is
+        written. Rows are read in the order of the entity IDs: a page in that
+        order keeps at most ``yield_per`` rows in memory, another one buffers
+        the rows of the entities read ahead.
+
+        Args:
+            objs (list): The entities to serialize.
+            yield_per (int, optional): Rows fetched per round trip. Defaults to 1000.
+
+        Yields:
+            dict: The requested fields and expanded collections of each entity.
+        """
+        ids = [obj.id for obj in objs]
+        streams = {relation: self._collection_streams(relation, nested, ids, yield_per)
+                   for relation, nested in self.expand.items() if ids}
+        for obj in objs:
+            data = {}
+            for field in self.fields:
+                value = getattr(obj, field)
+                data[field] = value.value if isinstance(value, Enum) else value
+            for relation, by_id in streams.items():
+                data[relation] = JsonArray(by_id[obj.id].batches_of(obj.id), plain=True)
+            yield data
+
+    def serialize(self, obj) -> dict:
+        """Serialize one entity loaded with the options of this projection.
+
+        Args:
+            obj (obj): The entity to serialize.
+
+        Returns:
+            dict: The requested fields and expanded collections.
+        """
+        return self.serialize_all([obj])[0]
+
+
+class _CollectionStream:
+    """Rows of collections read from one cursor ordered by entity, handed out entity by entity.
+
+    Rows come in partitions of the cursor; the rows of an entity are found by
+    bisecting the keys of the partition. Rows of the entities met before the
+    requested one are kept until they are requested in turn.
+    """
+
+    def __init__(self, rows, key_index: int, convert):
+        self._partitions = rows.partitions()
+        self._key_index = key_index
+        self._convert = convert
+        self._ahead = {}
+        self._partition, self._keys, self._offset = [], [], 0
+
+    def batches_of(self, entity_id: int):
+        """Yield the serialized rows of an entity, in lists; each entity is requested once."""
+        ahead = self._ahead.pop(entity_id, None)
+        if ahead is not None:
+            yield ahead
+            return
+        convert = self._convert
+        while True:
+            if self._offset == len(self._partition):
+                self._partition = next(self._partitions, None)
+                if self._partition is None:
+                    self._partition, self._keys, self._offset = [], [], 0
+                    return
+                self._keys = [row[self._key_index] for row in self._partition]
+                self._offset = 0
+            partition, keys, offset = self._partition, self._keys, self._offset
+            start = bisect_left(keys, entity_id, offset)
+            end = bisect_right(keys, entity_id, start)
+            for row, key in zip(partition[offset:start], keys[offset:start]):
+                self._ahead.setdefault(key, []).append(convert(row))
+            if start < end:
+                yield [convert(row) for row in partition[start:end]]
+            self._offset = end
+            if end < len(partition):
+                return
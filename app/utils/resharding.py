@@ -0,0 +1,259 @@
+"This file contains the online moves of policies between rule shards"
+import logging
+from contextlib import ExitStack
+from sqlalchemy import bindparam, delete, false, func, insert, select, text, update
+from app.extensions import db
+from app.models import ChangeLog, Policy, Rule
+from app.shards import MAIN_SHARD, lock_placement, rule_shards
+from app.utils.streams import chunked
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Catch-up passes run before the final one, taken with the writers blocked
+CATCH_UP_PASSES = 5
+
+_RULES = Rule.__table__
+
+
+def _lock_shard(connection):
+    """Wait for the writers of a shard and block them until the end of the transaction."""
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(f"LOCK TABLE {_RULES.name} IN SHARE MODE"))
+    else:
+        # Any write takes the database lock of SQLite, even one matching no row
+        connection.execute(update(_RULES).where(false()).values(id=_RULES.c.id))
+
+
+def _join(stack: ExitStack, main, engine):
+    """Begin a transaction on an engine, or join the main one for the main database."""
+    if engine is main.engine:
+        return main
+    connection = stack.enter_context(engine.connect())
+    stack.enter_context(connection.begin())
+    return connection
+
+
+def _lock_source(stack: ExitStack, main, source_engine, policy_id: int, source: str):
+    """Lock the placement of a policy and block the writers of its shard.
+
+    The writers of a policy lock its placement first, then write its shard,
+    but commit both databases in any order: holding both locks, every change
+    logged so far is also in the shard.
+
+    Returns:
+        Connection: The connection of the source shard, in the locked transaction.
+
+    Raises:
+        LookupError: If the policy was deleted or moved meanwhile.
+    """
+    if lock_placement(main, policy_id) != source:
+        raise LookupError(f"Policy {policy_id} was deleted or moved meanwhile")
+    connection = _join(stack, main, source_engine)
+    if connection is not main:
+        _lock_shard(connection)
+    return connection
+
+
+def _barrier(main_engine, source_engine, policy_id: int, source: str) -> int:
+    """Return the last change sequence number, every change up to it being in the source."""
+    with main_engine.begin() as main, ExitStack() as stack:
+        _lock_source(stack, main, source_engine, policy_id, source)
+        return main.execute(select(func.max(ChangeLog.seq))).scalar() or 0
+
+
+def _changed_rules(main, policy_id: int, since: int) -> tuple:
+    """Return the IDs of the rules of a policy changed after a sequence number.
+
+    Returns:
+        tuple: The rule IDs, and whether the rules of the policy were reordered.
+    """
+    changed, reordered = set(), False
+    for entity, op, entity_id in main.execute(
+            select(ChangeLog.entity, ChangeLog.op, ChangeLog.entity_id)
+            .where(ChangeLog.seq > since, ChangeLog.policy_id == policy_id)):
+        if entity == 'rule':
+            changed.add(entity_id)
+        elif entity == 'policy' and op == 'reorder':
+            reordered = True
+    return changed, reordered
+
+
+def _copy_rules(source, target, rule_ids) -> int:
+    """Replace the copies of rules in the target shard, removing those deleted since."""
+    rows = [dict(row) for row in source.execute(
+        select(_RULES).where(_RULES.c.id.in_(rule_ids))).mappings()]
+    target.execute(delete(_RULES).where(_RULES.c.id.in_(rule_ids)))
+    if rows:
+        target.execute(insert(_RULES), rows)
+    return len(rows)
+
+
+def _sync_rules(source, target, policy_id: int, rule_ids, reordered: bool, batch_size: int):
+    """Bring the copies of changed rules up to date in the target shard."""
+    for chunk in chunked(sorted(rule_ids), batch_size):
+        _copy_rules(source, target, chunk)
+    if reordered:
+        keys = source.execute(select(_RULES.c.id, _RULES.c.position)
+                              .where(_RULES.c.policy_id == policy_id)).all()
+        for chunk in chunked(keys, batch_size):
+            target.execute(update(_RULES).where(_RULES.c.id == bindparam('rule_id'))
+                           .values(position=bindparam('key')),
+                           [{'rule_id': rule_id, 'key': key} for rule_id, key in chunk])
+
+
+def move_policy(policy_id: int, target: str, batch_size: int = 5000, progress=None) -> dict:
+    """Move the rules of a policy to another shard while it stays writable.
+
+    The rules are copied batch by batch, then the changes logged meanwhile
+    are applied in catch-up passes. The last pass blocks the writers of the
+    policy and of the source shard for the time of the last changes, and
+    switches the placement once the target has committed. The rules left in
+    the source shard are deleted last.
+
+    Args:
+        policy_id (int): The ID of the policy.
+        target (str): The name of the target shard, "main" for the main database.
+        batch_size (int, optional): Rules copied or deleted per transaction. Defaults to 5000.
+        progress (callable, optional): Called with the number of rules copied so far.
+
+    Returns:
+        dict: The source and target shards, and the number of rules moved.
+
+    Raises:
+        LookupError: If the policy does not exist.
+        ValueError: If the target shard is unknown.
+    """
+    shards = rule_shards()
+    target_engine = shards.engine(target)
+    main_engine = db.engine
+    with main_engine.connect() as main:
+        source = main.execute(select(Policy.shard).where(Policy.id == policy_id)).first()
+    if source is None:
+        raise LookupError(f"Policy {policy_id} not found")
+    source = source.shard or MAIN_SHARD
+    result = {'policy_id': policy_id, 'source': source, 'target': target, 'rules': 0}
+    if source == target:
+        return result
+    source_engine = shards.engine(source)
+
+    # Leftovers of an interrupted move would be taken for copies
+    with target_engine.begin() as target_connection:
+        target_connection.execute(delete(_RULES).where(_RULES.c.policy_id == policy_id))
+    since = _barrier(main_engine, source_engine, policy_id, source)
+    last_id, copied = 0, 0
+    while True:
+        with source_engine.connect() as source_connection, \
+                target_engine.begin() as target_connection:
+            rule_ids = source_connection.execute(
+                select(_RULES.c.id).where(_RULES.c.policy_id == policy_id, _RULES.c.id > last_id)
+                .order_by(_RULES.c.id).limit(batch_size)).scalars().all()
+            if not rule_ids:
+                break
+            copied += _copy_rules(source_connection, target_connection, rule_ids)
+        last_id = rule_ids[-1]
+        if progress is not None:
+            progress(copied)
+
+    for _ in range(CATCH_UP_PASSES):
+        cursor = _barrier(main_engine, source_engine, policy_id, source)
+        with main_engine.connect() as main:
+            changed, reordered = _changed_rules(main, policy_id, since)
+        if len(changed) < batch_size and not reordered:
+            break
+        with source_engine.connect() as source_connection, \
+                target_engine.begin() as target_connection:
+            _sync_rules(source_connection, target_connection, policy_id, changed, reordered,
+                        batch_size)
+        since = cursor
+
+    with main_engine.begin() as main, ExitStack() as stack:
+        source_connection = _lock_source(stack, main, source_engine, policy_id, source)
+        changed, reordered = _changed_rules(main, policy_id, since)
+        target_connection = _join(stack, main, target_engine)
+        _sync_rules(source_connection, target_connection, policy_id, changed, reordered,
+                    batch_size)
+        result['rules'] = target_connection.execute(
+            select(func.count()).select_from(_RULES)
+            .where(_RULES.c.policy_id == policy_id)).scalar()
+        if target_connection is not main:
+            # The target commits first: once the placement names it, it has every rule
+            target_connection.commit()
+        main.execute(update(Policy).where(Policy.id == policy_id)
+                     .values(shard=None if target == MAIN_SHARD else target))
+    logger.info(f"Moved the {result['rules']} rules of policy {policy_id} "
+                f"from {source} to {target}")
+
+    while True:
+        with source_engine.begin() as source_connection:
+            batch = select(_RULES.c.id).where(_RULES.c.policy_id == policy_id).limit(batch_size)
+            if not source_connection.execute(delete(_RULES).where(_RULES.c.id.in_(batch))).rowcount:
+                break
+    return result
+
+
+def shard_loads(session) -> dict:
+    """Return the number of rules of each policy, by shard.
+
+    Policies of the main database without rules are listed too, with 0 rules.
+    """
+    shards = rule_shards()
+    loads = {}
+    for name in shards.names():
+        loads[name] = dict(session.execute(
+            select(Rule.policy_id, func.count()).group_by(Rule.policy_id),
+            bind_arguments=shards.bind_arguments(name)).all())
+    for policy_id in session.execute(select(Policy.id).where(Policy.shard.is_(None))).scalars():
+        loads[MAIN_SHARD].setdefault(policy_id, 0)
+    return loads
+
+
+def plan_moves(loads: dict, targets: list) -> list:
+    """Plan the moves spreading the rules evenly over shards.
+
+    The policies of the databases that are not targets are moved first,
+    largest first, each to the least loaded target. Then, while a policy of
+    the most loaded shard is smaller than its gap with the least loaded one,
+    the policy closest to half the gap moves; each move lowers the spread.
+
+    Args:
+        loads (dict): The number of rules of each policy, by shard, see ``shard_loads``.
+        targets (list): The names of the shards to spread the rules over.
+
+    Returns:
+        list: The (policy ID, source, target, rules) moves, in order.
+    """
+    placed = {name: dict(loads.get(name, {})) for name in targets}
+    totals = {name: sum(policies.values()) for name, policies in placed.items()}
+    origins = {}
+    for name, policies in loads.items():
+        if name in targets:
+            continue
+        for policy_id, count in sorted(policies.items(), key=lambda item: (-item[1], item[0])):
+            emptiest = min(targets, key=totals.get)
+            placed[emptiest][policy_id] = count
+            totals[emptiest] += count
+            origins[policy_id] = name
+
+    while True:
+        fullest = max(targets, key=totals.get)
+        emptiest = min(targets, key=totals.get)
+        gap = totals[fullest] - totals[emptiest]
+        candidates = [(abs(gap - 2 * count), policy_id)
+                      for policy_id, count in placed[fullest].items() if 0 < count < gap]
+        if not candidates:
+            break
+        _, policy_id = min(candidates)
+        count = placed[fullest].pop(policy_id)
+        placed[emptiest][policy_id] = count
+        totals[fullest] -= count
+        totals[emptiest] += count
+        origins.setdefault(policy_id, fullest)
+
+    moves = []
+    for name, policies in placed.items():
+        for policy_id, count in policies.items():
+            origin = origins.get(policy_id, name)
+            if origin != name:
+                moves.append((policy_id, origin, name, count))
+    return sorted(moves, key=lambda move: (-move[3], move[0]))
@@ -0,0 +1,247 @@
+"This file contains the streamed and compressed JSON responses of the large listings"
+import zlib
+from functools import partial
+from itertools import chain
+from flask import current_app, request, stream_with_context
+from app.json_provider import OrjsonProvider
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_KEY = 'jouerflux.compression'
+
+# Content codings in the order of preference of RESPONSE_COMPRESSION
+ENCODINGS = ('zstd', 'br', 'gzip')
+
+# Levels trading ratio for speed, every chunk being compressed while the client waits
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+BROTLI_QUALITY = 4
+
+
+class JsonArray:
+    """A JSON array whose items are read while the document is written.
+
+    Items are any JSON value, or a dict holding other JsonArray values. A
+    ``plain`` array holds none of the latter and is given its items in lists,
+    each encoded at once.
+    """
+
+    def __init__(self, items, plain: bool = False):
+        self.items = items
+        self.plain = plain
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def _is_streamed(value) -> bool:
+    return isinstance(value, JsonArray) or (
+        isinstance(value, dict) and any(isinstance(item, JsonArray) for item in value.values()))
+
+
+def iter_json(value, dumps, sort_keys: bool = True, batch_size: int = 1000):
+    """Encode a JSON document piece by piece.
+
+    Plain items of a JsonArray are encoded ``batch_size`` at a time, in one
+    call to ``dumps`` whose brackets are stripped, so the document matches the
+    one ``dumps`` would write at once.
+
+    Args:
+        value (obj): The document, holding JsonArray values.
+        dumps (callable): Encodes a plain value, e.g. ``current_app.json.dumps``.
+        sort_keys (bool, optional): Write the keys of objects sorted. Defaults to True.
+        batch_size (int, optional): Plain items encoded at once. Defaults to 1000.
+
+    Yields:
+        str: The next piece of the document.
+    """
+    if not _is_streamed(value):
+        yield dumps(value)
+        return
+    if isinstance(value, dict):
+        yield '{'
+        for index, key in enumerate(sorted(value) if sort_keys else value):
+            yield (',' if index else '') + dumps(key) + ':'
+            yield from iter_json(value[key], dumps, sort_keys, batch_size)
+        yield '}'
+        return
+
+    yield '['
+    if value.plain:
+        separator = ''
+        for batch in value:
+            if batch:
+                yield separator + dumps(batch)[1:-1]
+                separator = ','
+        yield ']'
+        return
+    separator, batch = '', []
+    for item in value:
+        if not _is_streamed(item):
+            batch.append(item)
+            if len(batch) < batch_size:
+                continue
+        if batch:
+            yield separator + dumps(batch)[1:-1]
+            separator, batch = ',', []
+        if _is_streamed(item):
+            yield separator
+            separator = ','
+            yield from iter_json(item, dumps, sort_keys, batch_size)
+    if batch:
+        yield separator + dumps(batch)[1:-1]
+    yield ']'
+
+
+def buffered(pieces, size: int):
+    """Join small string pieces into chunks of about ``size`` characters."""
+    chunk, length = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+class GzipStream:
+    """gzip compressor flushing a block per chunk, so the client reads as it comes."""
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class ZstdStream:
+    """zstd compressor flushing a block per chunk."""
+
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return (self._compressor.compress(data)
+                + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliStream:
+    """Brotli compressor flushing a block per chunk."""
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+COMPRESSORS = {
+    'zstd': ZstdStream if zstandard is not None else None,
+    'br': BrotliStream if brotli is not None else None,
+    'gzip': GzipStream,
+}
+
+
+def init_compression(app) -> list:
+    """Select the content codings of RESPONSE_COMPRESSION that are installed.
+
+    Args:
+        app (Flask): The Flask application.
+
+    Returns:
+        list: The codings offered, by preference, also stored in ``app.extensions``.
+
+    Raises:
+        ValueError: If a coding is not supported.
+    """
+    offered = []
+    for name in (part.strip() for part in app.config['RESPONSE_COMPRESSION'].split(',')):
+        if not name:
+            continue
+        if name not in ENCODINGS:
+            raise ValueError(f"Invalid RESPONSE_COMPRESSION '{name}'. "
+                             f"Valid values are: {list(ENCODINGS)}")
+        if COMPRESSORS[name] is not None:
+            offered.append(name)
+    app.extensions[COMPRESSION_KEY] = offered
+    return offered
+
+
+def negotiate_encoding(accept_encodings, offered: list):
+    """Pick the content coding of a response from the Accept-Encoding of the request.
+
+    Args:
+        accept_encodings (Accept): The parsed header, ``request.accept_encodings``.
+        offered (list): The codings available, by preference.
+
+    Returns:
+        str: The coding accepted with the highest quality, ties going to the
+            preferred one; None to send the response uncompressed.
+    """
+    best, best_quality = None, 0
+    for name in offered:
+        quality = accept_encodings[name]
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def json_stream_response(document, status: int = 200):
+    """Stream a JSON document holding JsonArray values as a chunked response.
+
+    The body is encoded and compressed chunk by chunk, within the request
+    context, so that memory stays bounded by the chunk and cursor sizes.
+
+    Args:
+        document (dict): The document, see ``iter_json``.
+        status (int, optional): The HTTP status. Defaults to 200.
+
+    Returns:
+        Response: The streamed response, compressed if the client accepts it.
+    """
+    app = current_app
+    encoding = negotiate_encoding(request.accept_encodings, app.extensions[COMPRESSION_KEY])
+    chunk_size, batch_size = app.config['STREAM_CHUNK_SIZE'], app.config['LISTING_YIELD_PER']
+
+    dumps = app.json.dumps
+    if not isinstance(app.json, OrjsonProvider):
+        # Compact like the responses of jsonify
+        dumps = partial(dumps, separators=(',', ':'))
+
+    def generate():
+        pieces = chain(iter_json(document, dumps, getattr(app.json, 'sort_keys', True),
+                                 batch_size), ('\n',))
+        compressor = COMPRESSORS[encoding]() if encoding else None
+        for chunk in buffered(pieces, chunk_size):
+            data = chunk.encode()
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor is not None:
+            yield compressor.finish()
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return app.response_class(stream_with_context(generate()), status=status,
+                              mimetype=app.json.mimetype, headers=headers)
@@ -0,0 +1,364 @@
+"This file contains the compiled per-firewall rule index used to evaluate flows"
+import logging
+import socket
+import threading
+from itertools import chain
+from sqlalchemy import event, select
+from app.extensions import db
+from app.models import Firewall, Policy, Rule, firewall_policy
+from app.shards import MAIN_SHARD, rule_shards
+from app.utils.common import gc_paused
+from app.utils.schema import ActionEnum, ProtocolEnum
+from app.utils.serializers import serializer_for
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Verdict returned when no rule of the firewall matches the flow.
+DEFAULT_ACTION = ActionEnum.DENY
+
+
+def effective_rules_query(firewall_id: int, columns: bool = False):
+    """Build the query selecting every rule reachable from a firewall.
+
+    Rules are returned in evaluation order, the first matching rule winning:
+    policies in their order on the firewall, then rules in their order in the
+    policy (see app.utils.ordering), each read from its composite index.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+        columns (bool, optional): Select the serialized columns and the policy ID
+            as rows instead of Rule entities. Defaults to False.
+
+    Returns:
+        Select: The SQLAlchemy select statement.
+    """
+    statement = serializer_for(Rule).select(Rule.policy_id) if columns else select(Rule)
+    return (statement
+            .join(firewall_policy, firewall_policy.c.policy_id == Rule.policy_id)
+            .where(firewall_policy.c.firewall_id == firewall_id)
+            .order_by(firewall_policy.c.position, firewall_policy.c.policy_id,
+                      Rule.position, Rule.id))
+
+
+def effective_rule_rows(session, firewall_id: int, yield_per: int = None):
+    """Yield the rules reachable from a firewall, in evaluation order.
+
+    When the rules are sharded, the attached policies are read in their
+    order from the main database, then the rules of each policy from its
+    shard; otherwise a single ``effective_rules_query`` reads them all.
+
+    Args:
+        session (Session): The session to query.
+        firewall_id (int): The ID of the firewall.
+        yield_per (int, optional): Rows fetched per round trip, all at once when None.
+
+    Yields:
+        Row: The serialized columns of a rule, then its policy ID.
+    """
+    options = {} if yield_per is None else {'yield_per': yield_per}
+    shards = rule_shards()
+    if not shards.enabled:
+        yield from session.execute(effective_rules_query(firewall_id, columns=True)
+                                   .execution_options(**options))
+        return
+    policies = session.execute(
+        select(firewall_policy.c.policy_id, Policy.shard)
+        .join(Policy, Policy.id == firewall_policy.c.policy_id)
+        .where(firewall_policy.c.firewall_id == firewall_id)
+        .order_by(firewall_policy.c.position, firewall_policy.c.policy_id)).all()
+    statement = (serializer_for(Rule).select(Rule.policy_id)
+                 .order_by(Rule.position, Rule.id).execution_options(**options))
+    for policy_id, shard in policies:
+        yield from session.execute(statement.where(Rule.policy_id == policy_id),
+                                   bind_arguments=shards.bind_arguments(shard or MAIN_SHARD))
+
+
+def parse_prefix(value: str) -> tuple:
+    """Parse an address or a CIDR prefix.
+
+    Stored addresses are already normalized, so they are decoded with
+    ``inet_pton`` rather than the much slower ``ipaddress`` parser.
+
+    Args:
+        value (str): The address or prefix, e.g. "10.0.0.1" or "10.0.0.0/8".
+
+    Returns:
+        tuple: The IP version, the network address as an integer,
+            the prefix length and the address bit width.
+
+    Raises:
+        ValueError: If the value is not a valid address or prefix.
+    """
+    address, _, length = value.partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, address)
+    except OSError as e:
+        raise ValueError(f"'{value}' does not appear to be an IPv4 or IPv6 address") from e
+    bits = len(packed) * 8
+    length = int(length) if length else bits
+    if not 0 <= length <= bits:
+        raise ValueError(f"Invalid prefix length in '{value}'")
+    network = int.from_bytes(packed, 'big') >> (bits - length) << (bits - length)
+    return (4 if bits == 32 else 6), network, length, bits
+
+
+class PrefixTrie:
+    """Prefix trie flattened into one hash table per populated prefix length.
+
+    Only the levels that actually hold a prefix are stored, so a walk costs one
+    dict lookup per populated length, bounded by the address bit width.
+    """
+    __slots__ = ('bits', '_levels', '_lengths')
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self._levels = {}
+        self._lengths = ()
+
+    def setdefault(self, address: int, length: int, factory):
+        """Return the value stored on a prefix, creating it with factory if missing.
+
+        Args:
+            address (int): The network address of the prefix.
+            length (int): The prefix length.
+            factory (callable): Builds the value when the prefix is new.
+
+        Returns:
+            obj: The value stored on the prefix.
+        """
+        level = self._levels.get(length)
+        if level is None:
+            level = self._levels[length] = {}
+            self._lengths = tuple(sorted(self._levels))
+        key = address >> (self.bits - length)
+        value = level.get(key)
+        if value is None:
+            value = level[key] = factory()
+        return value
+
+    def walk(self, address: int):
+        """Yield the values of every prefix containing an address, shortest first.
+
+        Args:
+            address (int): The address as an integer.
+        """
+        for length in self._lengths:
+            value = self._levels[length].get(address >> (self.bits - length))
+            if value is not None:
+                yield value
+
+
+class _Slot:
+    """Holds the best (lowest) priority of the rules stored on a destination prefix."""
+    __slots__ = ('priority',)
+
+    def __init__(self):
+        self.priority = None
+
+
+class _RangeSlot:
+    """Holds the port ranges stored on a destination prefix, in evaluation order."""
+    __slots__ = ('ranges',)
+
+    def __init__(self):
+        self.ranges = []
+
+    def first(self, port: int):
+        """Return the priority of the first range containing a port, or None."""
+        for priority, start, end in self.ranges:
+            if start <= port <= end:
+                return priority
+        return None
+
+
+# Port key of the buckets holding port ranges instead of single ports
+PORT_RANGE = 'range'
+
+
+class CompiledRuleset:
+    """In-memory index of the rules of a firewall.
+
+    Rules are bucketed by protocol, port and address families; each bucket is a
+    source prefix trie whose nodes hold destination prefix tries. A lookup walks
+    at most two address lengths instead of scanning every rule.
+    """
+
+    def __init__(self, firewall_id: int, policy_ids, rules: list, version=None):
+        self.firewall_id = firewall_id
+        self.version = version
+        self.policy_ids = frozenset(policy_ids)
+        self.rules = rules
+        self._buckets = {}
+        with gc_paused():
+            for priority, rule in enumerate(rules):
+                self._insert(priority, rule)
+
+    def _insert(self, priority: int, rule: dict):
+        src_version, src, src_len, src_bits = parse_prefix(rule['source_ip'])
+        dst_version, dst, dst_len, dst_bits = parse_prefix(rule['destination_ip'])
+        port_range = rule.get('port_end') is not None
+        key = (rule['protocol'], PORT_RANGE if port_range else rule['port'],
+               src_version, dst_version)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = PrefixTrie(src_bits)
+        dst_trie = bucket.setdefault(src, src_len, lambda: PrefixTrie(dst_bits))
+        if port_range:
+            dst_trie.setdefault(dst, dst_len, _RangeSlot).ranges.append(
+                (priority, rule['port'], rule['port_end']))
+            return
+        slot = dst_trie.setdefault(dst, dst_len, _Slot)
+        # Rules are inserted in evaluation order, later duplicates never win
+        if slot.priority is None:
+            slot.priority = priority
+
+    def __len__(self):
+        return len(self.rules)
+
+    def lookup(self, protocol: str, source, destination, port: int | None = None):
+        """Find the first rule matching a flow.
+
+        Args:
+            protocol (str): The protocol of the flow.
+            source (IPv4Address | IPv6Address): The source address.
+            destination (IPv4Address | IPv6Address): The destination address.
+            port (int, optional): The destination port. Defaults to None.
+
+        Returns:
+            dict: The matching rule, or None if no rule matches.
+        """
+        keys = {(protocol, port), (protocol, None), (ProtocolEnum.ALL.value, None)}
+        if port is not None:
+            keys.add((protocol, PORT_RANGE))
+        src, dst = int(source), int(destination)
+        best = None
+        for proto, rule_port in keys:
+            bucket = self._buckets.get((proto, rule_port, source.version, destination.version))
+            if bucket is None:
+                continue
+            for dst_trie in bucket.walk(src):
+                for slot in dst_trie.walk(dst):
+                    priority = slot.first(port) if rule_port == PORT_RANGE else slot.priority
+                    if priority is not None and (best is None or priority < best):
+                        best = priority
+        return None if best is None else self.rules[best]
+
+
+def compile_ruleset(firewall_id: int):
+    """Load the rules of a firewall and compile them into a lookup index.
+
+    Args:
+        firewall_id (int): The ID of the firewall.
+
+    Returns:
+        CompiledRuleset: The compiled index, or None if the firewall does not exist.
+    """
+    # Read before the rules, a concurrent change can only make the index look older
+    version = db.session.execute(
+        select(Firewall.version).where(Firewall.id == firewall_id)).scalar()
+    if version is None:
+        return None
+    policy_ids = db.session.execute(
+        select(firewall_policy.c.policy_id)
+        .where(firewall_policy.c.firewall_id == firewall_id)
+    ).scalars().all()
+    rules = []
+    convert = serializer_for(Rule).convert
+    for row in effective_rule_rows(db.session, firewall_id):
+        entry = convert(row)
+        entry['policy_id'] = row.policy_id
+        rules.append(entry)
+    logger.info(f"Compiled {len(rules)} rules for firewall {firewall_id}")
+    return CompiledRuleset(firewall_id, policy_ids, rules, version=version)
+
+
+class RulesetCache:
+    """Thread-safe cache of compiled rulesets, keyed by firewall ID.
+
+    Local invalidation only reaches the current process; entries are also
+    checked against the firewall version, so changes committed by other worker
+    processes are picked up at the cost of one primary key lookup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = 0
+
+    def get(self, firewall_id: int):
+        """Return the compiled ruleset of a firewall, compiling it on a miss.
+
+        Args:
+            firewall_id (int): The ID of the firewall.
+
+        Returns:
+            CompiledRuleset: The compiled index, or None if the firewall does not exist.
+        """
+        with self._lock:
+            compiled = self._entries.get(firewall_id)
+            generation = self._generation
+        if compiled is not None:
+            version = db.session.execute(
+                select(Firewall.version).where(Firewall.id == firewall_id)).scalar()
+            if version == compiled.version:
+                return compiled
+
+        compiled = compile_ruleset(firewall_id)
+        if compiled is not None:
+            with self._lock:
+                # Do not cache a ruleset compiled while an invalidation happened
+                if generation == self._generation:
+                    self._entries[firewall_id] = compiled
+        return compiled
+
+    def invalidate(self, firewall_ids=(), policy_ids=()):
+        """Drop the rulesets depending on the given firewalls or policies.
+
+        Args:
+            firewall_ids (iterable, optional): IDs of changed firewalls.
+            policy_ids (iterable, optional): IDs of changed policies.
+        """
+        firewall_ids, policy_ids = set(firewall_ids), set(policy_ids)
+        with self._lock:
+            self._generation += 1
+            for key, compiled in list(self._entries.items()):
+                if key in firewall_ids or not compiled.policy_ids.isdisjoint(policy_ids):
+                    del self._entries[key]
+
+    def clear(self):
+        """Drop every cached ruleset."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+ruleset_cache = RulesetCache()
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_ruleset_changes(session, flush_context):
+    """Record the firewalls and policies touched by a flush."""
+    firewall_ids, policy_ids = session.info.setdefault('ruleset_changes', (set(), set()))
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Rule):
+            policy_ids.add(obj.policy_id)
+        elif isinstance(obj, Policy):
+            policy_ids.add(obj.id)
+        elif isinstance(obj, Firewall):
+            firewall_ids.add(obj.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_committed_changes(session):
+    """Invalidate the cached rulesets once the changes are committed."""
+    changes = session.info.pop('ruleset_changes', None)
+    if changes:
+        ruleset_cache.invalidate(*changes)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_rolled_back_changes(session):
+    """Forget the changes of a rolled back transaction."""
+    session.info.pop('ruleset_changes', None)
@@ -1,7 +1,8 @@
 "This file contains the Pydantic models for firewall rules in a Flask application"
 from enum import Enum
 from typing import Annotated
-from pydantic import BaseModel, IPvAnyAddress, field_validator, StringConstraints
+from pydantic import (BaseModel, Field, IPvAnyAddress, IPvAnyNetwork, TypeAdapter,
+                      field_validator, model_validator, StringConstraints)
 
 class ActionEnum(str, Enum):
     """Enumeration for action types in firewall rules."""
@@ -18,28 +19,72 @@ class ProtocolEnum(str, Enum):
     AH = 'AH'
     ALL = 'ALL'
 
+def check_port(proto, value):
+    """Check that a port is consistent with its protocol.
+
+    Args:
+        proto (ProtocolEnum): The protocol, None if it failed validation.
+        value (int): The port to check.
+
+    Returns:
+        int: The validated port.
+
+    Raises:
+        ValueError: If the port does not match the protocol.
+    """
+    if proto in {ProtocolEnum.TCP, ProtocolEnum.UDP}:
+        # Port must be specified for TCP/UDP protocols
+        if value is None or not 0 <= value <= 65535:
+            raise ValueError('Port must be specified for TCP/UDP protocols')
+
+    elif value is not None:
+        raise ValueError('Port must be None for non-TCP/UDP protocols')
+
+    return value
+
 class RuleCheck(BaseModel):
     """Pydantic model for firewall rules."""
     action: ActionEnum
     protocol: ProtocolEnum
-    source_ip: IPvAnyAddress
-    destination_ip: IPvAnyAddress
+    source_ip: IPvAnyNetwork
+    destination_ip: IPvAnyNetwork
     port: int | None = None
+    port_end: int | None = None
 
     @field_validator('port')
     @classmethod
     def validate_port(cls, value, info):
         """Validate that the port is within the valid range."""
-        proto = info.data.get('protocol')
-        if proto in {ProtocolEnum.TCP, ProtocolEnum.UDP}:
-            # Port must be specified for TCP/UDP protocols
-            if value is None or not 0 <= value <= 65535:
-                raise ValueError('Port must be specified for TCP/UDP protocols')
+        return check_port(info.data.get('protocol'), value)
+
+    @field_validator('port_end')
+    @classmethod
+    def validate_port_end(cls, value, info):
+        """Validate that the port range ends after its first port."""
+        if value is None:
+            return value
+        port = info.data.get('port')
+        if port is None or not port <= value <= 65535:
+            raise ValueError('Port range must end between port and 65535')
+        # A one-port range is stored as a single port
+        return None if value == port else value
 
-        elif value is not None:
-            raise ValueError('Port must be None for non-TCP/UDP protocols')
+# Validates a whole batch of rules in one call
+RuleListCheck = TypeAdapter(list[RuleCheck])
 
-        return value
+class FlowCheck(BaseModel):
+    """Pydantic model for a flow evaluated against a firewall."""
+    protocol: ProtocolEnum
+    source_ip: IPvAnyAddress
+    destination_ip: IPvAnyAddress
+    # Validated when omitted too: a TCP/UDP flow always has a port
+    port: int | None = Field(default=None, validate_default=True)
+
+    @field_validator('port')
+    @classmethod
+    def validate_port(cls, value, info):
+        """Validate that the port is within the valid range."""
+        return check_port(info.data.get('protocol'), value)
 
 NamePattern = Annotated[str, StringConstraints(min_length=1,
                                                max_length=100,
@@ -55,3 +100,51 @@ class NameCheck(BaseModel):
         if not value:
             raise ValueError('Name cannot be empty')
         return value
+
+class PairSetCheck(BaseModel):
+    """Pydantic model for a set of firewall/policy pairs.
+
+    Either explicit ``pairs`` of firewall and policy IDs, or the cartesian
+    product of ``firewall_ids`` and ``policy_ids``.
+    """
+    pairs: list[tuple[int, int]] | None = None
+    firewall_ids: list[int] | None = None
+    policy_ids: list[int] | None = None
+
+    @model_validator(mode='after')
+    def validate_spec(self):
+        """Validate that exactly one of the two forms is given."""
+        cartesian = self.firewall_ids is not None or self.policy_ids is not None
+        if (self.pairs is None) == (not cartesian):
+            raise ValueError('Give either pairs, or firewall_ids and policy_ids')
+        if cartesian and (self.firewall_ids is None or self.policy_ids is None):
+            raise ValueError('A cartesian spec needs both firewall_ids and policy_ids')
+        return self
+
+class BulkAssociationCheck(BaseModel):
+    """Pydantic model for a bulk attach/detach of policies and firewalls."""
+    attach: PairSetCheck | None = None
+    detach: PairSetCheck | None = None
+
+    @model_validator(mode='after')
+    def validate_operations(self):
+        """Validate that there is something to do."""
+        if self.attach is None and self.detach is None:
+            raise ValueError('Give attach, detach or both')
+        return self
+
+class OrderCheck(BaseModel):
+    """Pydantic model for the place of an inserted or moved rule or policy.
+
+    ``before`` or ``after`` names the neighbour, in the same policy or
+    firewall; without them the item goes last.
+    """
+    before: int | None = None
+    after: int | None = None
+
+    @model_validator(mode='after')
+    def validate_anchor(self):
+        """Validate that at most one neighbour is given."""
+        if self.before is not None and self.after is not None:
+            raise ValueError('Give either before or after')
+        return self
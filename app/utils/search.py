@@ -0,0 +1,142 @@
+"This file contains the indexed name search of firewalls and policies"
+import logging
+from flask import current_app
+from sqlalchemy import and_, column, event, select, table, text
+from app.extensions import db
+from app.models import Firewall, Policy
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+NAME_MATCHES = ('contains', 'prefix')
+
+# Trigram indexes cannot match shorter terms
+TRIGRAM_MIN_LENGTH = 3
+
+SEARCHABLE_MODELS = (Firewall, Policy)
+
+# Whether the name index exists, per database URL and table
+_index_available = {}
+
+
+def fts_table(model) -> str:
+    """Return the name of the FTS5 index of a model."""
+    return f"{model.__tablename__}_name_fts"
+
+
+def _sqlite_statements(name: str) -> list:
+    index = f"{name}_name_fts"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5("
+        f"name, content='{name}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {name} BEGIN "
+        f"INSERT INTO {index}(rowid, name) VALUES (new.id, new.name); END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {name} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, name) VALUES ('delete', old.id, old.name); END",
+        # Version bumps do not touch the name and skip the index
+        f"CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF name ON {name} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, name) VALUES ('delete', old.id, old.name); "
+        f"INSERT INTO {index}(rowid, name) VALUES (new.id, new.name); END",
+    ]
+
+
+def _postgresql_statements(name: str) -> list:
+    return [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        f"CREATE INDEX IF NOT EXISTS ix_{name}_name_trgm ON {name} USING gin (name gin_trgm_ops)",
+    ]
+
+
+def install_name_index(connection, model, rebuild: bool = False) -> bool:
+    """Create the name search index of a model, if the database supports one.
+
+    SQLite gets an external-content FTS5 trigram table kept in sync by
+    triggers; PostgreSQL gets a pg_trgm GIN index, which ILIKE uses directly.
+
+    Args:
+        connection (Connection): The connection to write with.
+        model (obj): Firewall or Policy.
+        rebuild (bool, optional): Re-index the existing rows. Defaults to False.
+
+    Returns:
+        bool: Whether the database has a name index.
+    """
+    name = model.__tablename__
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        statements = _sqlite_statements(name)
+        if rebuild:
+            statements.append(f"INSERT INTO {name}_name_fts({name}_name_fts) VALUES ('rebuild')")
+    elif dialect == 'postgresql':
+        statements = _postgresql_statements(name)
+    else:
+        return False
+    for statement in statements:
+        connection.execute(text(statement))
+    _index_available.clear()
+    return True
+
+
+def _after_create(target, connection, **kwargs):
+    model = next(model for model in SEARCHABLE_MODELS if model.__table__ is target)
+    install_name_index(connection, model)
+
+
+def _before_drop(target, connection, **kwargs):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text(f"DROP TABLE IF EXISTS {target.name}_name_fts"))
+    _index_available.clear()
+
+
+for _model in SEARCHABLE_MODELS:
+    event.listen(_model.__table__, 'after_create', _after_create)
+    event.listen(_model.__table__, 'before_drop', _before_drop)
+
+
+def _has_fts_index(model) -> bool:
+    key = (db.engine.url.render_as_string(), model.__tablename__)
+    available = _index_available.get(key)
+    if available is None:
+        available = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': fts_table(model)}
+        ).first() is not None
+        _index_available[key] = available
+        if not available:
+            logger.warning(f"No {fts_table(model)} index, name searches scan the table; "
+                           f"run 'flask search rebuild' to create it")
+    return available
+
+
+def name_filter(model, name: str, match: str = 'contains'):
+    """Build the filter of the ``name`` search parameter.
+
+    Prefix searches are a range on the unique B-tree index of the name.
+    Substring searches use the FTS5 trigram index on SQLite and the pg_trgm
+    index on PostgreSQL; shorter terms and other databases scan the table.
+
+    Args:
+        model (obj): Firewall or Policy.
+        name (str): The searched name, or part of it.
+        match (str, optional): "contains" or "prefix". Defaults to "contains".
+
+    Returns:
+        ColumnElement: The filter condition.
+
+    Raises:
+        ValueError: If the match mode is not supported.
+    """
+    if match not in NAME_MATCHES:
+        raise ValueError(f"Invalid match '{match}'. Valid values are: {list(NAME_MATCHES)}")
+    if match == 'prefix':
+        # The smallest string greater than every name starting with the prefix
+        upper = name[:-1] + chr(ord(name[-1]) + 1)
+        return and_(model.name >= name, model.name < upper)
+
+    if (current_app.config['SEARCH_BACKEND'] == 'auto' and len(name) >= TRIGRAM_MIN_LENGTH
+            and db.session.get_bind().dialect.name == 'sqlite' and _has_fts_index(model)):
+        index = table(fts_table(model), column('rowid'))
+        phrase = '"' + name.replace('"', '""') + '"'
+        return model.id.in_(select(index.c.rowid)
+                            .where(text(f"{fts_table(model)} MATCH :phrase").bindparams(phrase=phrase)))
+    return model.name.ilike(f"%{name}%")
@@ -0,0 +1,104 @@
+"This file contains the row serializers generated from the column metadata of the models"
+from functools import lru_cache
+from sqlalchemy import Enum as EnumType, inspect, select
+from app.models import ChangeLog, Firewall, Policy, Rule
+
+# Fields exposed by the API for each model, in serialization order
+SERIALIZED_FIELDS = {
+    Firewall: ('id', 'name'),
+    Policy: ('id', 'name'),
+    Rule: ('id', 'action', 'source_ip', 'destination_ip', 'protocol', 'port',
+           'port_end', 'position'),
+    ChangeLog: ('seq', 'entity', 'op', 'entity_id', 'firewall_id', 'policy_id', 'payload',
+                'created_at'),
+}
+
+
+def _converter(fields: tuple, enums: tuple):
+    """Build the function converting a row into the dict of its fields.
+
+    Args:
+        fields (tuple): The field names, in the order of the row.
+        enums (tuple): The (index, field) pairs of the enum columns.
+
+    Returns:
+        callable: The conversion function.
+    """
+    if not enums:
+        return lambda row: dict(zip(fields, row))
+
+    def convert(row):
+        item = dict(zip(fields, row))
+        for index, field in enums:
+            value = row[index]
+            if value is not None:
+                item[field] = value.value
+        return item
+    return convert
+
+
+class RowSerializer:
+    """Serialize result rows of selected columns into API dicts.
+
+    The conversion function is built once from the column types: enum
+    columns are rendered as their value and the other columns are copied, so
+    rows go straight from the result tuple to the response without ORM
+    entities. Columns selected after the serialized fields (e.g. a grouping
+    key) are ignored.
+    """
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = tuple(fields)
+        mapper_columns = inspect(model).columns
+        self.columns = [getattr(model, field) for field in self.fields]
+
+        enums = tuple((index, field) for index, field in enumerate(self.fields)
+                      if isinstance(mapper_columns[field].type, EnumType)
+                      and mapper_columns[field].type.enum_class is not None)
+        self.convert = _converter(self.fields, enums)
+
+    def select(self, *extra):
+        """Build a SELECT of the serialized columns, followed by ``extra`` columns.
+
+        Returns:
+            Select: The SQLAlchemy select statement.
+        """
+        return select(*self.columns, *extra)
+
+    def row(self, row) -> dict:
+        """Serialize one result row.
+
+        Args:
+            row (tuple): The row, starting with the serialized columns.
+
+        Returns:
+            dict: The serialized fields.
+        """
+        return self.convert(row)
+
+    def rows(self, rows) -> list:
+        """Serialize result rows.
+
+        Args:
+            rows (iterable): The rows, e.g. a ``Result``.
+
+        Returns:
+            list: The serialized fields of each row.
+        """
+        return list(map(self.convert, rows))
+
+
+@lru_cache(maxsize=None)
+def serializer_for(model, fields=None) -> RowSerializer:
+    """Return the cached serializer of a model.
+
+    Args:
+        model (obj): The SQLAlchemy model.
+        fields (tuple, optional): The serialized fields, in order. Defaults to
+            SERIALIZED_FIELDS of the model.
+
+    Returns:
+        RowSerializer: The serializer.
+    """
+    return RowSerializer(model, SERIALIZED_FIELDS[model] if fields is None else fields)
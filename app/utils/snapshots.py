@@ -0,0 +1,201 @@
+"This file contains the content-addressed snapshots of the effective rulesets"
+import hashlib
+import json
+import struct
+from sqlalchemy import insert, select
+from app.models import Firewall, Rule, RuleContent, RulesetContent, RulesetSnapshot
+from app.utils.associations import UPSERT_INSERTS
+from app.utils.ruleset import effective_rule_rows
+from app.utils.serializers import serializer_for
+from app.utils.streams import chunked
+
+DIGEST_SIZE = 16
+_DIGEST_FORMAT = struct.Struct(f'{DIGEST_SIZE}s')
+
+# Digests looked up or written per statement
+DIGESTS_PER_STATEMENT = 5000
+
+# Fields of a frozen rule, in canonical order. The rule ID is left out: a rule
+# deleted and created again with the same content is unchanged.
+CONTENT_FIELDS = ('policy_id', 'action', 'protocol', 'source_ip', 'destination_ip',
+                  'port', 'port_end')
+
+
+def content_digest(content: dict) -> bytes:
+    """Return the digest addressing the content of a rule.
+
+    Args:
+        content (dict): The CONTENT_FIELDS of the rule.
+
+    Returns:
+        bytes: The 16-byte BLAKE2b digest of its canonical encoding.
+    """
+    canonical = json.dumps([content[field] for field in CONTENT_FIELDS], separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode(), digest_size=DIGEST_SIZE).digest()
+
+
+def split_digests(rules: bytes) -> list:
+    """Split the packed rule digests of a ruleset content."""
+    # Unpacked in C, about twice as fast as slicing for large rulesets
+    return [digest for (digest,) in _DIGEST_FORMAT.iter_unpack(rules)]
+
+
+def _insert_missing(connection, model, rows: list):
+    """Insert the rows whose digest is not stored yet."""
+    upsert = UPSERT_INSERTS.get(connection.dialect.name)
+    for chunk in chunked(rows, DIGESTS_PER_STATEMENT):
+        if upsert is not None:
+            connection.execute(upsert(model).on_conflict_do_nothing(), chunk)
+            continue
+        existing = set(connection.execute(select(model.digest).where(
+            model.digest.in_([row['digest'] for row in chunk]))).scalars())
+        chunk = [row for row in chunk if row['digest'] not in existing]
+        if chunk:
+            connection.execute(insert(model), chunk)
+
+
+def take_snapshot(session, firewall_id: int):
+    """Freeze the effective ruleset of a firewall.
+
+    Each distinct rule content is stored once across all snapshots, and so is
+    each distinct ruleset: a snapshot of an unchanged ruleset only adds its
+    own row.
+
+    Args:
+        session (Session): The session holding the transaction.
+        firewall_id (int): The ID of the firewall.
+
+    Returns:
+        tuple: The new RulesetSnapshot, None if the firewall does not exist,
+            and whether its content was already stored.
+    """
+    version = session.execute(select(Firewall.version).where(Firewall.id == firewall_id)).scalar()
+    if version is None:
+        return None, False
+    serializer = serializer_for(Rule)
+    contents = {}
+    digests = []
+    for row in effective_rule_rows(session, firewall_id):
+        rule = serializer.row(row)
+        rule['policy_id'] = row.policy_id
+        content = {field: rule[field] for field in CONTENT_FIELDS}
+        digest = content_digest(content)
+        contents.setdefault(digest, content)
+        digests.append(digest)
+
+    rules = b''.join(digests)
+    digest = hashlib.blake2b(rules, digest_size=DIGEST_SIZE).digest()
+    connection = session.connection()
+    stored = connection.execute(
+        select(RulesetContent.digest).where(RulesetContent.digest == digest)).first() is not None
+    if not stored:
+        # Rule contents are written first: a stored ruleset has all of its rules
+        _insert_missing(connection, RuleContent, [{'digest': rule_digest, 'content': content}
+                                                  for rule_digest, content in contents.items()])
+        _insert_missing(connection, RulesetContent, [{'digest': digest, 'rule_count': len(digests),
+                                                      'rules': rules}])
+    snapshot = RulesetSnapshot(firewall_id=firewall_id, firewall_version=version, digest=digest)
+    session.add(snapshot)
+    return snapshot, stored
+
+
+def snapshot_dict(snapshot: RulesetSnapshot, rule_count: int) -> dict:
+    """Serialize the metadata of a snapshot."""
+    return {
+        'id': snapshot.id,
+        'firewall_id': snapshot.firewall_id,
+        'firewall_version': snapshot.firewall_version,
+        'digest': snapshot.digest.hex(),
+        'rule_count': rule_count,
+        'created_at': snapshot.created_at,
+    }
+
+
+def ruleset_rules(session, digest: bytes) -> bytes:
+    """Return the packed rule digests of a stored ruleset, in evaluation order."""
+    return session.execute(
+        select(RulesetContent.rules).where(RulesetContent.digest == digest)).scalar_one()
+
+
+def missing_positions(rules: bytes, reference: bytes) -> list:
+    """Return the positions of the digests of ``rules`` absent from ``reference``.
+
+    Both packed lists are read as pairs of 64-bit integers and sorted on
+    their first half; the looked up digests are then found with a binary
+    search in sorted order, which keeps the memory accesses sequential, and
+    their second half compared, without building Python objects per rule.
+    Digests sharing their first half with another one are checked exactly.
+
+    Args:
+        rules (bytes): The packed digests looked up.
+        reference (bytes): The packed digests looked up in.
+
+    Returns:
+        list: The positions in ``rules``, in increasing order.
+    """
+    # NumPy is imported on the first diff only, it weighs on every cold start
+    import numpy as np
+    looked_up = np.frombuffer(rules, dtype='<u8').reshape(-1, 2)
+    if not len(reference):
+        return list(range(len(looked_up)))
+    halves = np.frombuffer(reference, dtype='<u8').reshape(-1, 2)
+    halves = halves[np.argsort(halves[:, 0])]
+    order = np.argsort(looked_up[:, 0])
+    queries = looked_up[order]
+    found = np.searchsorted(halves[:, 0], queries[:, 0]).clip(max=len(halves) - 1)
+    same_first = halves[found, 0] == queries[:, 0]
+    absent = ~(same_first & (halves[found, 1] == queries[:, 1]))
+    missing = np.zeros(len(looked_up), dtype=bool)
+    missing[order[absent]] = True
+    ambiguous = order[absent & same_first]
+    if len(ambiguous):
+        exact = set(split_digests(reference))
+        for position in ambiguous:
+            start = int(position) * DIGEST_SIZE
+            missing[position] = rules[start:start + DIGEST_SIZE] not in exact
+    return np.flatnonzero(missing).tolist()
+
+
+def load_contents(session, digests) -> dict:
+    """Return the rule contents of digests, by digest."""
+    contents = {}
+    for chunk in chunked(sorted(set(digests)), DIGESTS_PER_STATEMENT):
+        contents.update(session.execute(select(RuleContent.digest, RuleContent.content)
+                                        .where(RuleContent.digest.in_(chunk))).all())
+    return contents
+
+
+def diff_snapshots(session, base: RulesetSnapshot, head: RulesetSnapshot) -> dict:
+    """Compute the rules added and removed between two snapshots.
+
+    The packed digests of both rulesets are compared as sets (see
+    ``missing_positions``), so only the contents of the changed rules are
+    read. Identical rulesets share their digest and are not compared.
+
+    Args:
+        session (Session): The session to query.
+        base (RulesetSnapshot): The older snapshot.
+        head (RulesetSnapshot): The newer snapshot.
+
+    Returns:
+        dict: The added and removed rules in evaluation order, and the
+            number of rules of the head snapshot present in the base one.
+    """
+    if base.digest == head.digest:
+        rule_count = session.execute(select(RulesetContent.rule_count)
+                                     .where(RulesetContent.digest == head.digest)).scalar_one()
+        return {'added': [], 'removed': [], 'unchanged': rule_count}
+    before = ruleset_rules(session, base.digest)
+    after = ruleset_rules(session, head.digest)
+    added_positions = missing_positions(after, before)
+    removed_positions = missing_positions(before, after)
+    added = list(dict.fromkeys(after[position * DIGEST_SIZE:(position + 1) * DIGEST_SIZE]
+                               for position in added_positions))
+    removed = list(dict.fromkeys(before[position * DIGEST_SIZE:(position + 1) * DIGEST_SIZE]
+                                 for position in removed_positions))
+    contents = load_contents(session, added + removed)
+    return {
+        'added': [contents[digest] for digest in added],
+        'removed': [contents[digest] for digest in removed],
+        'unchanged': len(after) // DIGEST_SIZE - len(added_positions),
+    }
@@ -0,0 +1,83 @@
+"This file contains helpers to read NDJSON and CSV request bodies as streams"
+import csv
+import io
+import json
+from itertools import islice
+
+STREAM_FORMATS = ('ndjson', 'csv')
+
+READ_BUFFER_SIZE = 64 * 1024
+
+
+def stream_format(request) -> str:
+    """Detect the format of a streamed request body.
+
+    The ``format`` query parameter wins over the Content-Type header.
+
+    Args:
+        request (Request): The Flask request.
+
+    Returns:
+        str: Either "ndjson" or "csv".
+
+    Raises:
+        ValueError: If the requested format is not supported.
+    """
+    fmt = request.args.get('format', default=None, type=str)
+    if fmt is None:
+        fmt = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    if fmt not in STREAM_FORMATS:
+        raise ValueError(f"Invalid format '{fmt}'. Valid values are: {list(STREAM_FORMATS)}")
+    return fmt
+
+
+def iter_records(stream, fmt: str):
+    """Iterate over the records of an NDJSON or CSV stream without buffering it.
+
+    Blank lines are skipped. A line that cannot be decoded yields the error
+    message instead of a record, so callers can report it and carry on.
+
+    Args:
+        stream (file): The binary stream to read, e.g. ``request.stream``.
+        fmt (str): Either "ndjson" or "csv".
+
+    Yields:
+        tuple: The record (dict, or None on error) and the error message (str or None).
+    """
+    if isinstance(stream, io.RawIOBase):
+        # Raw WSGI streams read lines byte by byte, buffer them
+        stream = io.BufferedReader(stream, buffer_size=READ_BUFFER_SIZE)
+    lines = (line.decode('utf-8', errors='replace') for line in stream)
+    if fmt == 'csv':
+        for row in csv.DictReader(lines):
+            yield {key: (value if value != '' else None)
+                   for key, value in row.items()}, None
+        return
+
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield None, "Invalid JSON: expected an object"
+            continue
+        yield record, None
+
+
+def chunked(iterable, size: int):
+    """Split an iterable into lists of at most size items.
+
+    Args:
+        iterable (iterable): The items to split.
+        size (int): The maximum size of a chunk.
+
+    Yields:
+        list: The next chunk.
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -0,0 +1,98 @@
+"This file contains the version counters of firewalls and policies used for ETags"
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm.util import identity_key
+from app.extensions import db
+from app.models import Firewall, Policy, Rule, firewall_policy
+
+
+def bump_versions(session, firewall_ids=(), policy_ids=()):
+    """Increment the versions of firewalls and policies in the current transaction.
+
+    The firewalls attached to a bumped policy are bumped too, since their
+    ruleset depends on it. Core statements bypassing the ORM (bulk inserts or
+    deletes of rules) must call this explicitly.
+
+    Args:
+        session (Session): The session holding the transaction.
+        firewall_ids (iterable, optional): IDs of changed firewalls.
+        policy_ids (iterable, optional): IDs of changed policies.
+    """
+    firewall_ids = {firewall_id for firewall_id in firewall_ids if firewall_id is not None}
+    policy_ids = {policy_id for policy_id in policy_ids if policy_id is not None}
+    if not firewall_ids and not policy_ids:
+        return
+    connection = session.connection()
+    if policy_ids:
+        firewall_ids.update(connection.execute(
+            select(firewall_policy.c.firewall_id)
+            .where(firewall_policy.c.policy_id.in_(policy_ids))
+        ).scalars())
+        connection.execute(update(Policy).where(Policy.id.in_(policy_ids))
+                           .values(version=Policy.version + 1))
+    if firewall_ids:
+        connection.execute(update(Firewall).where(Firewall.id.in_(firewall_ids))
+                           .values(version=Firewall.version + 1))
+
+    # Loaded instances must read the new versions from the database
+    for model, ids in ((Policy, policy_ids), (Firewall, firewall_ids)):
+        for entity_id in ids:
+            obj = session.identity_map.get(identity_key(model, entity_id))
+            if obj is not None:
+                session.expire(obj, ['version'])
+
+
+def _history_ids(obj, relation: str) -> set:
+    """IDs of the entities added to or removed from a collection since the last flush."""
+    history = inspect(obj).attrs[relation].history
+    return {item.id for item in history.added + history.deleted}
+
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_version_changes(session, flush_context, instances):
+    """Record the firewalls and policies whose content changes in this flush.
+
+    Collections are read before the flush, while the rows of deleted entities
+    and removed associations still exist.
+    """
+    firewall_ids, policy_ids = session.info.setdefault('version_changes', (set(), set()))
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Rule):
+                policy_ids.add(obj.policy.id if obj.policy is not None else obj.policy_id)
+        for obj in session.dirty:
+            if not session.is_modified(obj):
+                continue
+            if isinstance(obj, Rule):
+                policy_ids.add(obj.policy_id)
+                policy_ids.update(inspect(obj).attrs.policy_id.history.deleted)
+            elif isinstance(obj, Policy):
+                policy_ids.add(obj.id)
+                firewall_ids.update(_history_ids(obj, 'firewalls'))
+            elif isinstance(obj, Firewall):
+                firewall_ids.add(obj.id)
+                policy_ids.update(_history_ids(obj, 'policies'))
+        for obj in session.deleted:
+            if isinstance(obj, Rule):
+                policy_ids.add(obj.policy_id)
+            elif isinstance(obj, Policy):
+                firewall_ids.update(firewall.id for firewall in obj.firewalls)
+            elif isinstance(obj, Firewall):
+                policy_ids.update(policy.id for policy in obj.policies)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _apply_version_changes(session, flush_context):
+    """Bump the recorded versions in the transaction of the flush."""
+    changes = session.info.pop('version_changes', None)
+    if changes:
+        firewall_ids, policy_ids = changes
+        # Entities deleted by this flush have no version left to bump
+        firewall_ids -= {obj.id for obj in session.deleted if isinstance(obj, Firewall)}
+        policy_ids -= {obj.id for obj in session.deleted if isinstance(obj, Policy)}
+        bump_versions(session, firewall_ids, policy_ids)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_version_changes(session):
+    """Forget the changes recorded for a flush that failed."""
+    session.info.pop('version_changes', None)
@@ -0,0 +1,77 @@
+"""Benchmark of the shadowed/redundant/conflicting rule analyzer.
+
+Usage:
+    python -m benchmarks.bench_analysis --rules 100000
+"""
+import argparse
+import ipaddress
+import json
+import random
+import time
+from app.utils.analysis import analyze_rules
+
+PROTOCOLS = ('TCP', 'UDP', 'ICMP', 'ALL')
+
+
+def generate_rules(count: int, seed: int = 0) -> list:
+    """Generate a synthetic ruleset mixing hosts, subnets and catch-all rules.
+
+    Args:
+        count (int): The number of rules.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        list: The rules, as returned by ``Rule.to_dict``.
+    """
+    rng = random.Random(seed)
+
+    def address():
+        roll = rng.random()
+        if roll < 0.90:
+            return str(ipaddress.IPv4Address(0x0A000000 | rng.getrandbits(24)))
+        if roll < 0.99:
+            return str(ipaddress.IPv4Network((0x0A000000 | rng.getrandbits(8) << 16, 16)))
+        return '10.0.0.0/8'
+
+    rules = []
+    for rule_id in range(1, count + 1):
+        protocol = rng.choice(PROTOCOLS)
+        port = rng.randint(1, 1024) if protocol in ('TCP', 'UDP') and rng.random() < 0.9 else None
+        rules.append({
+            'id': rule_id,
+            'action': rng.choice(('ALLOW', 'DENY')),
+            'protocol': protocol,
+            'source_ip': address(),
+            'destination_ip': address(),
+            'port': port,
+            'policy_id': rule_id % 50 + 1
+        })
+    return rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rules', type=int, default=100000, help='Number of rules.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs.')
+    args = parser.parse_args()
+
+    rules = generate_rules(args.rules, seed=args.seed)
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        report = analyze_rules(rules)
+        timings.append(time.perf_counter() - started)
+
+    print(json.dumps({
+        'benchmark': 'analysis',
+        'rules': args.rules,
+        'seconds': {'min': min(timings), 'max': max(timings)},
+        'shadowed': len(report['shadowed']),
+        'redundant': len(report['redundant']),
+        'conflicts': report['conflicts_total']
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""Latency and throughput of every API endpoint through the Flask test client.
+
+A temporary SQLite database is seeded with the deterministic dataset of the
+requested scale, then each endpoint is called sequentially: read endpoints
+first, then the writes, each on rows created for it. The JSON results can be
+saved and compared across commits with ``benchmarks.compare``.
+
+Usage:
+    python -m benchmarks.bench_endpoints --scale 10k --requests 50 --output results.json
+    python -m benchmarks.bench_endpoints --scale 1m --endpoints rules. firewalls.get
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from benchmarks.dataset import SCALES, generate_rule
+
+CASES = []
+
+# Cases working on the rows created by another one, which then runs unmeasured
+DEPENDS = {
+    'rules.import_rules': 'rules.create_rule',
+    'rules.move_rule': 'rules.create_rule',
+    'rules.delete_rule': 'rules.create_rule',
+    'firewall_policy.remove_policy_from_firewall': 'firewall_policy.add_policy_to_firewall',
+    'policies.delete_policy': 'firewall_policy.add_policy_to_firewall',
+}
+
+
+def case(endpoint: str):
+    """Register the request builder of an endpoint, in execution order."""
+    def register(build):
+        CASES.append((endpoint, build))
+        return build
+    return register
+
+
+def _flow(rng) -> dict:
+    rule = generate_rule(rng, None)
+    return {'protocol': rule['protocol'], 'source_ip': rule['source_ip'].split('/')[0],
+            'destination_ip': rule['destination_ip'].split('/')[0], 'port': rule['port']}
+
+
+def _create(client, path: str, **kwargs) -> int:
+    response = client.post(path, **kwargs)
+    if response.status_code >= 400:
+        raise RuntimeError(f"Setup request {path} failed: {response.status_code}")
+    return response.get_json()['id']
+
+
+# Read endpoints. Builders get the client, the dataset, the number of requests
+# and a state shared by the cases, and return (method, path, client kwargs) tuples.
+
+@case('firewalls.list_firewalls')
+def _list_firewalls(client, data, count, state, rng):
+    return [('GET', f'/firewalls/?page={i % 4 + 1}&per_page=25', {}) for i in range(count)]
+
+
+@case('firewalls.get_firewall')
+def _get_firewall(client, data, count, state, rng):
+    return [('GET', f'/firewalls/{i % data["firewalls"] + 1}', {}) for i in range(count)]
+
+
+@case('firewalls.evaluate_flow')
+def _evaluate_flow(client, data, count, state, rng):
+    return [('POST', f'/firewalls/{i % data["firewalls"] + 1}/evaluate', {'json': _flow(rng)})
+            for i in range(count)]
+
+
+@case('firewalls.evaluate_flows')
+def _evaluate_flows(client, data, count, state, rng):
+    requests = []
+    for i in range(count):
+        body = ''.join(json.dumps(_flow(rng)) + '\n' for _ in range(1000))
+        requests.append(('POST', f'/firewalls/{i % data["firewalls"] + 1}/evaluate/batch',
+                         {'data': body, 'content_type': 'application/x-ndjson'}))
+    return requests
+
+
+@case('firewalls.export_firewall')
+def _export_firewall(client, data, count, state, rng):
+    formats = ('nft', 'iptables', 'ndjson')
+    return [('GET', f'/firewalls/{i % data["firewalls"] + 1}/export?format={formats[i % 3]}', {})
+            for i in range(count)]
+
+
+@case('firewalls.analyze_firewall')
+def _analyze_firewall(client, data, count, state, rng):
+    return [('GET', f'/firewalls/{i % data["firewalls"] + 1}/analysis', {}) for i in range(count)]
+
+
+@case('policies.list_all_policies')
+def _list_all_policies(client, data, count, state, rng):
+    return [('GET', f'/policies/?page={i % 4 + 1}&per_page=10', {}) for i in range(count)]
+
+
+@case('policies.list_policies')
+def _list_policies(client, data, count, state, rng):
+    return [('GET', f'/policies/{i % data["policies"] + 1}', {}) for i in range(count)]
+
+
+@case('rules.list_rules')
+def _list_rules(client, data, count, state, rng):
+    return [('GET', f'/rules/policy/{i % data["policies"] + 1}', {}) for i in range(count)]
+
+
+@case('rules.search_rules')
+def _search_rules(client, data, count, state, rng):
+    requests = []
+    for _ in range(count):
+        flow = _flow(rng)
+        requests.append(('GET', f'/rules/search?src={flow["source_ip"]}'
+                                f'&port={flow["port"] or 80}&limit=25&count=none', {}))
+    return requests
+
+
+@case('firewall_policy.get_policies_of_firewall')
+def _get_policies_of_firewall(client, data, count, state, rng):
+    return [('GET', f'/firewall-policy/{i % data["firewalls"] + 1}/policies', {})
+            for i in range(count)]
+
+
+@case('policies.optimize_policy')
+def _optimize_policy(client, data, count, state, rng):
+    return [('POST', f'/policies/{i % data["policies"] + 1}/optimize?dry_run=true', {})
+            for i in range(count)]
+
+
+# Write endpoints, each working on rows of its own
+
+@case('firewalls.create_firewall')
+def _create_firewall(client, data, count, state, rng):
+    return [('POST', '/firewalls', {'json': {'name': f'bench-fw-{i}'}}) for i in range(count)]
+
+
+@case('policies.create_policy')
+def _create_policy(client, data, count, state, rng):
+    return [('POST', '/policies/', {'json': {'name': f'bench-policy-{i}'}}) for i in range(count)]
+
+
+@case('rules.create_rule')
+def _create_rule(client, data, count, state, rng):
+    state['rule_policy'] = _create(client, '/policies/', json={'name': 'bench-rules'})
+    requests = []
+    for _ in range(count):
+        rule = generate_rule(rng, None)
+        del rule['policy_id']
+        requests.append(('POST', f'/rules/policy/{state["rule_policy"]}', {'json': rule}))
+    return requests
+
+
+@case('rules.import_rules')
+def _import_rules(client, data, count, state, rng):
+    requests = []
+    for _ in range(count):
+        rules = [generate_rule(rng, None) for _ in range(1000)]
+        body = ''.join(json.dumps({key: value for key, value in rule.items()
+                                   if key != 'policy_id'}) + '\n' for rule in rules)
+        requests.append(('POST', f'/rules/policy/{state["rule_policy"]}/bulk',
+                         {'data': body, 'content_type': 'application/x-ndjson'}))
+    return requests
+
+
+@case('rules.move_rule')
+def _move_rule(client, data, count, state, rng):
+    # Every rule lands right after the first one, halving the same gap each time
+    rows = client.get(f'/rules/policy/{state["rule_policy"]}').get_json()
+    first = rows[0]['id']
+    return [('POST', f'/rules/{rule["id"]}/move', {'json': {'after': first}})
+            for rule in rows[1:count + 1]]
+
+
+@case('firewalls.create_snapshot')
+def _create_snapshot(client, data, count, state, rng):
+    return [('POST', f'/firewalls/{i % data["firewalls"] + 1}/snapshots', {}) for i in range(count)]
+
+
+@case('firewalls.diff_snapshot')
+def _diff_snapshot(client, data, count, state, rng):
+    # Firewall 1 before and after a new policy of 100 rules is attached
+    base = _create(client, '/firewalls/1/snapshots')
+    policy_id = _create(client, '/policies/', json={'name': 'bench-snapshot'})
+    for _ in range(100):
+        rule = generate_rule(rng, None)
+        del rule['policy_id']
+        _create(client, f'/rules/policy/{policy_id}', json=rule)
+    client.post(f'/firewall-policy/1/add/{policy_id}')
+    head = _create(client, '/firewalls/1/snapshots')
+    return [('GET', f'/firewalls/1/snapshots/{base}/diff/{head}', {}) for _ in range(count)]
+
+
+@case('firewall_policy.add_policy_to_firewall')
+def _add_policy_to_firewall(client, data, count, state, rng):
+    state['attached'] = [_create(client, '/policies/', json={'name': f'bench-attach-{i}'})
+                         for i in range(count)]
+    return [('POST', f'/firewall-policy/1/add/{policy_id}', {}) for policy_id in state['attached']]
+
+
+@case('firewall_policy.remove_policy_from_firewall')
+def _remove_policy_from_firewall(client, data, count, state, rng):
+    return [('DELETE', f'/firewall-policy/1/remove/{policy_id}', {})
+            for policy_id in state['attached'][:count]]
+
+
+@case('rules.delete_rule')
+def _delete_rule(client, data, count, state, rng):
+    rows = client.get(f'/rules/policy/{state["rule_policy"]}').get_json()
+    return [('DELETE', f'/rules/{rule["id"]}', {}) for rule in rows[:count]]
+
+
+@case('policies.delete_policy')
+def _delete_policy(client, data, count, state, rng):
+    return [('DELETE', f'/policies/{policy_id}', {}) for policy_id in state['attached'][:count]]
+
+
+@case('firewalls.delete_firewall')
+def _delete_firewall(client, data, count, state, rng):
+    ids = [_create(client, '/firewalls', json={'name': f'bench-delete-{i}'}) for i in range(count)]
+    return [('DELETE', f'/firewalls/{firewall_id}', {}) for firewall_id in ids]
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Return the nearest-rank percentile of sorted values."""
+    index = min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+def measure(client, requests: list, warmup: int) -> dict:
+    """Send the requests in turn and summarize their latencies.
+
+    Args:
+        client (FlaskClient): The test client.
+        requests (list): The (method, path, kwargs) tuples to send.
+        warmup (int): Leading requests sent but not measured.
+
+    Returns:
+        dict: Counts, throughput and latency percentiles in milliseconds.
+    """
+    latencies, errors = [], 0
+    for index, (method, path, kwargs) in enumerate(requests):
+        started = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        response.get_data()
+        elapsed = time.perf_counter() - started
+        if index < warmup:
+            continue
+        if response.status_code >= 400:
+            errors += 1
+        latencies.append(elapsed)
+
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_sec': round(len(latencies) / total, 1) if total else None,
+        'latency_ms': {
+            'mean': round(total / len(latencies) * 1000, 3),
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p90': round(percentile(latencies, 0.90) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3),
+        } if latencies else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='10k', help='Named dataset size.')
+    parser.add_argument('--requests', type=int, default=50, help='Measured requests per endpoint.')
+    parser.add_argument('--warmup', type=int, default=3, help='Unmeasured requests per endpoint.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--endpoints', nargs='*', default=None,
+                        help='Only run the endpoints starting with these prefixes.')
+    parser.add_argument('--output', default=None, help='Write the results to this file.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The configuration is read at import time, the app is imported afterwards
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        from benchmarks.dataset import seed_database
+        from app import create_app
+
+        dataset = seed_database(*SCALES[args.scale], seed=args.seed)
+        logging.disable(logging.INFO)
+        client = create_app().test_client()
+        rng = random.Random(args.seed)
+        selected = [endpoint for endpoint, _ in CASES
+                    if args.endpoints is None or endpoint.startswith(tuple(args.endpoints))]
+        needed = set(selected) | {DEPENDS[endpoint] for endpoint in selected if endpoint in DEPENDS}
+        state, results = {}, {}
+        for endpoint, build in CASES:
+            if endpoint not in needed:
+                continue
+            requests = build(client, dataset, args.warmup + args.requests, state, rng)
+            summary = measure(client, requests, args.warmup)
+            if endpoint in selected:
+                results[endpoint] = summary
+        logging.disable(logging.NOTSET)
+
+    report = {
+        'benchmark': 'endpoints',
+        'commit': git_commit(),
+        'scale': args.scale,
+        'dataset': dataset,
+        'python': platform.python_version(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Name search of firewalls: ILIKE scan against the FTS5 trigram index and the prefix range.
+
+A temporary SQLite database is seeded with generated firewall names, then
+each term is searched through ``GET /firewalls/?name=`` with the index
+disabled (SEARCH_BACKEND=scan) and enabled, and as a prefix search.
+
+Usage:
+    python -m benchmarks.bench_search --firewalls 200000 --repeat 20
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+
+REGIONS = ('paris', 'lyon', 'nice', 'lille', 'nantes', 'berlin', 'madrid', 'milan')
+ROLES = ('edge', 'core', 'dmz', 'lab', 'vpn')
+
+# Rare and frequent substrings, then prefixes
+TERMS = {
+    'contains': ('042x', 'milan-0', 'dmz'),
+    'prefix': ('edge-paris-00001', 'lab-'),
+}
+
+
+def firewall_names(count: int, seed: int = 0) -> list:
+    """Generate unique firewall names such as "edge-paris-000123"."""
+    rng = random.Random(seed)
+    return [f"{rng.choice(ROLES)}-{rng.choice(REGIONS)}-{index:06d}"
+            + ('x' if index % 1000 == 42 else '') for index in range(count)]
+
+
+def _time(client, path: str, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(path)
+        timings.append(time.perf_counter() - started)
+    body = response.get_json()
+    return {'median_ms': round(statistics.median(timings) * 1000, 3),
+            'results': len(body['results']), 'total': body['total']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--firewalls', type=int, default=200000, help='Number of firewalls.')
+    parser.add_argument('--repeat', type=int, default=20, help='Searches per term and mode.')
+    parser.add_argument('--count', choices=('none', 'exact'), default='exact',
+                        help='Total computed by the listing.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The configuration is read at import time, the app is imported afterwards
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        from sqlalchemy import insert
+        from app import create_app
+        from app.extensions import db
+        from app.models import Firewall
+
+        app = create_app()
+        started = time.perf_counter()
+        with app.app_context():
+            db.session.execute(insert(Firewall), [{'name': name}
+                                                  for name in firewall_names(args.firewalls)])
+            db.session.commit()
+        seeding = time.perf_counter() - started
+        logging.disable(logging.INFO)
+        client = app.test_client()
+
+        results = {}
+        for term in TERMS['contains']:
+            path = f'/firewalls/?name={term}&per_page=25&count={args.count}'
+            for backend in ('scan', 'auto'):
+                app.config['SEARCH_BACKEND'] = backend
+                client.get(path)
+                results[f'contains {term} ({"index" if backend == "auto" else "scan"})'] = \
+                    _time(client, path, args.repeat)
+        app.config['SEARCH_BACKEND'] = 'scan'
+        for term in TERMS['prefix']:
+            for match in ('contains', 'prefix'):
+                path = f'/firewalls/?name={term}&match={match}&per_page=25&count={args.count}'
+                results[f'prefix {term} ({"range" if match == "prefix" else "scan"})'] = \
+                    _time(client, path, args.repeat)
+        logging.disable(logging.NOTSET)
+
+    print(json.dumps({
+        'benchmark': 'search',
+        'firewalls': args.firewalls,
+        'count': args.count,
+        'seeding_seconds': round(seeding, 2),
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
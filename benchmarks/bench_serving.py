@@ -0,0 +1,159 @@
+"""Throughput of the development server (run.py) against the pre-fork server (app.serve).
+
+A temporary SQLite database is seeded with one firewall, then each server is
+started in turn and loaded by concurrent clients for a fixed duration.
+
+Usage:
+    python -m benchmarks.bench_serving --rules 10000 --duration 10 --concurrency 8
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.bench_analysis import generate_rules
+
+REQUESTS = (
+    ('GET', '/firewalls/1', None),
+    ('GET', '/rules/search?src=10.1.2.3&limit=25&count=none', None),
+    ('POST', '/firewalls/1/evaluate', {'protocol': 'TCP', 'source_ip': '10.1.2.3',
+                                       'destination_ip': '10.3.2.1', 'port': 443}),
+)
+
+COMMANDS = {
+    'dev': [sys.executable, 'run.py'],
+    'serve': [sys.executable, '-m', 'app.serve', '--bind', '127.0.0.1:5000'],
+}
+
+
+def seed(rules: int):
+    """Create one firewall and one policy holding the generated rules."""
+    from sqlalchemy import insert
+    from app import create_app
+    from app.extensions import db
+    from app.models import ActionEnum, Firewall, Policy, ProtocolEnum, Rule
+    from app.utils.common import address_columns
+
+    app = create_app()
+    with app.app_context():
+        firewall, policy = Firewall(name='bench'), Policy(name='bench')
+        firewall.policies.append(policy)
+        db.session.add(firewall)
+        db.session.commit()
+        rows = [{
+            'action': ActionEnum(rule['action']),
+            'protocol': ProtocolEnum(rule['protocol']),
+            'source_ip': rule['source_ip'],
+            'destination_ip': rule['destination_ip'],
+            'port': rule['port'],
+            'policy_id': policy.id,
+            **address_columns('src', rule['source_ip']),
+            **address_columns('dst', rule['destination_ip'])
+        } for rule in generate_rules(rules)]
+        db.session.execute(insert(Rule), rows)
+        db.session.commit()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def _wait_ready(timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', 5000, timeout=5)
+            connection.request('GET', '/firewalls/1')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('Server did not start')
+
+
+def _client(deadline: float, latencies: list, errors: list, offset: int):
+    index = offset
+    while time.monotonic() < deadline:
+        method, path, body = REQUESTS[index % len(REQUESTS)]
+        index += 1
+        started = time.perf_counter()
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', 5000, timeout=30)
+            connection.request(method, path, body=json.dumps(body) if body else None,
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            if response.status >= 400:
+                errors.append(response.status)
+                continue
+        except OSError as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+def run_load(mode: str, duration: float, concurrency: int) -> dict:
+    """Start a server, load it and report its throughput and latencies."""
+    process = subprocess.Popen(COMMANDS[mode], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        _wait_ready()
+        latencies, errors = [], []
+        deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=_client, args=(deadline, latencies, errors, offset))
+                   for offset in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        # The development reloader forks a child, stop the whole group
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_sec': round(len(latencies) / duration, 1),
+        'latency_ms': {
+            'p50': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+            'p99': round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, default=10000, help='Number of rules.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of load per server.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients.')
+    parser.add_argument('--mode', choices=('dev', 'serve', 'both'), default='both')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        # The configuration is read at import time, seed from a fresh interpreter
+        seeder = multiprocessing.get_context('spawn').Process(target=seed, args=(args.rules,))
+        seeder.start()
+        seeder.join()
+        modes = ('dev', 'serve') if args.mode == 'both' else (args.mode,)
+        results = {mode: run_load(mode, args.duration, args.concurrency) for mode in modes}
+
+    print(json.dumps({
+        'benchmark': 'serving',
+        'rules': args.rules,
+        'concurrency': args.concurrency,
+        'cpus': os.cpu_count(),
+        'results': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Cold start profile of create_app(): wall time and import-time report.
+
+Each run starts a fresh interpreter and times ``create_app()`` including its
+imports; one more run with ``-X importtime`` gives the per-module report.
+
+Usage:
+    python -m benchmarks.bench_startup --runs 5 --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SNIPPET = ("import time; started = time.perf_counter(); "
+           "from app import create_app; create_app(); "
+           "print(time.perf_counter() - started)")
+
+
+def parse_importtime(stderr: str) -> list:
+    """Parse the ``-X importtime`` report into (module, self us, cumulative us) rows."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        rows.append((module.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def run_once(env: dict, importtime: bool = False) -> tuple:
+    options = ['-X', 'importtime'] if importtime else []
+    result = subprocess.run([sys.executable, *options, '-c', SNIPPET],
+                            env=env, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Number of cold starts.')
+    parser.add_argument('--top', type=int, default=15, help='Number of modules listed.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        _, imports = run_once(env, importtime=True)
+        timings = [run_once(env)[0] for _ in range(args.runs)]
+
+    # Top-level packages by cumulative time, then the heaviest modules by self time
+    packages = {}
+    for module, _, cumulative_us in imports:
+        if '.' not in module:
+            packages[module] = packages.get(module, 0) + cumulative_us
+    print(json.dumps({
+        'benchmark': 'startup',
+        'runs': args.runs,
+        'create_app_seconds': {'min': min(timings), 'median': statistics.median(timings)},
+        'import_seconds': sum(self_us for _, self_us, _ in imports) / 1e6,
+        'packages_ms': {name: round(us / 1000, 1) for name, us in
+                        sorted(packages.items(), key=lambda item: -item[1])[:args.top]},
+        'modules_self_ms': {name: round(self_us / 1000, 1) for name, self_us, _ in
+                            sorted(imports, key=lambda row: -row[1])[:args.top]},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
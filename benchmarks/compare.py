@@ -0,0 +1,70 @@
+"""Compare two result files of bench_endpoints, e.g. from two commits.
+
+An endpoint regresses when its latency percentile grows by more than the
+threshold; the exit status is 1 if any endpoint regressed.
+
+Usage:
+    python -m benchmarks.compare base.json head.json --percentile p50 --threshold 1.2
+"""
+import argparse
+import json
+import sys
+
+
+def compare(base: dict, head: dict, percentile: str = 'p50', threshold: float = 1.2) -> list:
+    """Compare the latencies of the endpoints measured in both reports.
+
+    Args:
+        base (dict): The reference report.
+        head (dict): The report compared with it.
+        percentile (str, optional): The latency percentile compared. Defaults to p50.
+        threshold (float, optional): The head/base ratio above which an endpoint
+            regressed. Defaults to 1.2.
+
+    Returns:
+        list: (endpoint, base ms, head ms, ratio, regressed) rows.
+    """
+    rows = []
+    for endpoint, result in head['results'].items():
+        reference = base['results'].get(endpoint)
+        if not reference or not reference['latency_ms'] or not result['latency_ms']:
+            continue
+        before = reference['latency_ms'][percentile]
+        after = result['latency_ms'][percentile]
+        ratio = after / before if before else float('inf')
+        rows.append((endpoint, before, after, ratio, ratio > threshold))
+    return rows
+
+
+def _shape(report: dict) -> dict:
+    return {key: value for key, value in report['dataset'].items() if key != 'seconds'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base', help='Reference results file.')
+    parser.add_argument('head', help='Results file compared with it.')
+    parser.add_argument('--percentile', choices=('mean', 'p50', 'p90', 'p99', 'max'), default='p50')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Latency ratio above which an endpoint regressed.')
+    args = parser.parse_args()
+
+    reports = []
+    for path in (args.base, args.head):
+        with open(path, encoding='utf-8') as results:
+            reports.append(json.load(results))
+    base, head = reports
+    if _shape(base) != _shape(head):
+        print('warning: the results were measured on different datasets', file=sys.stderr)
+
+    rows = compare(base, head, args.percentile, args.threshold)
+    print(f"{'endpoint':45} {base['commit'] or 'base':>10} {head['commit'] or 'head':>10}   ratio")
+    for endpoint, before, after, ratio, regressed in rows:
+        print(f"{endpoint:45} {before:10.2f} {after:10.2f} {ratio:7.2f}"
+              f"{'  REGRESSION' if regressed else ''}")
+    sys.exit(1 if any(row[4] for row in rows) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Deterministic synthetic dataset seeded straight into the database.
+
+The same scale and seed always produce the same rows with the same IDs, so
+results of different commits are measured on identical data.
+
+Usage:
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.dataset --scale 100k
+"""
+import argparse
+import json
+import random
+import time
+
+# Firewalls, policies and rules per policy of each named scale
+SCALES = {
+    '1k': (10, 20, 50),
+    '10k': (20, 50, 200),
+    '100k': (50, 100, 1000),
+    '1m': (100, 200, 5000),
+}
+
+PROTOCOLS = ('TCP', 'UDP', 'ICMP', 'ALL')
+
+INSERT_CHUNK_SIZE = 20000
+
+
+def _address(rng) -> str:
+    roll = rng.random()
+    if roll < 0.90:
+        octets = rng.getrandbits(24)
+        return f"10.{octets >> 16}.{octets >> 8 & 0xFF}.{octets & 0xFF}"
+    if roll < 0.99:
+        return f"10.{rng.getrandbits(8)}.0.0/16"
+    return '10.0.0.0/8'
+
+
+def generate_rule(rng, policy_id: int) -> dict:
+    """Generate one rule mixing hosts, subnets, catch-alls and port ranges.
+
+    Args:
+        rng (Random): The random generator.
+        policy_id (int): The ID of the policy holding the rule.
+
+    Returns:
+        dict: The rule, with the plain values of its columns.
+    """
+    protocol = rng.choice(PROTOCOLS)
+    port = port_end = None
+    # Like the API, TCP and UDP rules always have a port
+    if protocol in ('TCP', 'UDP'):
+        port = rng.randint(1, 1024)
+        if rng.random() < 0.1:
+            port_end = port + rng.randint(1, 100)
+    return {
+        'action': rng.choice(('ALLOW', 'DENY')),
+        'protocol': protocol,
+        'source_ip': _address(rng),
+        'destination_ip': _address(rng),
+        'port': port,
+        'port_end': port_end,
+        'policy_id': policy_id,
+    }
+
+
+def seed_database(firewalls: int, policies: int, rules_per_policy: int,
+                  policies_per_firewall: int = 5, seed: int = 0) -> dict:
+    """Create the tables and fill them with a synthetic dataset.
+
+    Each firewall is attached to ``policies_per_firewall`` random policies. Rows
+    are written with Core inserts, without building ORM entities.
+
+    Args:
+        firewalls (int): The number of firewalls.
+        policies (int): The number of policies.
+        rules_per_policy (int): The number of rules of each policy.
+        policies_per_firewall (int, optional): Policies attached to each firewall. Defaults to 5.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        dict: The size of the dataset and the seeding time.
+    """
+    # Imported here, the configuration is read from the environment at import time
+    from sqlalchemy import insert
+    from app import create_app
+    from app.extensions import db
+    from app.models import ActionEnum, Firewall, Policy, ProtocolEnum, Rule, firewall_policy
+    from app.utils.common import address_columns
+    from app.utils.ordering import ORDER_GAP
+
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(Firewall), [{'name': f'fw-{index}'}
+                                              for index in range(1, firewalls + 1)])
+        db.session.execute(insert(Policy), [{'name': f'policy-{index}'}
+                                            for index in range(1, policies + 1)])
+        db.session.execute(insert(firewall_policy), [
+            {'firewall_id': firewall_id, 'policy_id': policy_id, 'position': ORDER_GAP * index}
+            for firewall_id in range(1, firewalls + 1)
+            for index, policy_id in enumerate(sorted(rng.sample(
+                range(1, policies + 1), min(policies_per_firewall, policies))), start=1)
+        ])
+
+        rows = []
+        for policy_id in range(1, policies + 1):
+            for index in range(1, rules_per_policy + 1):
+                rule = generate_rule(rng, policy_id)
+                rule['position'] = ORDER_GAP * index
+                rule['action'] = ActionEnum(rule['action'])
+                rule['protocol'] = ProtocolEnum(rule['protocol'])
+                rule.update(address_columns('src', rule['source_ip']))
+                rule.update(address_columns('dst', rule['destination_ip']))
+                rows.append(rule)
+                if len(rows) == INSERT_CHUNK_SIZE:
+                    db.session.execute(insert(Rule), rows)
+                    rows = []
+        if rows:
+            db.session.execute(insert(Rule), rows)
+        db.session.commit()
+        for engine in db.engines.values():
+            engine.dispose()
+
+    return {
+        'firewalls': firewalls,
+        'policies': policies,
+        'rules': policies * rules_per_policy,
+        'policies_per_firewall': policies_per_firewall,
+        'seed': seed,
+        'seconds': round(time.perf_counter() - started, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='10k', help='Named dataset size.')
+    parser.add_argument('--policies-per-firewall', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    print(json.dumps(seed_database(*SCALES[args.scale],
+                                   policies_per_firewall=args.policies_per_firewall,
+                                   seed=args.seed), indent=2))
+
+
+if __name__ == '__main__':
+    main()
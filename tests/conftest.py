@@ -0,0 +1,81 @@
+"Fixtures of the test suite: an application on a fresh SQLite file per test"
+import pytest
+from sqlalchemy import event
+from app import create_app
+from app.config import Config
+from app.database import app_engines
+from app.extensions import db
+from app.utils.ruleset import ruleset_cache
+
+
+@pytest.fixture
+def app_config():
+    """Settings overriding Config for the application of a test."""
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, app_config):
+    """Create the application on an empty database; engines are built from Config."""
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'test.db'}")
+    for name, value in app_config.items():
+        monkeypatch.setattr(Config, name, value)
+    # Firewall IDs and versions repeat from one database to the next
+    ruleset_cache.clear()
+    app = create_app()
+    app.config['TESTING'] = True
+    yield app
+    with app.app_context():
+        db.session.remove()
+    for engine in app_engines(app, db):
+        engine.dispose()
+    ruleset_cache.clear()
+
+
+@pytest.fixture
+def statements(app):
+    """Collect the SQL statements run by the application."""
+    executed = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    engines = app_engines(app, db)
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', collect)
+    yield executed
+    for engine in engines:
+        event.remove(engine, 'before_cursor_execute', collect)
+
+
+class Api:
+    """Creates entities through the API and checks the status of each call."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _post(self, path: str, json=None, status: int = 201) -> dict:
+        response = self.client.post(path, json=json)
+        assert response.status_code == status, response.get_json()
+        return response.get_json()
+
+    def firewall(self, name: str) -> int:
+        return self._post('/firewalls', {'name': name})['id']
+
+    def policy(self, name: str) -> int:
+        return self._post('/policies/', {'name': name})['id']
+
+    def rule(self, policy_id: int, **fields) -> dict:
+        return self._post(f'/rules/policy/{policy_id}', fields)
+
+    def attach(self, firewall_id: int, policy_id: int, **order):
+        self._post(f'/firewall-policy/{firewall_id}/add/{policy_id}', order or None, status=200)
+
+    def evaluate(self, firewall_id: int, **flow) -> dict:
+        return self._post(f'/firewalls/{firewall_id}/evaluate', flow, status=200)
+
+
+@pytest.fixture
+def api(client) -> Api:
+    """Helpers creating firewalls, policies and rules through the test client."""
+    return Api(client)
@@ -0,0 +1,100 @@
+"Tests of the admission control: concurrency limits, their queue and the per-client rate limit"
+import threading
+import time
+import pytest
+from app.admission import ADMISSION_KEY, ConcurrencyLimit, parse_limits
+
+FEED = 'changes.list_changes'
+
+
+def test_parse_limits():
+    assert parse_limits('') == {}
+    assert parse_limits(f'{FEED}=2, *=16') == {FEED: 2, '*': 16}
+    for value in ('changes', f'{FEED}=0', f'{FEED}=two', '=3'):
+        with pytest.raises(ValueError):
+            parse_limits(value)
+
+
+def test_concurrency_limit_decisions():
+    limit = ConcurrencyLimit(1, queue_size=1, timeout=0.05)
+    assert limit.acquire() == 'admitted'
+    assert limit.acquire() == 'timeout'
+    limit.waiting = 1  # The queue is full
+    assert limit.acquire() == 'shed'
+    limit.waiting = 0
+    limit.release()
+    assert limit.acquire() == 'admitted'
+
+
+def hold_the_feed(app, seconds: float) -> threading.Thread:
+    """Keep the only slot of the change feed busy with a long-poll."""
+    thread = threading.Thread(
+        target=lambda: app.test_client().get(f'/changes/?since=0&wait={seconds}'))
+    thread.start()
+    limit = app.extensions[ADMISSION_KEY].limit_of(FEED)
+    while limit.active < 1:
+        time.sleep(0.01)
+    return thread
+
+
+class TestConcurrency:
+
+    @pytest.fixture
+    def app_config(self):
+        return {'ADMISSION_LIMITS': f'{FEED}=1', 'ADMISSION_QUEUE_SIZE': 0,
+                'ADMISSION_RETRY_AFTER': 2, 'METRICS_ENABLED': True}
+
+    def test_requests_beyond_the_limit_are_shed(self, app, client):
+        holder = hold_the_feed(app, 0.5)
+        started = time.monotonic()
+        response = client.get('/changes/?since=0')
+        assert time.monotonic() - started < 0.4
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '2'
+        # Other endpoints are not limited
+        assert client.get('/firewalls/').status_code == 200
+        holder.join()
+        assert client.get('/changes/?since=0').status_code == 200
+
+        metrics = client.get('/metrics').get_data(as_text=True)
+        assert f'jouerflux_admission_decisions_total{{endpoint="{FEED}",decision="shed"}} 1' \
+            in metrics
+        assert f'jouerflux_admission_decisions_total{{endpoint="{FEED}",decision="admitted"}} 2' \
+            in metrics
+
+    def test_queued_requests_wait_for_a_slot(self, app, client, monkeypatch):
+        monkeypatch.setattr(app.extensions[ADMISSION_KEY].limit_of(FEED), 'queue_size', 1)
+        holder = hold_the_feed(app, 0.2)
+        assert client.get('/changes/?since=0').status_code == 200
+        holder.join()
+
+    def test_queued_requests_time_out(self, app, client, monkeypatch):
+        limit = app.extensions[ADMISSION_KEY].limit_of(FEED)
+        monkeypatch.setattr(limit, 'queue_size', 1)
+        monkeypatch.setattr(limit, 'timeout', 0.05)
+        holder = hold_the_feed(app, 0.5)
+        response = client.get('/changes/?since=0')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '2'
+        holder.join()
+
+
+class TestRateLimit:
+
+    @pytest.fixture
+    def app_config(self):
+        return {'RATE_LIMIT_PER_SECOND': 0.5, 'RATE_LIMIT_BURST': 2,
+                'RATE_LIMIT_CLIENT_HEADER': 'X-Forwarded-For', 'METRICS_ENABLED': True}
+
+    def test_clients_beyond_their_rate_are_throttled(self, client):
+        agent = {'X-Forwarded-For': '192.0.2.1, 10.0.0.1'}
+        assert client.get('/firewalls/', headers=agent).status_code == 200
+        assert client.get('/firewalls/', headers=agent).status_code == 200
+        response = client.get('/firewalls/', headers=agent)
+        assert response.status_code == 429
+        # One token comes back every two seconds
+        assert response.headers['Retry-After'] == '2'
+        # Each client has its own bucket, and the metrics are never throttled
+        other = {'X-Forwarded-For': '192.0.2.2'}
+        assert client.get('/firewalls/', headers=other).status_code == 200
+        assert client.get('/metrics', headers=agent).status_code == 200
@@ -0,0 +1,56 @@
+"Tests of attaching and detaching a policy from a firewall"
+from app.extensions import db
+from app.models import ChangeLog, Firewall
+
+
+def test_attach_and_detach(app, api):
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    api.attach(firewall, policy)
+    response = api.client.post(f'/firewall-policy/{firewall}/add/{policy}')
+    assert response.status_code == 400
+    with app.app_context():
+        version = db.session.get(Firewall, firewall).version
+
+    response = api.client.delete(f'/firewall-policy/{firewall}/remove/{policy}')
+    assert response.status_code == 204
+    response = api.client.delete(f'/firewall-policy/{firewall}/remove/{policy}')
+    assert response.status_code == 400
+    assert api.client.delete(f'/firewall-policy/{firewall}/remove/999').status_code == 404
+
+    with app.app_context():
+        assert db.session.get(Firewall, firewall).version == version + 1
+        entries = db.session.query(ChangeLog.op).filter(
+            ChangeLog.entity == 'firewall_policy').order_by(ChangeLog.seq).all()
+        assert [op for op, in entries] == ['attach', 'detach']
+    # Attached again after the detach
+    api.attach(firewall, policy)
+
+
+def test_policies_of_a_firewall_are_listed_in_evaluation_order(api):
+    firewall = api.firewall('fw')
+    # Created in the reverse order, so that the IDs do not follow the positions
+    third, second, first = api.policy('third'), api.policy('second'), api.policy('first')
+    api.attach(firewall, third)
+    api.attach(firewall, first, before=third)
+    api.attach(firewall, second, after=first)
+    api.attach(api.firewall('other'), api.policy('elsewhere'))
+    order = [first, second, third]
+
+    listing = api.client.get(f'/firewall-policy/{firewall}/policies?expand=&per_page=2')
+    body = listing.get_json()
+    assert [policy['id'] for policy in body['results']] == order[:2]
+    assert (body['total'], body['pages']) == (3, 2)
+    last = api.client.get(f'/firewall-policy/{firewall}/policies?expand=&per_page=2&page=2')
+    assert [policy['id'] for policy in last.get_json()['results']] == order[2:]
+
+    seen, cursor = [], ''
+    while True:
+        page = api.client.get(f'/firewall-policy/{firewall}/policies?expand=&limit=1&after={cursor}')
+        body = page.get_json()
+        seen += [policy['id'] for policy in body['results']]
+        cursor = body['next_cursor']
+        if cursor is None:
+            break
+    assert seen == order
+    invalid = api.client.get(f'/firewall-policy/{firewall}/policies?after=eyJpZCI6MX0')
+    assert invalid.status_code == 400
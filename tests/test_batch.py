@@ -0,0 +1,65 @@
+"Tests of the batch evaluation against the evaluation of single flows"
+import json
+import pytest
+
+FLOWS = [
+    {'protocol': 'TCP', 'source_ip': '10.0.0.1', 'destination_ip': '10.0.0.2', 'port': 443},
+    {'protocol': 'UDP', 'source_ip': '10.0.0.1', 'destination_ip': '10.0.0.2', 'port': 53},
+    {'protocol': 'ICMP', 'source_ip': '10.0.0.1', 'destination_ip': '10.0.0.2', 'port': None},
+    {'protocol': 'TCP', 'source_ip': '2001:db8::1', 'destination_ip': '2001:db8::2', 'port': 22},
+    # Rejected by FlowCheck: a TCP/UDP flow needs a port, other protocols have none
+    {'protocol': 'TCP', 'source_ip': '10.0.0.1', 'destination_ip': '10.0.0.2', 'port': None},
+    {'protocol': 'UDP', 'source_ip': '10.0.0.1', 'destination_ip': '10.0.0.2'},
+    {'protocol': 'ICMP', 'source_ip': '10.0.0.1', 'destination_ip': '10.0.0.2', 'port': 8},
+    {'protocol': 'TCP', 'source_ip': '10.0.0.1', 'destination_ip': '10.0.0.2', 'port': 70000},
+    {'protocol': 'SCTP', 'source_ip': '10.0.0.1', 'destination_ip': '10.0.0.2', 'port': 80},
+    {'protocol': 'TCP', 'source_ip': '10.0.0.300', 'destination_ip': '10.0.0.2', 'port': 80},
+]
+
+
+@pytest.fixture
+def firewall(api):
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    api.rule(policy, action='ALLOW', protocol='TCP', source_ip='10.0.0.0/8',
+             destination_ip='0.0.0.0/0', port=443)
+    api.rule(policy, action='ALLOW', protocol='ALL', source_ip='2001:db8::/32',
+             destination_ip='::/0')
+    api.rule(policy, action='DENY', protocol='UDP', source_ip='0.0.0.0/0',
+             destination_ip='0.0.0.0/0', port=1, port_end=1024)
+    api.attach(firewall, policy)
+    return firewall
+
+
+def test_batch_agrees_with_single_flows(client, firewall):
+    body = ''.join(json.dumps(flow) + '\n' for flow in FLOWS)
+    response = client.post(f'/firewalls/{firewall}/evaluate/batch', data=body,
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    verdicts, summary = lines[:-1], lines[-1]['summary']
+    assert len(verdicts) == len(FLOWS)
+    assert summary['flows'] == len(FLOWS)
+
+    for flow, verdict in zip(FLOWS, verdicts):
+        single = client.post(f'/firewalls/{firewall}/evaluate', json=flow)
+        if single.status_code == 400:
+            assert 'error' in verdict, flow
+            continue
+        assert single.status_code == 200
+        expected = single.get_json()
+        assert verdict == {'action': expected['action'],
+                           'rule_id': expected['rule']['id'] if expected['matched'] else None}, flow
+    assert summary['errors'] == sum('error' in verdict for verdict in verdicts) == 6
+
+
+def test_batch_reads_csv(client, firewall):
+    body = ('protocol,source_ip,destination_ip,port\n'
+            'TCP,10.0.0.1,10.0.0.2,443\n'
+            'ICMP,10.0.0.1,10.0.0.2,\n'
+            'TCP,10.0.0.1,10.0.0.2,\n')
+    response = client.post(f'/firewalls/{firewall}/evaluate/batch', data=body,
+                           content_type='text/csv')
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[0]['action'] == 'ALLOW'
+    assert lines[1] == {'action': 'DENY', 'rule_id': None}
+    assert 'Port must be specified' in lines[2]['error']
@@ -0,0 +1,91 @@
+"Tests of the benchmark suite: deterministic dataset, endpoint cases and result comparison"
+import ipaddress
+import random
+import pytest
+from sqlalchemy import create_engine, select
+from app.config import Config
+from app.models import Firewall, Rule, firewall_policy
+from benchmarks.bench_endpoints import CASES, DEPENDS, measure, percentile
+from benchmarks.compare import compare
+from benchmarks.dataset import generate_rule, seed_database
+
+TINY = (3, 4, 5)
+
+
+def seed(monkeypatch, path) -> dict:
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{path}")
+    return seed_database(*TINY, policies_per_firewall=2, seed=7)
+
+
+@pytest.fixture
+def app_config(tmp_path, monkeypatch):
+    # Seeded in the database file of the app fixture, which then finds its tables
+    seed(monkeypatch, tmp_path / 'test.db')
+    return {}
+
+
+def test_generated_rules_are_valid_and_deterministic():
+    rules = [generate_rule(random.Random(3), 1) for _ in range(2)]
+    assert rules[0] == rules[1]
+    rng = random.Random(0)
+    for rule in (generate_rule(rng, 1) for _ in range(500)):
+        ipaddress.ip_network(rule['source_ip'])
+        ipaddress.ip_network(rule['destination_ip'])
+        if rule['protocol'] in ('TCP', 'UDP'):
+            assert 1 <= rule['port'] <= (rule['port_end'] or rule['port'])
+        else:
+            assert rule['port'] is None and rule['port_end'] is None
+
+
+def snapshot(path) -> tuple:
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as connection:
+        rows = (connection.execute(select(Firewall.id, Firewall.name)).all(),
+                connection.execute(select(firewall_policy)).all(),
+                connection.execute(select(Rule.id, Rule.policy_id, Rule.source_ip, Rule.port,
+                                          Rule.position)).all())
+    engine.dispose()
+    return rows
+
+
+def test_dataset_is_reproducible(tmp_path, monkeypatch):
+    paths = [tmp_path / 'first.db', tmp_path / 'second.db']
+    report = seed(monkeypatch, paths[0])
+    assert (report['firewalls'], report['rules'], report['seed']) == (3, 20, 7)
+    seed(monkeypatch, paths[1])
+    firewalls, associations, rules = snapshot(paths[0])
+    assert len(firewalls) == 3
+    assert len(associations) == 3 * 2
+    assert len(rules) == 4 * 5
+    assert snapshot(paths[1]) == (firewalls, associations, rules)
+
+
+def test_every_endpoint_case_runs(app, client):
+    dataset = {'firewalls': TINY[0], 'policies': TINY[1], 'rules': TINY[0] * TINY[1]}
+    rng, state = random.Random(0), {}
+    endpoints = {rule.endpoint for rule in app.url_map.iter_rules()}
+    for endpoint, build in CASES:
+        assert endpoint in endpoints
+        summary = measure(client, build(client, dataset, 3, state, rng), warmup=1)
+        assert summary['requests'] == 2
+        assert summary['errors'] == 0, endpoint
+        assert summary['latency_ms']['p50'] <= summary['latency_ms']['max']
+    assert set(DEPENDS.values()) <= {endpoint for endpoint, _ in CASES}
+
+
+def test_percentiles_use_the_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([4], 0.9) == 4
+
+
+def test_compare_flags_the_regressions():
+    def report(**latencies):
+        return {'results': {endpoint: {'latency_ms': {'p50': value} if value else None}
+                            for endpoint, value in latencies.items()}}
+
+    rows = compare(report(a=10, b=10, c=10), report(a=11, b=13, c=None, d=5),
+                   percentile='p50', threshold=1.2)
+    assert [(endpoint, round(ratio, 2), regressed) for endpoint, _, _, ratio, regressed in rows] \
+        == [('a', 1.1, False), ('b', 1.3, True)]
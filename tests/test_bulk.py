@@ -0,0 +1,66 @@
+"Tests of the streamed rule import"
+import json
+import pytest
+from sqlalchemy import text
+from app.extensions import db
+
+
+@pytest.fixture
+def app_config():
+    return {'BULK_CHUNK_SIZE': 2}
+
+
+def rule(port) -> dict:
+    return {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+            'destination_ip': '0.0.0.0/0', 'port': port}
+
+
+def import_rules(client, policy_id: int, records: list):
+    body = ''.join(json.dumps(record) + '\n' for record in records)
+    return client.post(f'/rules/policy/{policy_id}/bulk', data=body,
+                       content_type='application/x-ndjson')
+
+
+@pytest.fixture
+def refused(app):
+    """Make the database refuse the rules on port 666, like a constraint would."""
+    with app.app_context(), db.engine.begin() as connection:
+        connection.execute(text("CREATE TRIGGER refuse_port BEFORE INSERT ON rule "
+                                "WHEN NEW.port = 666 BEGIN SELECT RAISE(ABORT, 'refused'); END"))
+
+
+def test_invalid_rows_are_reported(client, api):
+    policy = api.policy('p')
+    response = import_rules(client, policy, [rule(80), rule(None) | {'protocol': 'ICMP'},
+                                             rule(70000), rule(443)])
+    assert response.status_code == 201
+    report = response.get_json()
+    assert report['inserted'] == 3
+    assert [error['row'] for error in report['errors']] == [3]
+    listed = client.get(f'/rules/policy/{policy}').get_json()
+    assert [item['port'] for item in listed] == [80, None, 443]
+
+    response = import_rules(client, policy, [rule(70000)])
+    assert response.status_code == 400
+
+
+def test_a_refused_chunk_does_not_abort_the_others(client, api, refused):
+    policy = api.policy('p')
+    # Chunks of two rows: the second chunk is refused by the database
+    response = import_rules(client, policy, [rule(80), rule(81), rule(666), rule(82),
+                                             rule(83), rule(84)])
+    assert response.status_code == 201
+    report = response.get_json()
+    assert report['inserted'] == 4
+    assert report['failed'] == 2
+    assert report['errors'] == [{'row': 3, 'error': 'Failed to insert rule'},
+                                {'row': 4, 'error': 'Failed to insert rule'}]
+    listed = client.get(f'/rules/policy/{policy}').get_json()
+    assert [item['port'] for item in listed] == [80, 81, 83, 84]
+
+
+def test_nothing_written_by_the_database_is_a_server_error(client, api, refused):
+    policy = api.policy('p')
+    response = import_rules(client, policy, [rule(666)])
+    assert response.status_code == 500
+    assert response.get_json()['failed'] == 1
@@ -0,0 +1,110 @@
+"Tests of the change feed: cursors, firewall filter, long-poll, event stream and waiter cap"
+import threading
+import time
+import pytest
+from app.utils.changes import change_notifier
+
+RULE = {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+        'destination_ip': '0.0.0.0/0', 'port': 443}
+
+
+@pytest.fixture
+def app_config():
+    return {'CHANGES_POLL_INTERVAL': 0.05, 'CHANGES_HEARTBEAT': 0.05,
+            'CHANGES_STREAM_SECONDS': 0.3, 'CHANGES_MAX_WAITERS': 2}
+
+
+def feed(client, **args) -> dict:
+    response = client.get('/changes/', query_string=args)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def test_entries_follow_the_cursor(client, api):
+    policy = api.policy('p')
+    rule = api.rule(policy, **RULE)
+    page = feed(client, since=0)
+    assert [(entry['entity'], entry['op']) for entry in page['changes']] == [('rule', 'create')]
+    assert page['changes'][0]['payload']['id'] == rule['id']
+    assert page['next_since'] == page['changes'][0]['seq']
+
+    assert client.delete(f"/rules/{rule['id']}").status_code in (200, 204)
+    after = feed(client, since=page['next_since'])
+    assert [(entry['op'], entry['entity_id']) for entry in after['changes']] == \
+        [('delete', rule['id'])]
+    assert feed(client, since=after['next_since'])['changes'] == []
+
+
+def test_firewall_filter_keeps_the_attached_policies(client, api):
+    firewall, other = api.firewall('fw'), api.firewall('other')
+    attached, detached = api.policy('attached'), api.policy('detached')
+    api.attach(firewall, attached)
+    api.attach(other, detached)
+    api.rule(attached, **RULE)
+    api.rule(detached, **RULE)
+    entries = feed(client, since=0, firewall_id=firewall)['changes']
+    assert [(entry['entity'], entry['op'], entry['policy_id']) for entry in entries] == \
+        [('firewall_policy', 'attach', attached), ('rule', 'create', attached)]
+
+
+def test_invalid_parameters(client):
+    assert client.get('/changes/?since=-1').status_code == 400
+    assert client.get('/changes/?limit=0').status_code == 400
+    assert client.get('/changes/?wait=soon').status_code == 400
+
+
+def test_long_poll_returns_early_on_a_new_change(app, client, api):
+    policy = api.policy('p')
+    since = feed(client, since=0)['next_since']
+
+    def write():
+        time.sleep(0.2)
+        response = app.test_client().post(f'/rules/policy/{policy}', json=RULE)
+        assert response.status_code == 201
+
+    writer = threading.Thread(target=write)
+    started = time.monotonic()
+    writer.start()
+    page = feed(client, since=since, wait=20)
+    elapsed = time.monotonic() - started
+    writer.join()
+    assert [entry['op'] for entry in page['changes']] == ['create']
+    assert elapsed < 5
+    assert change_notifier.waiters == 0
+
+
+def test_long_poll_expires_without_change(client, api):
+    since = feed(client, since=0)['next_since']
+    started = time.monotonic()
+    page = feed(client, since=since, wait=0.2)
+    assert time.monotonic() - started >= 0.2
+    assert page == {'changes': [], 'next_since': since, 'has_more': False}
+
+
+def test_event_stream_pushes_entries_with_their_cursor(client, api):
+    policy = api.policy('p')
+    api.rule(policy, **RULE)
+    response = client.get('/changes/?since=0', headers={'Accept': 'text/event-stream'})
+    assert response.mimetype == 'text/event-stream'
+    body = response.get_data(as_text=True)
+    response.close()
+    seq = feed(client, since=0)['changes'][0]['seq']
+    assert body.startswith(f"id: {seq}\nevent: change\ndata: ")
+    assert ': keep-alive' in body
+    assert change_notifier.waiters == 0
+
+
+def test_waiting_requests_beyond_the_cap_are_rejected(client, api):
+    assert change_notifier.enter(2) and change_notifier.enter(2)
+    try:
+        response = client.get('/changes/?since=0&wait=10')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        response = client.get('/changes/?since=0', headers={'Accept': 'text/event-stream'})
+        assert response.status_code == 503
+        # A request that does not wait is always served
+        assert client.get('/changes/?since=0').status_code == 200
+    finally:
+        change_notifier.leave()
+        change_notifier.leave()
+    assert feed(client, since=0, wait=0.05)['changes'] == []
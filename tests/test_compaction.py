@@ -0,0 +1,134 @@
+"Tests that optimizing a policy keeps the verdict of every flow"
+import ipaddress
+import json
+import random
+import pytest
+
+# Hand-written: merged rules that overlap rules kept in place, before and after them
+RULES = [
+    # Kept in place, before the rules merged from the ones that follow
+    {'action': 'DENY', 'protocol': 'TCP', 'source_ip': '10.0.128.0/17', 'destination_ip': '0.0.0.0/0',
+     'port': 22},
+    # Collapsed into 10.0.0.0/15, appended after the rules kept in place
+    {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/16', 'destination_ip': '172.16.0.0/12',
+     'port': 80},
+    {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.1.0.0/16', 'destination_ip': '172.16.0.0/12',
+     'port': 80},
+    # Same action, overlaps the merged rule and is not merged itself
+    {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8', 'destination_ip': '172.16.5.0/24',
+     'port': 70, 'port_end': 90},
+    # Covered by the two /16 rules together only: never dropped, never fires first
+    {'action': 'DENY', 'protocol': 'TCP', 'source_ip': '10.0.5.0/24', 'destination_ip': '172.16.0.0/12',
+     'port': 80},
+    # Merged into the port range 443-445
+    {'action': 'DENY', 'protocol': 'UDP', 'source_ip': '192.168.0.0/24', 'destination_ip': '0.0.0.0/0',
+     'port': 443},
+    {'action': 'DENY', 'protocol': 'UDP', 'source_ip': '192.168.0.0/24', 'destination_ip': '0.0.0.0/0',
+     'port': 444, 'port_end': 445},
+    # Duplicate and redundant rules
+    {'action': 'DENY', 'protocol': 'UDP', 'source_ip': '192.168.0.0/24', 'destination_ip': '0.0.0.0/0',
+     'port': 443},
+    {'action': 'ALLOW', 'protocol': 'UDP', 'source_ip': '192.168.0.7', 'destination_ip': '8.8.8.8',
+     'port': 444},
+    # Conflicts with the DENY /17, so both stay where they are
+    {'action': 'ALLOW', 'protocol': 'ALL', 'source_ip': '10.0.0.0/9', 'destination_ip': '0.0.0.0/0'},
+    {'action': 'ALLOW', 'protocol': 'ICMP', 'source_ip': '2001:db8::/33', 'destination_ip': '::/0'},
+    {'action': 'ALLOW', 'protocol': 'ICMP', 'source_ip': '2001:db8:8000::/33', 'destination_ip': '::/0'},
+    {'action': 'DENY', 'protocol': 'TCP', 'source_ip': '2001:db8::1', 'destination_ip': '::/0', 'port': 22},
+]
+
+SOURCES = ['10.0.0.0/16', '10.1.0.0/16', '10.2.0.0/16', '10.3.0.0/16', '10.0.0.0/15', '10.0.0.0/8',
+           '10.0.128.0/17', '192.168.0.0/24', '192.168.1.0/24', '0.0.0.0/0',
+           '2001:db8::/33', '2001:db8:8000::/33', '2001:db8::/32', '::/0']
+DESTINATIONS = ['172.16.0.0/12', '172.16.5.0/24', '172.16.4.0/24', '0.0.0.0/0',
+                'fd00::/9', 'fd80::/9', '::/0']
+PORTS = (22, 53, 80, 81, 82, 443, 444)
+
+
+def random_rules(seed: int, count: int) -> list:
+    rng = random.Random(seed)
+    rules = []
+    for _ in range(count):
+        version = rng.choice((4, 6))
+        pick = lambda pool: rng.choice([p for p in pool if ipaddress.ip_network(p).version == version])
+        rule = {'action': rng.choice(('ALLOW', 'DENY')),
+                'protocol': rng.choice(('TCP', 'TCP', 'UDP', 'ICMP', 'ALL')),
+                'source_ip': pick(SOURCES), 'destination_ip': pick(DESTINATIONS)}
+        if rule['protocol'] in ('TCP', 'UDP') and rng.random() < 0.8:
+            rule['port'] = rng.choice(PORTS)
+            if rng.random() < 0.2:
+                rule['port_end'] = rule['port'] + rng.choice((1, 2, 100))
+        rules.append(rule)
+    return rules
+
+
+def addresses(prefixes: list) -> list:
+    """Sample the first, last and middle address of every prefix."""
+    result = set()
+    for prefix in prefixes:
+        network = ipaddress.ip_network(prefix)
+        for offset in (0, network.num_addresses // 2, network.num_addresses - 1):
+            result.add(str(network.network_address + offset))
+    return sorted(result)
+
+
+def flows(rules: list) -> list:
+    sources = addresses(SOURCES + [rule['source_ip'] for rule in rules])
+    destinations = addresses(DESTINATIONS + [rule['destination_ip'] for rule in rules])
+    result = []
+    for source in sources:
+        for destination in destinations:
+            if ipaddress.ip_address(source).version != ipaddress.ip_address(destination).version:
+                continue
+            for protocol in ('TCP', 'UDP'):
+                for port in (21, 22, 23, 79, 80, 83, 90, 91, 443, 445, 446):
+                    result.append({'protocol': protocol, 'source_ip': source,
+                                   'destination_ip': destination, 'port': port})
+            result.append({'protocol': 'ICMP', 'source_ip': source, 'destination_ip': destination})
+    return result
+
+
+def verdicts(client, firewall_id: int, flow_list: list) -> list:
+    body = ''.join(json.dumps(flow) + '\n' for flow in flow_list)
+    response = client.post(f'/firewalls/{firewall_id}/evaluate/batch', data=body,
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[-1]['summary']['errors'] == 0
+    return [line['action'] for line in lines[:-1]]
+
+
+def optimized(client, api, rules: list) -> tuple:
+    """Evaluate flows against a policy of the rules, before and after applying /optimize."""
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    body = ''.join(json.dumps(rule) + '\n' for rule in rules)
+    response = client.post(f'/rules/policy/{policy}/bulk', data=body,
+                           content_type='application/x-ndjson')
+    assert response.get_json()['inserted'] == len(rules)
+    api.attach(firewall, policy)
+
+    flow_list = flows(rules)
+    before = verdicts(client, firewall, flow_list)
+    response = client.post(f'/policies/{policy}/optimize?dry_run=false')
+    assert response.status_code == 200
+    plan = response.get_json()
+    assert verdicts(client, firewall, flow_list) == before
+    # Merged rules are appended after the kept ones, in the order of the plan
+    listed = client.get(f'/rules/policy/{policy}').get_json()
+    assert [rule['id'] for rule in listed] == [rule['id'] for rule in plan['rules']]
+    return plan, before
+
+
+def test_optimize_keeps_verdicts_of_overlapping_rules(client, api):
+    plan, before = optimized(client, api, RULES)
+    merged = [rule for rule in plan['rules'] if rule.get('replaces')]
+    assert {rule['source_ip'] for rule in merged} >= {'10.0.0.0/15', '192.168.0.0/24',
+                                                      '2001:db8::/32'}
+    assert plan['after'] < plan['before']
+    assert 'ALLOW' in before and 'DENY' in before
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_optimize_keeps_verdicts_of_random_rules(client, api, seed):
+    plan, _ = optimized(client, api, random_rules(seed, 40))
+    assert plan['after'] <= plan['before']
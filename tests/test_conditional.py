@@ -0,0 +1,61 @@
+"Tests of the conditional GETs of firewalls and policies driven by their version counters"
+
+RULE = {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+        'destination_ip': '0.0.0.0/0', 'port': 443}
+
+
+def etag_of(client, path: str) -> str:
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.headers['ETag']
+    return response.headers['ETag']
+
+
+def test_unchanged_entities_answer_304_from_their_version(client, api, statements):
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    api.rule(policy, **RULE)
+    api.attach(firewall, policy)
+    for path in (f'/firewalls/{firewall}', f'/policies/{policy}'):
+        etag = etag_of(client, path)
+        statements.clear()
+        response = client.get(path, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert response.get_data() == b''
+        # A single lookup of the version, the rules are not read
+        assert len(statements) == 1
+        assert 'rule' not in statements[0]
+        # Another representation of the same version has another tag
+        assert etag_of(client, f'{path}?fields=id') != etag
+    assert client.get('/firewalls/999', headers={'If-None-Match': '"1-0"'}).status_code == 404
+
+
+def test_rule_changes_renew_the_tags(client, api):
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    api.attach(firewall, policy)
+    paths = (f'/firewalls/{firewall}', f'/policies/{policy}')
+    tags = [etag_of(client, path) for path in paths]
+
+    rule = api.rule(policy, **RULE)
+    renewed = [etag_of(client, path) for path in paths]
+    assert all(new != old for new, old in zip(renewed, tags))
+    for path, etag in zip(paths, tags):
+        assert client.get(path, headers={'If-None-Match': etag}).status_code == 200
+
+    top = api.rule(policy, **RULE)
+    renewed = [etag_of(client, path) for path in paths]
+    response = client.post(f"/rules/{top['id']}/move", json={'before': rule['id']})
+    assert response.status_code == 200
+    updated = [etag_of(client, path) for path in paths]
+    assert all(new != old for new, old in zip(updated, renewed))
+
+
+def test_associations_renew_the_firewall_tag(client, api):
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    path = f'/firewalls/{firewall}'
+    detached = etag_of(client, path)
+    api.attach(firewall, policy)
+    attached = etag_of(client, path)
+    assert attached != detached
+    assert client.delete(f'/firewall-policy/{firewall}/remove/{policy}').status_code == 204
+    assert etag_of(client, path) not in (attached, detached)
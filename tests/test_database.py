@@ -0,0 +1,73 @@
+"Tests of the engine profiles, the SQLite pragmas and the read/write session routing"
+import pytest
+from sqlalchemy import event, text
+from app.database import READ_ENGINE_KEY, engine_options, resolve_profile
+from app.extensions import db
+
+
+def config(**values) -> dict:
+    settings = {'DB_PROFILE': 'auto', 'SQLALCHEMY_DATABASE_URI': 'sqlite:///jouerflux.db',
+                'SQLITE_BUSY_TIMEOUT': 5000, 'DB_POOL_SIZE': 10, 'DB_MAX_OVERFLOW': 20,
+                'DB_POOL_TIMEOUT': 30, 'DB_POOL_RECYCLE': 1800}
+    settings.update(values)
+    return settings
+
+
+def test_profiles():
+    assert resolve_profile(config()) == 'sqlite'
+    assert resolve_profile(config(), 'postgresql+psycopg2://db/jouerflux') == 'postgresql'
+    assert resolve_profile(config(), 'mysql://db/jouerflux') == 'none'
+    assert resolve_profile(config(DB_PROFILE='none')) == 'none'
+    with pytest.raises(ValueError):
+        resolve_profile(config(DB_PROFILE='oracle'))
+
+    assert engine_options(config()) == {'connect_args': {'timeout': 5}}
+    assert engine_options(config(SQLALCHEMY_DATABASE_URI='sqlite://')) == {}
+    options = engine_options(config(SQLALCHEMY_DATABASE_URI='postgresql://db/jouerflux'))
+    assert (options['pool_size'], options['max_overflow'], options['pool_pre_ping']) == \
+        (10, 20, True)
+
+
+def pragma(engine, name: str):
+    with engine.connect() as connection:
+        return connection.execute(text(f"PRAGMA {name}")).scalar()
+
+
+def test_sqlite_pragmas(app):
+    read_engine = app.extensions[READ_ENGINE_KEY]
+    with app.app_context():
+        primary = db.engine
+    assert pragma(primary, 'journal_mode') == 'wal'
+    assert pragma(primary, 'foreign_keys') == 1
+    assert pragma(primary, 'busy_timeout') == 5000
+    assert pragma(primary, 'query_only') == 0
+    assert pragma(read_engine, 'query_only') == 1
+    assert read_engine.url == primary.url
+
+
+def test_reads_and_writes_are_routed(app, client, api):
+    read_engine = app.extensions[READ_ENGINE_KEY]
+    with app.app_context():
+        primary = db.engine
+    routed = {primary: [], read_engine: []}
+    listeners = {engine: (lambda conn, *args, engine=engine: routed[engine].append(args[1]))
+                 for engine in routed}
+    for engine, listener in listeners.items():
+        event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        assert client.post('/firewalls', json={'name': 'fw'}).status_code == 201
+        assert routed[primary] and not routed[read_engine]
+        assert any(statement.startswith('INSERT') for statement in routed[primary])
+
+        routed[primary].clear()
+        assert client.get('/firewalls/').status_code == 200
+        assert client.get('/firewalls/1').status_code == 200
+        assert routed[read_engine] and not routed[primary]
+    finally:
+        for engine, listener in listeners.items():
+            event.remove(engine, 'before_cursor_execute', listener)
+
+
+@pytest.mark.parametrize('app_config', [{'SQLALCHEMY_DATABASE_URI': 'sqlite://'}])
+def test_memory_databases_keep_a_single_engine(app):
+    assert READ_ENGINE_KEY not in app.extensions
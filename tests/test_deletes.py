@@ -0,0 +1,103 @@
+"Tests of the cascading deletes and of the background jobs running the large ones"
+import time
+import pytest
+from sqlalchemy import func, select
+from app.extensions import db
+from app.models import ChangeLog, Firewall, Policy, Rule, firewall_policy
+
+RULE = {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+        'destination_ip': '0.0.0.0/0'}
+
+
+@pytest.fixture
+def app_config():
+    return {'JOB_POLICY_RULES': 5, 'JOB_BULK_PAIRS': 4, 'DELETE_BATCH_SIZE': 2,
+            'DELETE_BATCH_PAUSE_MS': 0}
+
+
+def count(app, table, *conditions) -> int:
+    with app.app_context():
+        return db.session.execute(select(func.count()).select_from(table).where(*conditions)) \
+            .scalar()
+
+
+def wait_for(client, response) -> dict:
+    """Follow the job of a 202 response until it ends."""
+    assert response.status_code == 202
+    location = response.headers['Location']
+    assert location.endswith(f"/jobs/{response.get_json()['id']}")
+    for _ in range(100):
+        job = client.get(location).get_json()
+        if job['status'] not in ('pending', 'running'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"Job still {job['status']}")
+
+
+def test_policy_delete_cascades_without_loading_the_rules(app, client, api, statements):
+    firewall, policy, kept = api.firewall('fw'), api.policy('p'), api.policy('kept')
+    api.attach(firewall, policy)
+    api.attach(firewall, kept)
+    for port in range(5):
+        api.rule(policy, port=port + 1, **RULE)
+    api.rule(kept, port=80, **RULE)
+
+    statements.clear()
+    assert client.delete(f'/policies/{policy}').status_code == 204
+    # The rules are only counted, against JOB_POLICY_RULES, never loaded
+    assert not any('FROM rule' in statement and 'count(*)' not in statement
+                   for statement in statements)
+    assert count(app, Rule, Rule.policy_id == policy) == 0
+    assert count(app, firewall_policy, firewall_policy.c.policy_id == policy) == 0
+    assert count(app, Rule) == 1
+    assert api.client.get(f'/policies/{policy}').status_code == 404
+
+
+def test_firewall_delete_detaches_its_policies(app, client, api):
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    api.attach(firewall, policy)
+    api.rule(policy, port=22, **RULE)
+    assert client.delete(f'/firewalls/{firewall}').status_code == 204
+    assert count(app, firewall_policy) == 0
+    assert count(app, Policy) == 1
+    assert count(app, Rule) == 1
+    assert client.delete(f'/firewalls/{firewall}').status_code == 404
+
+
+def test_large_policies_are_deleted_by_a_job(app, client, api):
+    firewall, policy = api.firewall('fw'), api.policy('large')
+    api.attach(firewall, policy)
+    for port in range(7):
+        api.rule(policy, port=port + 1, **RULE)
+    assert api.evaluate(firewall, protocol='TCP', source_ip='10.0.0.1',
+                        destination_ip='1.1.1.1', port=3)['action'] == 'ALLOW'
+
+    job = wait_for(client, client.delete(f'/policies/{policy}'))
+    assert (job['kind'], job['status']) == ('delete_policy', 'succeeded')
+    assert job['result'] == {'policy_id': policy, 'firewalls_detached': 1, 'rules_deleted': 7}
+    assert job['progress'] == {'rules_deleted': 7, 'rules_total': 7}
+    assert job['finished_at'] is not None
+    assert count(app, Rule) == count(app, Policy) == 0
+    # The firewall lost the policy, and the agents are told so
+    assert api.evaluate(firewall, protocol='TCP', source_ip='10.0.0.1',
+                        destination_ip='1.1.1.1', port=3)['action'] == 'DENY'
+    with app.app_context():
+        entries = db.session.execute(select(ChangeLog.entity, ChangeLog.op)
+                                     .order_by(ChangeLog.seq.desc()).limit(2)).all()
+    assert entries == [('policy', 'delete'), ('firewall_policy', 'detach')]
+
+
+def test_large_bulk_associations_run_as_a_job(app, client, api):
+    firewalls = [api.firewall(f'fw{index}') for index in range(3)]
+    policies = [api.policy(f'p{index}') for index in range(2)]
+    body = {'attach': {'firewall_ids': firewalls, 'policy_ids': policies}}
+    job = wait_for(client, client.post('/firewall-policy/bulk', json=body))
+    assert (job['kind'], job['status']) == ('bulk_associate', 'succeeded')
+    assert count(app, firewall_policy) == 6
+    with app.app_context():
+        versions = db.session.execute(select(Firewall.version)).scalars().all()
+    assert all(version > 1 for version in versions)
+
+
+def test_unknown_job(client):
+    assert client.get('/jobs/999').status_code == 404
@@ -0,0 +1,69 @@
+"Tests of the text of the firewall exports"
+import pytest
+
+
+@pytest.fixture
+def firewall(api):
+    firewall, policy = api.firewall('edge'), api.policy('p')
+    first = api.rule(policy, action='ALLOW', protocol='TCP', source_ip='10.0.0.0/8',
+                     destination_ip='192.168.1.0/24', port=443)
+    second = api.rule(policy, action='DENY', protocol='UDP', source_ip='0.0.0.0/0',
+                      destination_ip='0.0.0.0/0', port=1000, port_end=2000)
+    third = api.rule(policy, action='ALLOW', protocol='ICMP', source_ip='2001:db8::/32',
+                     destination_ip='::/0')
+    api.attach(firewall, policy)
+    return firewall, (first['id'], second['id'], third['id'])
+
+
+def export(client, firewall_id: int, fmt: str) -> str:
+    response = client.get(f'/firewalls/{firewall_id}/export?format={fmt}')
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_iptables_export(client, firewall):
+    firewall_id, (first, second, third) = firewall
+    assert export(client, firewall_id, 'iptables') == (
+        '# Generated by JouerFlux for firewall edge\n'
+        '*filter\n'
+        ':JOUERFLUX - [0:0]\n'
+        '-A FORWARD -j JOUERFLUX\n'
+        f'-A JOUERFLUX -s 10.0.0.0/8 -d 192.168.1.0/24 -p tcp --dport 443 '
+        f'-m comment --comment "jouerflux rule {first}" -j ACCEPT\n'
+        f'-A JOUERFLUX -s 0.0.0.0/0 -d 0.0.0.0/0 -p udp --dport 1000:2000 '
+        f'-m comment --comment "jouerflux rule {second}" -j DROP\n'
+        f'# skipped rule {third}: not an IPv4 rule\n'
+        '-A JOUERFLUX -j DROP\n'
+        'COMMIT\n')
+
+
+def test_ip6tables_export(client, firewall):
+    firewall_id, (first, second, third) = firewall
+    assert export(client, firewall_id, 'ip6tables') == (
+        '# Generated by JouerFlux for firewall edge\n'
+        '*filter\n'
+        ':JOUERFLUX - [0:0]\n'
+        '-A FORWARD -j JOUERFLUX\n'
+        f'# skipped rule {first}: not an IPv6 rule\n'
+        f'# skipped rule {second}: not an IPv6 rule\n'
+        f'-A JOUERFLUX -s 2001:db8::/32 -d ::/0 -p ipv6-icmp '
+        f'-m comment --comment "jouerflux rule {third}" -j ACCEPT\n'
+        '-A JOUERFLUX -j DROP\n'
+        'COMMIT\n')
+
+
+def test_nft_export(client, firewall):
+    firewall_id, (first, second, third) = firewall
+    assert export(client, firewall_id, 'nft') == (
+        '# Generated by JouerFlux for firewall edge\n'
+        'table inet jouerflux {\n'
+        f'\tchain fw_{firewall_id} {{\n'
+        '\t\ttype filter hook forward priority 0; policy drop;\n'
+        f'\t\tip saddr 10.0.0.0/8 ip daddr 192.168.1.0/24 tcp dport 443 '
+        f'comment "jouerflux rule {first}" accept\n'
+        f'\t\tip saddr 0.0.0.0/0 ip daddr 0.0.0.0/0 udp dport 1000-2000 '
+        f'comment "jouerflux rule {second}" drop\n'
+        f'\t\tip6 saddr 2001:db8::/32 ip6 daddr ::/0 meta l4proto ipv6-icmp '
+        f'comment "jouerflux rule {third}" accept\n'
+        '\t}\n'
+        '}\n')
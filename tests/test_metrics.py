@@ -0,0 +1,99 @@
+"Tests of the Prometheus metrics: text format, request and SQL counts, streamed responses"
+import re
+import pytest
+from app.metrics import METRICS_KEY, Registry, fingerprint
+
+
+@pytest.fixture
+def app_config():
+    return {'METRICS_ENABLED': True, 'SLOW_QUERY_MS': 0,
+            'CHANGES_STREAM_SECONDS': 0.3, 'CHANGES_HEARTBEAT': 0.1}
+
+
+def scrape(client) -> dict:
+    """Return the samples of /metrics by name and labels."""
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    response.close()
+    return samples
+
+
+def test_fingerprint_folds_literals_and_parameter_lists():
+    first = fingerprint("SELECT * FROM rule  WHERE id IN (?, ?, ?) AND name = 'a'")
+    second = fingerprint("SELECT * FROM rule WHERE id IN (?) AND name = 'b''c'")
+    assert first == second
+    assert first[1] == "SELECT * FROM rule WHERE id IN (?) AND name = ?"
+    assert first != fingerprint("SELECT * FROM policy WHERE id IN (?)")
+
+
+def test_text_format():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests.', ('path',))
+    counter.inc('/a"b\\')
+    counter.inc('/a"b\\', amount=2)
+    histogram = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert registry.render() == '\n'.join([
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{path="/a\\"b\\\\"} 3',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        'latency_seconds_sum 5.55',
+        'latency_seconds_count 3',
+    ]) + '\n'
+    assert registry.counter('requests_total', 'Ignored.') is counter
+
+
+def test_requests_and_statements_are_counted(client, api):
+    api.firewall('fw')
+    for _ in range(3):
+        with client.get('/firewalls/') as response:
+            assert response.status_code == 200
+    with client.get('/firewalls/999') as response:
+        assert response.status_code == 404
+
+    samples = scrape(client)
+    listing = 'endpoint="firewalls.list_firewalls"'
+    assert samples[f'jouerflux_http_requests_total{{{listing},method="GET",status="200"}}'] == 3
+    assert samples['jouerflux_http_requests_total{endpoint="firewalls.get_firewall",'
+                   'method="GET",status="404"}'] == 1
+    assert samples[f'jouerflux_http_request_duration_seconds_count{{{listing},method="GET"}}'] == 3
+    # Each listing runs at least one statement, counted in the totals too
+    assert samples[f'jouerflux_http_request_queries_bucket{{{listing},le="0"}}'] == 0
+    assert samples[f'jouerflux_http_request_queries_sum{{{listing}}}'] >= 3
+    assert samples['jouerflux_db_queries_total'] >= samples[
+        f'jouerflux_http_request_queries_sum{{{listing}}}']
+    # Every statement is slower than SLOW_QUERY_MS=0, and has a fingerprint
+    slow = [name for name in samples if name.startswith('jouerflux_db_slow_queries_total')]
+    assert slow and all(re.search(r'fingerprint="[0-9a-f]{8}"', name) for name in slow)
+
+
+def test_streamed_responses_are_recorded_once_sent(app, client, api):
+    api.rule(api.policy('p'), action='ALLOW', protocol='TCP', source_ip='10.0.0.0/8',
+             destination_ip='0.0.0.0/0', port=443)
+    stream = 'endpoint="changes.list_changes",method="GET"'
+    response = client.get('/changes/?since=0', headers={'Accept': 'text/event-stream'})
+    # Rendered directly: another request would interleave with the context of the stream
+    assert f'jouerflux_http_request_duration_seconds_count{{{stream}}}' \
+        not in app.extensions[METRICS_KEY].render()
+
+    assert 'event: change' in response.get_data(as_text=True)
+    response.close()
+    samples = scrape(client)
+    assert samples[f'jouerflux_http_request_duration_seconds_count{{{stream}}}'] == 1
+    # The stream lasted CHANGES_STREAM_SECONDS, its body included
+    assert samples[f'jouerflux_http_request_duration_seconds_bucket{{{stream},le="0.25"}}'] == 0
+    # The statements run by the body are counted with the request
+    assert samples['jouerflux_http_request_queries_sum{endpoint="changes.list_changes"}'] >= 2
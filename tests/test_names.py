@@ -0,0 +1,77 @@
+"Tests of the name search of firewalls and policies: FTS5 trigram index, prefix range and scan"
+import pytest
+from sqlalchemy import text
+from app.extensions import db
+
+NAMES = ['edge-paris', 'Edge-Lyon', 'core-paris', 'dmz_zone', 'lab']
+
+
+@pytest.fixture
+def firewalls(api) -> dict:
+    return {name: api.firewall(name) for name in NAMES}
+
+
+def search(client, name: str, match: str = None, path: str = '/firewalls/') -> list:
+    query = {'name': name, 'per_page': 50}
+    if match:
+        query['match'] = match
+    response = client.get(path, query_string=query)
+    assert response.status_code == 200, response.get_json()
+    return sorted(item['name'] for item in response.get_json()['results'])
+
+
+def test_substring_search_uses_the_trigram_index(client, firewalls, statements):
+    statements.clear()
+    assert search(client, 'paris') == ['core-paris', 'edge-paris']
+    assert any('MATCH' in statement for statement in statements)
+    # Case-insensitive like the scan it replaces; the term is a phrase, not an FTS query
+    assert search(client, 'EDGE') == ['Edge-Lyon', 'edge-paris']
+    assert search(client, 'z_zo') == ['dmz_zone']
+    assert search(client, 'paris OR lab') == []
+    assert search(client, 'a"b*') == []
+
+    # Terms shorter than a trigram scan the table
+    statements.clear()
+    assert search(client, 'ab') == ['lab']
+    assert not any('MATCH' in statement for statement in statements)
+
+
+def test_prefix_search_is_a_name_range(client, firewalls, statements):
+    statements.clear()
+    assert search(client, 'edge-', match='prefix') == ['edge-paris']
+    assert not any('MATCH' in statement or 'LIKE' in statement for statement in statements)
+    assert search(client, 'Edge', match='prefix') == ['Edge-Lyon']
+    response = client.get('/firewalls/', query_string={'name': 'edge', 'match': 'regex'})
+    assert response.status_code == 400
+
+
+def test_index_follows_the_writes(client, api, firewalls):
+    assert client.delete(f"/firewalls/{firewalls['edge-paris']}").status_code in (200, 204)
+    assert search(client, 'paris') == ['core-paris']
+    api.firewall('paris-2')
+    assert search(client, 'paris') == ['core-paris', 'paris-2']
+
+    policy = api.policy('allow-paris')
+    api.policy('deny-lyon')
+    assert search(client, 'paris', path='/policies/') == ['allow-paris']
+    assert client.delete(f'/policies/{policy}').status_code in (200, 202, 204)
+    assert search(client, 'paris', path='/policies/') == []
+
+
+@pytest.mark.parametrize('app_config', [{'SEARCH_BACKEND': 'scan'}])
+def test_scan_backend(client, firewalls, statements):
+    statements.clear()
+    assert search(client, 'paris') == ['core-paris', 'edge-paris']
+    assert not any('MATCH' in statement for statement in statements)
+
+
+def test_rebuild_restores_a_missing_index(app, client, firewalls):
+    with app.app_context(), db.engine.begin() as connection:
+        for statement in ("DROP TRIGGER firewall_name_fts_insert",
+                          "DROP TRIGGER firewall_name_fts_delete",
+                          "DROP TRIGGER firewall_name_fts_update",
+                          "DROP TABLE firewall_name_fts"):
+            connection.execute(text(statement))
+    result = app.test_cli_runner().invoke(args=['search', 'rebuild'])
+    assert result.exit_code == 0, result.output
+    assert search(client, 'paris') == ['core-paris', 'edge-paris']
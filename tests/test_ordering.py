@@ -0,0 +1,123 @@
+"Tests of the fractional ordering keys, down to their precision limit and through rebalances"
+import time
+import pytest
+from sqlalchemy import select
+from app.extensions import db
+from app.models import firewall_policy
+from app.routes import firewall_policy as firewall_policy_routes, rules as rules_routes
+from app.utils.ordering import (ORDER_GAP, POLICY_ORDER, RULE_ORDER, is_cramped, key_between,
+                                schedule_rebalance)
+
+# Enough insertions between the same two items to exhaust the doubles of the gap
+INSERTIONS = 60
+
+
+def test_key_between_down_to_the_precision_limit():
+    before, after = ORDER_GAP, 2 * ORDER_GAP
+    cramped_at = None
+    for step in range(1, 200):
+        key = key_between(before, after)
+        if key is None:
+            break
+        assert before < key < after
+        if cramped_at is None and is_cramped(before, key):
+            cramped_at = step
+        after = key
+    else:
+        pytest.fail('key_between never ran out of precision')
+    # The rebalance is scheduled long before the keys run out
+    assert cramped_at is not None
+    assert step - cramped_at >= 15
+    assert key_between(before, before) is None
+    assert not is_cramped(None, before) and not is_cramped(before, None)
+
+
+@pytest.fixture
+def rebalances(monkeypatch):
+    """Rebalances scheduled by the routes, recorded instead of run in the background."""
+    scheduled = []
+    record = lambda collection, scope_id: scheduled.append((collection.name, scope_id))
+    monkeypatch.setattr(firewall_policy_routes, 'schedule_rebalance', record)
+    monkeypatch.setattr(rules_routes, 'schedule_rebalance', record)
+    return scheduled
+
+
+def rebalance(client, collection, scope_id: int):
+    """Run the rebalance job of a scope, like the routes schedule it, and wait for it."""
+    job_id = schedule_rebalance(collection, scope_id).id
+    for _ in range(100):
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['status'] not in ('pending', 'running'):
+            break
+        time.sleep(0.05)
+    assert job['status'] == 'succeeded', job
+    assert job['result'] == {'rebalanced': INSERTIONS + 2}
+
+
+def attached_policies(firewall_id: int) -> list:
+    return db.session.execute(
+        select(firewall_policy.c.policy_id, firewall_policy.c.position)
+        .where(firewall_policy.c.firewall_id == firewall_id)
+        .order_by(firewall_policy.c.position, firewall_policy.c.policy_id)).all()
+
+
+def test_policies_inserted_in_the_same_gap(app, api, rebalances):
+    firewall = api.firewall('fw')
+    first, last = api.policy('first'), api.policy('last')
+    api.attach(firewall, first)
+    api.attach(firewall, last)
+    # Each policy goes right before the last one, halving the same gap
+    inserted = []
+    for index in range(INSERTIONS):
+        policy = api.policy(f'p{index}')
+        api.attach(firewall, policy, before=last)
+        inserted.append(policy)
+    expected = [first] + inserted + [last]
+    assert rebalances and set(rebalances) == {('policies', firewall)}
+
+    with app.app_context():
+        rows = attached_policies(firewall)
+        assert [policy_id for policy_id, _ in rows] == expected
+        # The keys ran out and the firewall was rebalanced inline at least once
+        assert len({position for _, position in rows}) == len(rows)
+        assert max(position for _, position in rows) > 2 * ORDER_GAP
+
+    rebalance(api.client, POLICY_ORDER, firewall)
+    with app.app_context():
+        rows = attached_policies(firewall)
+        assert [policy_id for policy_id, _ in rows] == expected
+        assert [position for _, position in rows] == [ORDER_GAP * (index + 1)
+                                                      for index in range(len(rows))]
+
+    # Placing keeps working after the rebalance
+    policy = api.policy('after')
+    api.attach(firewall, policy, after=first)
+    with app.app_context():
+        assert [policy_id for policy_id, _ in attached_policies(firewall)] == \
+            [first, policy] + inserted + [last]
+
+
+def test_rules_inserted_in_the_same_gap(app, api, rebalances):
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    # Every rule matches every TCP flow, the first one in order wins
+    rule = lambda **order: api.rule(policy, action='ALLOW', protocol='TCP',
+                                    source_ip='10.0.0.0/8', destination_ip='0.0.0.0/0',
+                                    **order)['id']
+    first, last = rule(), rule()
+    inserted = [rule(before=last) for _ in range(INSERTIONS)]
+    expected = [first] + inserted + [last]
+    assert rebalances and set(rebalances) == {('rules', policy)}
+
+    listed = lambda: [item['id'] for item in api.client.get(f'/rules/policy/{policy}').get_json()]
+    assert listed() == expected
+
+    rebalance(api.client, RULE_ORDER, policy)
+    assert listed() == expected
+
+    api.attach(firewall, policy)
+    flow = {'protocol': 'TCP', 'source_ip': '10.0.0.1', 'destination_ip': '1.1.1.1', 'port': 80}
+    assert api.evaluate(firewall, **flow)['rule']['id'] == first
+    response = api.client.post(f'/rules/{last}/move', json={'before': first})
+    assert response.status_code == 200
+    assert listed() == [last, first] + inserted
+    assert api.evaluate(firewall, **flow)['rule']['id'] == last
@@ -0,0 +1,73 @@
+"Tests of the expand/fields projection: requested columns, embedded collections, query counts"
+import pytest
+
+RULE = {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+        'destination_ip': '0.0.0.0/0'}
+
+
+def policies_with_rules(api, count: int, rules: int = 3) -> list:
+    policies = []
+    for index in range(count):
+        policy = api.policy(f'p{index}')
+        for port in range(rules):
+            api.rule(policy, port=1000 + port, **RULE)
+        policies.append(policy)
+    return policies
+
+
+def test_fields_restrict_the_columns(client, api):
+    policy = policies_with_rules(api, 1)[0]
+    body = client.get('/policies/?fields=name&expand=').get_json()
+    assert body['results'] == [{'name': 'p0'}]
+
+    body = client.get('/policies/?fields=id,rules.port').get_json()
+    assert body['results'] == [{'id': policy, 'rules': [{'port': 1000}, {'port': 1001},
+                                                        {'port': 1002}]}]
+
+    body = client.get(f'/policies/{policy}?expand=firewalls&fields=firewalls.name').get_json()
+    assert body['firewalls'] == []
+    assert 'rules' not in body
+
+
+@pytest.mark.parametrize('query', ['expand=owners', 'fields=secret', 'fields=rules.port&expand=',
+                                   'fields=rules.secret'])
+def test_invalid_projection(client, query):
+    response = client.get(f'/policies/?{query}')
+    assert response.status_code == 400
+    assert 'Invalid' in response.get_json()['error']
+
+
+def test_embedded_collections_keep_the_evaluation_order(client, api):
+    firewall = api.firewall('fw')
+    last, first = api.policy('last'), api.policy('first')
+    api.attach(firewall, last)
+    api.attach(firewall, first, before=last)
+    body = client.get(f'/firewalls/{firewall}?fields=id,policies.name').get_json()
+    assert body == {'id': firewall, 'policies': [{'name': 'first'}, {'name': 'last'}]}
+
+    rule = api.rule(last, port=80, **RULE)
+    top = api.rule(last, port=22, before=rule['id'], **RULE)
+    body = client.get(f'/policies/{last}?fields=rules.id').get_json()
+    assert body['rules'] == [{'id': top['id']}, {'id': rule['id']}]
+
+
+def test_listing_costs_a_constant_number_of_queries(client, api, statements):
+    def listing_queries(per_page: int) -> int:
+        statements.clear()
+        response = client.get('/policies/', query_string={'per_page': per_page,
+                                                          'expand': 'rules,firewalls'})
+        assert len(response.get_json()['results']) == per_page
+        return len(statements)
+
+    policies_with_rules(api, 20)
+    assert listing_queries(2) == listing_queries(20)
+
+
+def test_unrequested_columns_are_not_loaded(client, api, statements):
+    api.policy('p')
+    statements.clear()
+    client.get('/policies/?fields=id&expand=')
+    page_query, = [statement for statement in statements
+                   if statement.startswith('SELECT') and 'FROM policy' in statement
+                   and 'count(' not in statement.lower()]
+    assert 'policy.name' not in page_query
@@ -0,0 +1,101 @@
+"Tests of the streamed listings: encoding piece by piece and content-coding negotiation"
+import gzip
+import json
+import pytest
+from werkzeug.http import parse_accept_header
+from app.utils.responses import JsonArray, init_compression, iter_json, negotiate_encoding
+
+RULE = {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+        'destination_ip': '0.0.0.0/0'}
+
+
+def compact(value) -> str:
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 1000])
+def test_pieces_join_into_the_whole_document(batch_size):
+    nested = [{'id': 1, 'rules': JsonArray([{'port': 22}, {'port': 443}])}, {'id': 2}, 3]
+    document = {'total': 3, 'results': JsonArray(iter(nested)), 'empty': JsonArray([])}
+    expected = {'total': 3, 'results': [{'id': 1, 'rules': [{'port': 22}, {'port': 443}]},
+                                        {'id': 2}, 3], 'empty': []}
+    assert ''.join(iter_json(document, compact, batch_size=batch_size)) == compact(expected)
+    plain = JsonArray(iter([[1, 2], [], [3]]), plain=True)
+    assert ''.join(iter_json(plain, compact)) == '[1,2,3]'
+
+
+def test_negotiation_follows_the_qualities():
+    def accept(header: str):
+        return parse_accept_header(header)
+
+    offered = ['zstd', 'br', 'gzip']
+    assert negotiate_encoding(accept('gzip, br'), offered) == 'br'
+    assert negotiate_encoding(accept('br;q=0.5, gzip'), offered) == 'gzip'
+    assert negotiate_encoding(accept('*'), offered) == 'zstd'
+    assert negotiate_encoding(accept('gzip;q=0, identity'), offered) is None
+    assert negotiate_encoding(accept(''), offered) is None
+    assert negotiate_encoding(accept('gzip'), []) is None
+
+
+@pytest.fixture
+def app_config():
+    # Small chunks, so that a page is sent in several of them
+    return {'STREAM_CHUNK_SIZE': 64, 'LISTING_YIELD_PER': 2}
+
+
+@pytest.fixture
+def policies(api) -> list:
+    created = []
+    for index in range(3):
+        policy = api.policy(f'p{index}')
+        for port in range(4):
+            api.rule(policy, port=port + 1, **RULE)
+        created.append(policy)
+    return created
+
+
+def listing(client, path: str, encoding: str = None):
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    return client.get(path, headers=headers, buffered=False)
+
+
+def test_listing_is_streamed_and_gzipped(client, policies):
+    plain = listing(client, '/policies/')
+    assert plain.is_streamed
+    assert plain.headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Encoding' not in plain.headers
+    assert len(list(plain.response)) > 1
+    expected = json.loads(listing(client, '/policies/').get_data())
+    assert expected['total'] == 3
+    assert [len(policy['rules']) for policy in expected['results']] == [4, 4, 4]
+
+    compressed = listing(client, '/policies/', 'gzip')
+    assert compressed.is_streamed
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(gzip.decompress(compressed.get_data())) == expected
+
+
+def test_firewall_policies_are_streamed(client, api, policies):
+    firewall = api.firewall('fw')
+    for policy in policies:
+        api.attach(firewall, policy)
+    response = listing(client, f'/firewall-policy/{firewall}/policies', 'gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    body = json.loads(gzip.decompress(response.get_data()))
+    assert [policy['id'] for policy in body['results']] == policies
+
+
+@pytest.mark.parametrize('app_config', [{'RESPONSE_COMPRESSION': ''}])
+def test_compression_can_be_disabled(client, policies):
+    response = listing(client, '/policies/', 'gzip, br, zstd')
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.get_data())['total'] == 3
+
+
+def test_unknown_coding_is_rejected(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'RESPONSE_COMPRESSION', 'gzip,deflate')
+    with pytest.raises(ValueError):
+        init_compression(app)
+    monkeypatch.setitem(app.config, 'RESPONSE_COMPRESSION', ' gzip , ')
+    assert init_compression(app) == ['gzip']
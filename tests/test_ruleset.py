@@ -0,0 +1,152 @@
+"Tests of the compiled rule index against a first-match scan, and of its invalidation"
+import ipaddress
+import random
+import pytest
+from sqlalchemy import update
+from app.extensions import db
+from app.models import Rule
+from app.utils.ruleset import CompiledRuleset, ruleset_cache
+from app.utils.versions import bump_versions
+
+# Small pools, so that rules overlap a lot
+SOURCES = ['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.3', '192.168.0.0/16',
+           '::/0', '2001:db8::/32', '2001:db8:1::/48', '2001:db8:1::5']
+DESTINATIONS = ['0.0.0.0/0', '172.16.0.0/12', '172.16.5.0/24', '172.16.5.9', '8.8.8.8',
+                '::/0', 'fd00::/8', 'fd00::1']
+PORTED = ('TCP', 'UDP')
+UNPORTED = ('ICMP', 'GRE', 'ALL')
+PORTS = (22, 53, 80, 443, 8080)
+
+FLOW_SOURCES = ['10.1.2.3', '10.1.2.4', '10.1.9.9', '10.9.9.9', '192.168.1.1', '11.0.0.1',
+                '2001:db8:1::5', '2001:db8:1::6', '2001:db8:2::1', '2002::1']
+FLOW_DESTINATIONS = ['172.16.5.9', '172.16.5.10', '172.17.0.1', '8.8.8.8', '1.1.1.1',
+                     'fd00::1', 'fd00::2', '2001:db8::9']
+
+
+def random_rule(rng, rule_id: int) -> dict:
+    protocol = rng.choice(PORTED + UNPORTED)
+    port = port_end = None
+    if protocol in PORTED and rng.random() < 0.8:
+        port = rng.choice(PORTS)
+        if rng.random() < 0.3:
+            port_end = port + rng.choice((1, 10, 1000))
+    return {'id': rule_id, 'action': rng.choice(('ALLOW', 'DENY')), 'protocol': protocol,
+            'source_ip': rng.choice(SOURCES), 'destination_ip': rng.choice(DESTINATIONS),
+            'port': port, 'port_end': port_end, 'policy_id': 1}
+
+
+def first_match(rules: list, protocol: str, source, destination, port):
+    """Scan the rules in order, like the evaluation before the index."""
+    for rule in rules:
+        if rule['protocol'] not in (protocol, 'ALL'):
+            continue
+        if rule['port'] is not None:
+            end = rule['port_end'] if rule['port_end'] is not None else rule['port']
+            if port is None or not rule['port'] <= port <= end:
+                continue
+        if (source in ipaddress.ip_network(rule['source_ip'])
+                and destination in ipaddress.ip_network(rule['destination_ip'])):
+            return rule
+    return None
+
+
+def flows(rng, count: int):
+    for _ in range(count):
+        protocol = rng.choice(PORTED + UNPORTED[:2])
+        port = None
+        if protocol in PORTED:
+            port = rng.choice(PORTS + (23, 54, 90, 1043, 9000))
+        yield (protocol, ipaddress.ip_address(rng.choice(FLOW_SOURCES)),
+               ipaddress.ip_address(rng.choice(FLOW_DESTINATIONS)), port)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_index_matches_first_match_scan(seed):
+    rng = random.Random(seed)
+    rules = [random_rule(rng, rule_id) for rule_id in range(1, 301)]
+    compiled = CompiledRuleset(1, [1], rules)
+    for protocol, source, destination, port in flows(rng, 2000):
+        expected = first_match(rules, protocol, source, destination, port)
+        assert compiled.lookup(protocol, source, destination, port) is expected, \
+            (protocol, source, destination, port)
+
+
+def test_index_keeps_the_first_of_equal_rules():
+    rules = [
+        {'id': 1, 'action': 'DENY', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+         'destination_ip': '0.0.0.0/0', 'port': 80, 'port_end': None},
+        {'id': 2, 'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+         'destination_ip': '0.0.0.0/0', 'port': 80, 'port_end': None},
+        {'id': 3, 'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+         'destination_ip': '0.0.0.0/0', 'port': 70, 'port_end': 90},
+    ]
+    compiled = CompiledRuleset(1, [1], rules)
+    lookup = lambda port: compiled.lookup('TCP', ipaddress.ip_address('10.0.0.1'),
+                                          ipaddress.ip_address('1.2.3.4'), port)
+    assert lookup(80)['id'] == 1
+    assert lookup(81)['id'] == 3
+    assert lookup(91) is None
+    # Address families never cross
+    assert compiled.lookup('TCP', ipaddress.ip_address('::1'),
+                           ipaddress.ip_address('1.2.3.4'), 80) is None
+
+
+FLOW = {'protocol': 'TCP', 'source_ip': '10.1.2.3', 'destination_ip': '172.16.5.9', 'port': 443}
+
+
+def test_index_is_rebuilt_after_a_rule_change(app, api):
+    firewall = api.firewall('fw')
+    policy = api.policy('p')
+    api.attach(firewall, policy)
+    assert api.evaluate(firewall, **FLOW) == {'action': 'DENY', 'matched': False, 'rule': None}
+
+    rule = api.rule(policy, action='ALLOW', protocol='TCP', source_ip='10.0.0.0/8',
+                    destination_ip='0.0.0.0/0', port=443)
+    assert api.evaluate(firewall, **FLOW)['rule']['id'] == rule['id']
+
+    before = api.rule(policy, action='DENY', protocol='ALL', source_ip='10.1.2.3',
+                      destination_ip='0.0.0.0/0', before=rule['id'])
+    assert api.evaluate(firewall, **FLOW)['rule']['id'] == before['id']
+
+    assert api.client.delete(f"/rules/{before['id']}").status_code in (200, 204)
+    assert api.evaluate(firewall, **FLOW)['rule']['id'] == rule['id']
+
+
+def test_index_is_rebuilt_after_a_policy_change(app, api):
+    firewall = api.firewall('fw')
+    allow, deny = api.policy('allow'), api.policy('deny')
+    api.rule(allow, action='ALLOW', protocol='TCP', source_ip='0.0.0.0/0',
+             destination_ip='0.0.0.0/0', port=443)
+    api.rule(deny, action='DENY', protocol='ALL', source_ip='10.0.0.0/8',
+             destination_ip='0.0.0.0/0')
+    api.attach(firewall, allow)
+    assert api.evaluate(firewall, **FLOW)['action'] == 'ALLOW'
+
+    api.attach(firewall, deny, before=allow)
+    assert api.evaluate(firewall, **FLOW)['action'] == 'DENY'
+
+    response = api.client.delete(f'/firewall-policy/{firewall}/remove/{deny}')
+    assert response.status_code in (200, 204)
+    assert api.evaluate(firewall, **FLOW)['action'] == 'ALLOW'
+
+
+def test_index_follows_the_firewall_version(app, api):
+    """A change committed elsewhere only bumps the version, it is seen all the same."""
+    firewall = api.firewall('fw')
+    policy = api.policy('p')
+    rule = api.rule(policy, action='ALLOW', protocol='TCP', source_ip='0.0.0.0/0',
+                    destination_ip='0.0.0.0/0', port=443)
+    api.attach(firewall, policy)
+    assert api.evaluate(firewall, **FLOW)['action'] == 'ALLOW'
+
+    with app.app_context():
+        compiled = ruleset_cache.get(firewall)
+        assert ruleset_cache.get(firewall) is compiled
+        # Written like another worker would, without invalidating this process
+        db.session.execute(update(Rule).where(Rule.id == rule['id']).values(action='DENY'))
+        bump_versions(db.session, policy_ids=[policy])
+        db.session.commit()
+        rebuilt = ruleset_cache.get(firewall)
+        assert rebuilt is not compiled
+        assert rebuilt.version > compiled.version
+    assert api.evaluate(firewall, **FLOW)['action'] == 'DENY'
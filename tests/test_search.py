@@ -0,0 +1,59 @@
+"Tests of the rule search and of its pagination"
+import pytest
+
+
+@pytest.fixture
+def rules(api):
+    """Rules of two policies created in interleaved order, all covering 10.1.2.3 port 80."""
+    first, second = api.policy('first'), api.policy('second')
+    ids = []
+    for index in range(12):
+        policy = first if index % 2 else second
+        rule = api.rule(policy, action='ALLOW', protocol='TCP',
+                        source_ip=f'10.{index}.0.0/16' if index % 3 else '10.0.0.0/8',
+                        destination_ip='0.0.0.0/0', port=80)
+        ids.append(rule['id'])
+    # Inserted before the others, the highest ID comes first in its policy
+    api.rule(first, action='DENY', protocol='ALL', source_ip='0.0.0.0/0',
+             destination_ip='0.0.0.0/0', before=ids[1])
+    return ids
+
+
+def search(client, **params) -> dict:
+    response = client.get('/rules/search', query_string=params)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_search_pages_are_ordered_by_id(client, rules):
+    pages = [search(client, port=80, page=page, per_page=5) for page in (1, 2, 3)]
+    ids = [rule['id'] for page in pages for rule in page['results']]
+    assert ids == sorted(ids)
+    assert len(ids) == len(set(ids)) == 13
+    assert pages[0]['total'] == 13
+
+
+def test_search_cursor_matches_pages(client, rules):
+    cursor_ids, params = [], {'src': '10.0.0.1', 'limit': 2}
+    while True:
+        body = search(client, **params)
+        cursor_ids += [rule['id'] for rule in body['results']]
+        if body['next_cursor'] is None:
+            break
+        params['after'] = body['next_cursor']
+    page_ids = [rule['id'] for rule in search(client, src='10.0.0.1', per_page=50)['results']]
+    assert cursor_ids == page_ids == sorted(page_ids)
+
+
+def test_port_search_skips_protocols_without_ports(client, api):
+    policy = api.policy('p')
+    ids = {}
+    for protocol in ('TCP', 'UDP', 'ALL', 'ICMP', 'GRE', 'ESP'):
+        ids[protocol] = api.rule(policy, action='ALLOW', protocol=protocol,
+                                 source_ip='10.0.0.0/8', destination_ip='0.0.0.0/0')['id']
+    ported = api.rule(policy, action='DENY', protocol='TCP', source_ip='10.0.0.0/8',
+                      destination_ip='0.0.0.0/0', port=443)['id']
+    found = {rule['id'] for rule in search(client, port=443, per_page=50)['results']}
+    assert found == {ids['TCP'], ids['UDP'], ids['ALL'], ported}
+    found = {rule['id'] for rule in search(client, src='10.1.1.1', per_page=50)['results']}
+    assert found == set(ids.values()) | {ported}
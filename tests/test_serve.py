@@ -0,0 +1,27 @@
+"Tests of the pre-fork production server"
+import subprocess
+import sys
+from pathlib import Path
+from app.serve import warm_caches
+from app.utils.ruleset import ruleset_cache
+
+
+def test_numpy_is_not_imported_at_startup(tmp_path):
+    code = ("import sys, app.serve; from app import create_app; "
+            "app.serve.warm_caches(create_app()); print('numpy' in sys.modules)")
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            env={'DATABASE_URL': f"sqlite:///{tmp_path / 'serve.db'}",
+                                 'PATH': ''},
+                            cwd=Path(__file__).parents[1], check=True)
+    assert result.stdout.strip() == 'False'
+
+
+def test_warm_caches_compiles_every_firewall(app, api):
+    firewalls = [api.firewall(f'fw{index}') for index in range(3)]
+    policy = api.policy('p')
+    api.rule(policy, action='ALLOW', protocol='ALL', source_ip='0.0.0.0/0',
+             destination_ip='0.0.0.0/0')
+    api.attach(firewalls[0], policy)
+    ruleset_cache.clear()
+    assert warm_caches(app) == 3
+    assert len(ruleset_cache.get(firewalls[0]).rules) == 1
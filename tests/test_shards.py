@@ -0,0 +1,87 @@
+"Tests of the rules sharded across two SQLite databases"
+import pytest
+from sqlalchemy import select
+from app.extensions import db
+from app.models import Policy, Rule
+from app.shards import rule_shards
+
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'RULE_SHARDS': f"a=sqlite:///{tmp_path / 'a.db'},b=sqlite:///{tmp_path / 'b.db'}"}
+
+
+@pytest.fixture
+def placed(app, api):
+    """Policies of both shards with a few rules each, by shard name."""
+    placed = {}
+    for index in range(16):
+        policy = api.policy(f'policy{index}')
+        with app.app_context():
+            shard = db.session.get(Policy, policy).shard
+        placed.setdefault(shard, []).append(policy)
+    assert set(placed) == {'a', 'b'}
+    return {shard: policies[:2] for shard, policies in placed.items()}
+
+
+def add_rules(api, policy_id: int, count: int = 3) -> list:
+    return [api.rule(policy_id, action='ALLOW', protocol='TCP', source_ip=f'10.{index}.0.0/16',
+                     destination_ip='0.0.0.0/0', port=80 + index) for index in range(count)]
+
+
+def shard_rule_ids(app, name: str) -> set:
+    with app.app_context():
+        return set(db.session.scalars(select(Rule.id),
+                                      bind_arguments=rule_shards().bind_arguments(name)))
+
+
+def test_rules_are_written_and_read_in_their_shard(app, api, placed):
+    created = {}
+    for shard, policies in placed.items():
+        for policy in policies:
+            # The response is read back from the shard after the commit
+            rules = add_rules(api, policy)
+            assert [rule['port'] for rule in rules] == [80, 81, 82]
+            assert all(rule['id'] is not None for rule in rules)
+            created[policy] = rules
+
+            listed = api.client.get(f'/rules/policy/{policy}').get_json()
+            assert listed == rules
+
+    for shard, policies in placed.items():
+        expected = {rule['id'] for policy in policies for rule in created[policy]}
+        assert shard_rule_ids(app, shard) == expected
+    assert shard_rule_ids(app, 'main') == set()
+
+    # IDs are unique across the shards, the search gathers them in ID order
+    all_ids = sorted(rule['id'] for rules in created.values() for rule in rules)
+    assert len(set(all_ids)) == len(all_ids) == 12
+    pages = [api.client.get('/rules/search', query_string={'port': 81, 'page': page,
+                                                           'per_page': 3}).get_json()
+             for page in (1, 2)]
+    assert [rule['id'] for page in pages for rule in page['results']] == \
+        sorted(rules[1]['id'] for rules in created.values())
+    assert pages[0]['total'] == 4
+
+
+def test_rules_are_moved_and_deleted_in_their_shard(app, api, placed):
+    (first, second), (other, _) = placed['a'], placed['b']
+    rules = add_rules(api, first)
+    kept = add_rules(api, other)
+
+    # Found in its shard by ID, moved there
+    response = api.client.post(f"/rules/{rules[2]['id']}/move", json={'before': rules[0]['id']})
+    assert response.status_code == 200
+    listed = api.client.get(f'/rules/policy/{first}').get_json()
+    assert [rule['id'] for rule in listed] == [rules[2]['id'], rules[0]['id'], rules[1]['id']]
+
+    assert api.client.delete(f"/rules/{rules[0]['id']}").status_code == 204
+    assert api.client.delete(f"/rules/{rules[0]['id']}").status_code == 404
+    assert shard_rule_ids(app, 'a') == {rules[1]['id'], rules[2]['id']}
+
+    # Deleting the policy deletes its rules from the shard, which has no foreign key
+    assert api.client.delete(f'/policies/{first}').status_code in (200, 202, 204)
+    assert shard_rule_ids(app, 'a') == set()
+    assert shard_rule_ids(app, 'b') == {rule['id'] for rule in kept}
+    listed = api.client.get(f'/rules/policy/{other}').get_json()
+    assert listed == kept
@@ -0,0 +1,82 @@
+"Tests of the ruleset snapshots and of their hash-based diff"
+import random
+import pytest
+from app.utils.snapshots import DIGEST_SIZE, missing_positions
+
+RULE = {'action': 'ALLOW', 'protocol': 'TCP', 'source_ip': '10.0.0.0/8',
+        'destination_ip': '0.0.0.0/0'}
+
+
+def packed(digests: list) -> bytes:
+    return b''.join(digests)
+
+
+def expected_missing(rules: list, reference: list) -> list:
+    present = set(reference)
+    return [position for position, digest in enumerate(rules) if digest not in present]
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_missing_positions_match_a_set_difference(seed):
+    rng = random.Random(seed)
+    pool = [rng.randbytes(DIGEST_SIZE) for _ in range(300)]
+    # Digests sharing their first half with another one are checked exactly
+    pool += [digest[:8] + rng.randbytes(8) for digest in pool[:20]]
+    rules = rng.choices(pool, k=400)
+    reference = rng.sample(pool, 150)
+    assert missing_positions(packed(rules), packed(reference)) == \
+        expected_missing(rules, reference)
+    assert missing_positions(packed(rules), b'') == list(range(len(rules)))
+
+
+def snapshot(client, firewall: int) -> dict:
+    response = client.post(f'/firewalls/{firewall}/snapshots')
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def diff(client, firewall: int, base: dict, head: dict) -> dict:
+    response = client.get(f"/firewalls/{firewall}/snapshots/{base['id']}/diff/{head['id']}")
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_snapshots_are_frozen_and_deduplicated(client, api):
+    firewall, policy = api.firewall('fw'), api.policy('p')
+    api.attach(firewall, policy)
+    ssh = api.rule(policy, port=22, **RULE)
+    https = api.rule(policy, port=443, **RULE)
+
+    first = snapshot(client, firewall)
+    assert (first['rule_count'], first['deduplicated']) == (2, False)
+    second = snapshot(client, firewall)
+    assert second['id'] != first['id']
+    assert (second['digest'], second['deduplicated']) == (first['digest'], True)
+    assert diff(client, firewall, first, second) == {
+        'firewall_id': firewall, 'base': first['id'], 'head': second['id'],
+        'added': [], 'removed': [], 'unchanged': 2}
+
+    assert client.delete(f"/rules/{ssh['id']}").status_code in (200, 204)
+    api.rule(policy, port=80, before=https['id'], **RULE)
+    third = snapshot(client, firewall)
+    changes = diff(client, firewall, first, third)
+    assert [rule['port'] for rule in changes['added']] == [80]
+    assert [rule['port'] for rule in changes['removed']] == [22]
+    assert changes['unchanged'] == 1
+    assert changes['added'][0]['policy_id'] == policy
+
+    # The older snapshot still holds the rules it froze, in evaluation order
+    frozen = client.get(f"/firewalls/{firewall}/snapshots/{first['id']}").get_json()
+    assert [rule['port'] for rule in frozen['rules']] == [22, 443]
+    current = client.get(f"/firewalls/{firewall}/snapshots/{third['id']}").get_json()
+    assert [rule['port'] for rule in current['rules']] == [80, 443]
+
+
+def test_snapshots_belong_to_their_firewall(client, api):
+    firewall, other = api.firewall('fw'), api.firewall('other')
+    taken = snapshot(client, firewall)
+    assert taken['rule_count'] == 0
+    assert client.get(f"/firewalls/{other}/snapshots/{taken['id']}").status_code == 404
+    assert client.get(f"/firewalls/{other}/snapshots/{taken['id']}/diff/{taken['id']}") \
+        .status_code == 404
+    assert client.post('/firewalls/999/snapshots').status_code == 404
@@ -0,0 +1,66 @@
+"Tests of the boot: tables created only without migrations, and the compiled OpenAPI spec"
+import json
+import pytest
+from sqlalchemy import inspect
+from app import create_app
+from app.config import Config
+from app.extensions import db
+
+
+def tables(app) -> set:
+    with app.app_context():
+        return set(inspect(db.engine).get_table_names())
+
+
+@pytest.mark.parametrize('app_config', [{'DB_CREATE_ALL': 'always'}])
+def test_tables_are_created_on_boot(app):
+    assert {'firewall', 'policy', 'rule', 'firewall_policy'} <= tables(app)
+
+
+@pytest.mark.parametrize('app_config', [{'DB_CREATE_ALL': 'never'}])
+def test_no_ddl_when_disabled(app):
+    assert tables(app) == set()
+
+
+class TestMigrations:
+
+    @pytest.fixture
+    def app_config(self, tmp_path, monkeypatch):
+        # flask-migrate looks for its directory relative to the working directory
+        (tmp_path / 'migrations').mkdir()
+        monkeypatch.chdir(tmp_path)
+        return {'DB_CREATE_ALL': 'auto'}
+
+    def test_migrations_own_the_schema(self, app):
+        assert tables(app) == set()
+
+
+def test_invalid_create_all_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setattr(Config, 'DB_CREATE_ALL', 'sometimes')
+    with pytest.raises(ValueError):
+        create_app()
+
+
+def test_spec_is_built_on_the_first_request(app, client, tmp_path, monkeypatch):
+    # Neither parsed at boot nor read from an artifact
+    monkeypatch.setitem(app.config, 'APISPEC_PATH', str(tmp_path / 'missing.json'))
+    assert app.swag.apispecs == {}
+    spec = client.get('/apispec_1.json').get_json()
+    assert '/firewalls/' in spec['paths']
+    assert app.swag.apispecs
+
+
+def test_compiled_spec_is_served(app, client, tmp_path, monkeypatch):
+    artifact = tmp_path / 'apispec.json'
+    result = app.test_cli_runner().invoke(args=['docs', 'build', '--output', str(artifact)])
+    assert result.exit_code == 0, result.output
+    specs = json.loads(artifact.read_text())
+    assert '/firewalls/' in specs['apispec_1']['paths']
+
+    # Served from the artifact, not from the YAML files of the routes
+    specs['apispec_1']['info']['title'] = 'Compiled'
+    artifact.write_text(json.dumps(specs))
+    monkeypatch.setitem(app.config, 'APISPEC_PATH', str(artifact))
+    app.swag.apispecs.clear()
+    assert client.get('/apispec_1.json').get_json()['info']['title'] == 'Compiled'